@@ -0,0 +1,112 @@
+'''
+Runs a full Shutdown.shutdown() against a simulated esxi host, see
+esximanager.simulator, for increasing numbers of vms and reports the end to
+end wall time, the number of remote commands and the time spent in each
+phase.
+
+All of the simulated times, the guest shutdown latencies, command round trip
+and the Shutdown poll intervals and timeouts, are multiplied by --time-scale
+so that the benchmark completes quickly while preserving their proportions.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.bench_end_to_end
+'''
+import sys
+import time
+import logging
+import argparse
+from argparse import Namespace
+from esximanager.hostexec import HostExecutor
+from esximanager.metrics import RunMetrics
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, lognormal
+
+logger = logging.getLogger(__name__)
+
+PHASES = [
+    RunMetrics.PHASE_INVENTORY,
+    RunMetrics.PHASE_GRACEFUL_SHUTDOWN,
+    RunMetrics.PHASE_GRACEFUL_WAIT,
+    RunMetrics.PHASE_FORCED_POWEROFF,
+    RunMetrics.PHASE_FORCED_WAIT,
+    RunMetrics.PHASE_HOST_EXECUTOR,
+    RunMetrics.PHASE_HOST_POWEROFF,
+    RunMetrics.PHASE_HOST_WAIT,
+    ]
+
+
+def bench(num_vms, args):
+    scale = args.time_scale
+    host = SimulatedEsxiHost(
+        num_vms,
+        shutdown_latency=lognormal(args.median_shutdown * scale, args.sigma),
+        hung_fraction=args.hung_fraction,
+        command_latency=args.command_latency * scale,
+        poweroff_latency=args.host_poweroff_latency * scale,
+        seed=args.seed)
+    shutdown = Shutdown(
+        Namespace(esxihost='esxi.simulated', dryrun=False),
+        logger,
+        vm_poweroff_poll=Shutdown.DEFAULT_VM_POWEROFF_POLL_SECONDS * scale,
+        vm_poweroff_timeout=Shutdown.DEFAULT_VM_POWEROFF_TIMEOUT * scale,
+        esxi_poweroff_poll=Shutdown.DEFAULT_EXSI_HOST_POWEROFF_POLL_SECONDS * scale,
+        transport=host.create_transport(logger),
+        probe=host.create_probe(),
+        host_executor=args.host_executor)
+    if shutdown.host_executor is not None:
+        shutdown.host_executor.poll = HostExecutor.DEFAULT_POLL_SECONDS * scale
+    shutdown.vm_poweroff_min_poll = Shutdown.DEFAULT_VM_POWEROFF_MIN_POLL_SECONDS * scale
+    shutdown.esxi_poweroff_min_poll = Shutdown.DEFAULT_EXSI_HOST_POWEROFF_MIN_POLL_SECONDS * scale
+
+    start_time = time.time()
+    result = shutdown.shutdown()
+    elapsed = time.time() - start_time
+    return result, elapsed, shutdown.transport.commands, shutdown.metrics.get_phase_seconds()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vms', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--time-scale', type=float, default=0.01)
+    parser.add_argument(
+        '--median-shutdown',
+        type=float,
+        default=10,
+        help='median guest shutdown time, in unscaled seconds')
+    parser.add_argument(
+        '--sigma',
+        type=float,
+        default=0.8,
+        help='shape of the lognormal guest shutdown time distribution')
+    parser.add_argument('--hung-fraction', type=float, default=0.02)
+    parser.add_argument(
+        '--command-latency',
+        type=float,
+        default=0.05,
+        help='round trip time of each remote command, in unscaled seconds')
+    parser.add_argument(
+        '--host-poweroff-latency',
+        type=float,
+        default=5,
+        help='time for the host to go down after the poweroff command, in unscaled seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument(
+        '--host-executor',
+        action='store_true',
+        help='run the vm shutdown on the simulated host, see esximanager.hostexec')
+    parser.add_argument('--loglevel', type=str, default='CRITICAL')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), stream=sys.stderr)
+
+    print(f'{"vms":>6} {"result":>8} {"wall_secs":>10} {"commands":>9} ' + ' '.join(f'{p:>18}' for p in PHASES))
+    for num_vms in args.vms:
+        result, elapsed, commands, timings = bench(num_vms, args)
+        print(
+            f'{num_vms:>6} {result:>8} {elapsed:>10.3f} {commands:>9} '
+            + ' '.join(f'{timings.get(p, 0):>18.3f}' for p in PHASES))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
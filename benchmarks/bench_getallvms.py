@@ -0,0 +1,97 @@
+'''
+Parses a synthetic vim-cmd vmsvc/getallvms output for a large inventory and
+reports the parse time and the memory held by the parsed records, against
+the previous approach of splitting each line on whitespace into a dict.
+
+Some of the synthetic vms have spaces in their names and datastores and
+annotations that run over several lines, which the whitespace split cannot
+parse correctly; it is only there as a baseline for the cost.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.bench_getallvms
+'''
+import io
+import sys
+import time
+import logging
+import argparse
+import tracemalloc
+from esximanager.inventory import GetAllVmsParser
+
+logger = logging.getLogger(__name__)
+
+ROW = '{:<7}{:<28}{:<64}{:<20}{:<10}{}'
+
+
+def get_output(num_vms):
+    lines = [ROW.format('Vmid', 'Name', 'File', 'Guest OS', 'Version', 'Annotation')]
+    for vm_id in range(1, num_vms + 1):
+        if vm_id % 10 == 0:
+            name = f'app server {vm_id}'
+            datastore = '[datastore 2]'
+            annotation = 'Owned by the platform team\nrestart after the database'
+        else:
+            name = f'vm-{vm_id}'
+            datastore = '[datastore1]'
+            annotation = ''
+        lines.append(ROW.format(
+            vm_id, name, f'{datastore} {name}/{name}.vmx', 'centos7_64Guest', 'vmx-14', annotation))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_split(output):
+    retval = {}
+    for line in output.splitlines()[1:]:
+        tokens = line.split()
+        if len(tokens) < 6 or not tokens[0].isdigit():
+            continue
+        retval[int(tokens[0])] = dict(
+            name=tokens[1],
+            datastore=tokens[2],
+            file=tokens[3],
+            guest_os=tokens[4],
+            version=tokens[5],
+            )
+    return retval
+
+
+def parse_streaming(output):
+    return dict(GetAllVmsParser(logger).parse(io.StringIO(output)))
+
+
+def bench(funct, output, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        funct(output)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    vms = funct(output)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, retained, len(vms)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vms', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--loglevel', type=str, default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), stream=sys.stderr)
+
+    output = get_output(args.vms)
+    print(f'{"parser":>10} {"vms":>7} {"best_secs":>10} {"usecs_per_vm":>13} {"retained_kib":>13}')
+    for name, funct in [('split', parse_split), ('streaming', parse_streaming)]:
+        best, retained, num_vms = bench(funct, output, args.repeat)
+        print(
+            f'{name:>10} {num_vms:>7} {best:>10.4f} {best / max(num_vms, 1) * 1e6:>13.2f} '
+            f'{retained / 1024:>13.0f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
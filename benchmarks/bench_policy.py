@@ -0,0 +1,88 @@
+'''
+Sweeps the vm poll interval and timeout of Shutdown over a simulated esxi
+host, see esximanager.simulator.simulate_shutdown, running the real shutdown
+logic in virtual time, and reports for each pair the simulated time that the
+shutdown took, the number of remote commands, the number of vms that were
+forcefully powered off and how late the shutdown was to notice a vm, or the
+host, powering off.
+
+As the shutdown runs on a virtual clock, the real time of the guest
+shutdowns and of the timeouts is simulated without waiting for it, and each
+run takes a fraction of a second.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.bench_policy
+'''
+import sys
+import logging
+import argparse
+from esximanager.simulator import lognormal, simulate_shutdown
+
+logger = logging.getLogger(__name__)
+
+
+def format_seconds(seconds):
+    return f'{seconds:.2f}' if seconds is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vms', type=int, default=500)
+    parser.add_argument('--polls', type=float, nargs='+', default=[0.5, 1, 2, 5, 10])
+    parser.add_argument('--timeouts', type=int, nargs='+', default=[30, 60, 120])
+    parser.add_argument(
+        '--median-shutdown',
+        type=float,
+        default=10,
+        help='median guest shutdown time, in seconds')
+    parser.add_argument(
+        '--sigma',
+        type=float,
+        default=0.8,
+        help='shape of the lognormal guest shutdown time distribution')
+    parser.add_argument('--hung-fraction', type=float, default=0.02)
+    parser.add_argument(
+        '--command-latency',
+        type=float,
+        default=0.05,
+        help='round trip time of each remote command, in seconds')
+    parser.add_argument(
+        '--host-poweroff-latency',
+        type=float,
+        default=5,
+        help='time for the host to go down after the poweroff command, in seconds')
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--loglevel', type=str, default='CRITICAL')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper(), stream=sys.stderr)
+
+    host_kwargs = dict(
+        shutdown_latency=lognormal(args.median_shutdown, args.sigma),
+        hung_fraction=args.hung_fraction,
+        command_latency=args.command_latency,
+        poweroff_latency=args.host_poweroff_latency,
+        seed=args.seed)
+    print(
+        f'{"poll":>6} {"timeout":>8} {"result":>8} {"sim_secs":>9} {"commands":>9} {"forced":>7} '
+        f'{"vm_late":>8} {"host_late":>10} {"wall_secs":>10}')
+    for timeout in args.timeouts:
+        for poll in args.polls:
+            report = simulate_shutdown(
+                args.vms,
+                logger,
+                host_kwargs=host_kwargs,
+                vm_poweroff_poll=poll,
+                vm_poweroff_timeout=timeout,
+                vm_command_concurrency=args.concurrency)
+            print(
+                f'{poll:>6} {timeout:>8} {report["result"]:>8} {report["seconds"]:>9.2f} '
+                f'{report["num_commands"]:>9} {report["num_forced"]:>7} '
+                f'{format_seconds(report["vm_lateness"]):>8} {format_seconds(report["host_lateness"]):>10} '
+                f'{report["wall_seconds"]:>10.3f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
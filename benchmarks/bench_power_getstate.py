@@ -0,0 +1,85 @@
+'''
+Compares the number of remote round trips and the wall time of querying the
+power state of every vm one at a time against the batched power.getstate
+command.
+
+Remote execution is replaced with a stand-in that sleeps for a fixed round trip
+latency, which is the dominant cost of each remote command against a real esxi
+host.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.bench_power_getstate
+'''
+import sys
+import time
+import logging
+import argparse
+from argparse import Namespace
+from esximanager.shutdown import Shutdown
+from esximanager.transport import CommandResult
+from esximanager.transport.fake import FakeTransport
+
+logger = logging.getLogger(__name__)
+
+
+class Responder(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def __call__(self, command):
+        time.sleep(self.latency)
+        lines = []
+        if command.startswith('for id in'):
+            ids = command[len('for id in'):command.index(';')].split()
+            for vm_id in ids:
+                lines.append(f'{Shutdown.POWER_GETSTATE_MARKER} {vm_id}')
+                lines.extend(['Retrieved runtime info', 'Powered on'])
+        else:
+            lines.extend(['Retrieved runtime info', 'Powered on'])
+        return CommandResult('\n'.join(lines), 0)
+
+
+def bench(vm_ids, latency, batched):
+    args = Namespace(esxihost='esxi.example.com', dryrun=True)
+    transport = FakeTransport(args.esxihost, logger, responder=Responder(latency))
+    shutdown = Shutdown(args, logger, transport=transport)
+
+    start_time = time.time()
+    if batched:
+        shutdown.get_vm_power_states(vm_ids)
+    else:
+        for vm_id in vm_ids:
+            shutdown.is_vm_running(vm_id)
+    elapsed = time.time() - start_time
+    return transport.commands, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.05,
+        help='simulated round trip latency, in seconds, of each remote command')
+    parser.add_argument(
+        '--vms',
+        type=int,
+        nargs='+',
+        default=[10, 80, 200],
+        help='numbers of vms to benchmark')
+    args = parser.parse_args()
+
+    print(f'{"vms":>6} {"mode":>8} {"round_trips":>12} {"wall_secs":>10}')
+    for num_vms in args.vms:
+        vm_ids = list(range(1, num_vms + 1))
+        for batched in (False, True):
+            calls, elapsed = bench(vm_ids, args.latency, batched)
+            mode = 'batched' if batched else 'per-vm'
+            print(f'{num_vms:>6} {mode:>8} {calls:>12} {elapsed:>10.3f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+'''
+Measures the startup cost of each transport: the time to import it in a fresh
+interpreter, and, if an esxi host is given, the time to connect and run a
+first command and the mean latency of the commands after that.
+
+Run from the root of the repository with:
+
+    python -m benchmarks.bench_transport_startup [--esxihost esxi.example.com]
+'''
+import sys
+import time
+import logging
+import argparse
+import subprocess
+from esximanager.transport import TRANSPORTS, TRANSPORT_FAKE, create_transport
+
+logger = logging.getLogger(__name__)
+
+IMPORT_SNIPPET = '''
+import time
+start_time = time.perf_counter()
+from esximanager.transport import get_transport_class
+get_transport_class({name!r})
+print(time.perf_counter() - start_time)
+'''
+
+
+def measure_import(name, runs):
+    '''
+    Returns the best of runs of the time, in seconds, to import the transport
+    in a fresh interpreter.
+    '''
+    retval = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SNIPPET.format(name=name)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True)
+        retval.append(float(result.stdout))
+    return min(retval)
+
+
+def measure_commands(name, host, commands):
+    transport = create_transport(name, host, logger)
+    with transport:
+        start_time = time.perf_counter()
+        transport.run('true')
+        first_command = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for _ in range(commands):
+            transport.run('true')
+        mean_command = (time.perf_counter() - start_time) / commands
+    return first_command, mean_command
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--esxihost',
+        type=str,
+        help='host on which to also measure connection and command latency')
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=5,
+        help='number of fresh interpreters in which to measure the import time')
+    parser.add_argument(
+        '--commands',
+        type=int,
+        default=20,
+        help='number of commands over which to average the command latency')
+    args = parser.parse_args()
+
+    print(f'{"transport":>10} {"import_secs":>12} {"first_cmd_secs":>15} {"mean_cmd_secs":>14}')
+    for name in TRANSPORTS:
+        import_seconds = measure_import(name, args.runs)
+        first_command = mean_command = None
+        if args.esxihost is not None or name == TRANSPORT_FAKE:
+            first_command, mean_command = measure_commands(name, args.esxihost, args.commands)
+        first_command = f'{first_command:.4f}' if first_command is not None else '-'
+        mean_command = f'{mean_command:.4f}' if mean_command is not None else '-'
+        print(f'{name:>10} {import_seconds:>12.4f} {first_command:>15} {mean_command:>14}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import threading
+import socketserver
+from esximanager import agentclient
+from esximanager.budget import BudgetError
+from esximanager.pool import run_concurrently
+from esximanager.shutdown import Shutdown
+
+
+class Agent(object):
+    '''
+    A resident process that keeps everything needed to shut down the esxi
+    hosts warm, the ssh connections, the vm inventories and the recent power
+    states of the vms, so that a shutdown can start the moment it is
+    triggered over a unix domain socket instead of after interpreter startup,
+    ssh handshakes and inventory scans.
+
+    A background thread refreshes the power states of all of the vms every
+    refresh_interval seconds, which also keeps the connections alive and
+    notices when an inventory has gone stale.
+    '''
+
+    DEFAULT_REFRESH_SECONDS = 30
+
+    def __init__(
+            self,
+            shutdowns,
+            logger,
+            socket_path=None,
+            refresh_interval=None,
+            max_workers=None,
+            budget_factory=None):
+        '''
+        shutdowns is a dict of esxi host to the esximanager.shutdown.Shutdown
+        that will be used to shut it down.  budget_factory, if provided, is
+        called when a shutdown is triggered to get the
+        esximanager.budget.Budget for it.
+        '''
+        self.shutdowns = shutdowns
+        self.logger = logger
+        self.socket_path = socket_path if socket_path is not None else agentclient.DEFAULT_SOCKET_PATH
+        if refresh_interval is not None and refresh_interval > 0:
+            self.refresh_interval = refresh_interval
+        else:
+            self.refresh_interval = Agent.DEFAULT_REFRESH_SECONDS
+        self.max_workers = max_workers if max_workers is not None and max_workers > 0 else len(shutdowns)
+        self.budget_factory = budget_factory
+
+        # host -> dict(running_vms, timestamp) of the last refresh
+        self.states = {}
+        self.shutdown_lock = threading.Lock()
+        self.shutdown_done = False
+        self.stopped = threading.Event()
+        self.server = None
+
+    def refresh(self):
+        '''
+        Loads the inventory of each host, if we do not have it yet, and the
+        power states of all of its vms.
+        '''
+        def refresh_host(host):
+            _, running_vms = self.shutdowns[host].get_inventory_and_running_vms()
+            return running_vms
+
+        for host, outcome in self.run_on_hosts(refresh_host).items():
+            if outcome.succeeded:
+                self.states[host] = dict(running_vms=outcome.result, timestamp=time.time())
+            else:
+                self.logger.error(f'Unable to refresh state of esxihost={host}, error={outcome.error!r}')
+
+    def refresh_loop(self):
+        while not self.stopped.wait(self.refresh_interval):
+            if self.shutdown_done or self.shutdown_lock.locked():
+                continue
+            self.refresh()
+
+    def run_on_hosts(self, funct):
+        return run_concurrently(funct, list(self.shutdowns), self.max_workers)
+
+    def status(self):
+        now = time.time()
+        retval = {}
+        for host, shutdown in self.shutdowns.items():
+            state = self.states.get(host)
+            retval[host] = dict(
+                num_vms=len(shutdown.inventory) if shutdown.inventory is not None else None,
+                running_vms=state['running_vms'] if state is not None else None,
+                refreshed_seconds_ago=round(now - state['timestamp'], 3) if state is not None else None,
+                transport=shutdown.transport.stats())
+        return retval
+
+    def shutdown(self):
+        '''
+        Shuts down all of the hosts and returns a dict of host to result,
+        including how long after the trigger the first shutdown command for
+        the host was issued.
+        '''
+        trigger_time = time.time()
+        budget = None
+        if self.budget_factory is not None:
+            try:
+                budget = self.budget_factory()
+            except (BudgetError, OSError) as e:
+                self.logger.error(f'Unable to get the shutdown budget, using the fixed timeouts instead, error={e!r}')
+
+        def shutdown_host(host):
+            shutdown = self.shutdowns[host]
+            shutdown.budget = budget
+            return shutdown.shutdown()
+
+        outcomes = self.run_on_hosts(shutdown_host)
+        self.shutdown_done = True
+
+        retval = {}
+        for host, outcome in outcomes.items():
+            first_command_time = self.shutdowns[host].first_command_time
+            latency = first_command_time - trigger_time if first_command_time is not None else None
+            retval[host] = dict(
+                result=outcome.result,
+                error=repr(outcome.error) if outcome.error is not None else None,
+                trigger_to_first_command_seconds=round(latency, 6) if latency is not None else None)
+            self.logger.info(
+                f'Shutdown of esxihost={host} result={outcome.result}, '
+                f'trigger_to_first_command_seconds={latency}')
+        return retval
+
+    def handle_command(self, command, send):
+        '''
+        Runs the command received from a client, calling send with each dict
+        to be returned to it.
+        '''
+        if command == agentclient.COMMAND_PING:
+            send(dict(ok=True))
+        elif command == agentclient.COMMAND_STATUS:
+            send(dict(ok=True, status=self.status()))
+        elif command == agentclient.COMMAND_SHUTDOWN:
+            if not self.shutdown_lock.acquire(blocking=False):
+                send(dict(ok=False, error='A shutdown is already in progress'))
+                return
+            try:
+                send(dict(ok=True, event='accepted'))
+                results = self.shutdown()
+                ok = all(r['error'] is None and r['result'] == Shutdown.RESULT_OK for r in results.values())
+                send(dict(ok=ok, event='done', results=results))
+            finally:
+                self.shutdown_lock.release()
+        else:
+            send(dict(ok=False, error=f'Unknown command={command}'))
+
+    def get_handler_class(self):
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                command = self.rfile.readline().decode('utf-8').strip()
+                agent.logger.info(f'Received command={command}')
+
+                def send(message):
+                    try:
+                        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                    except OSError as e:
+                        # The client going away must never stop a shutdown
+                        agent.logger.warning(f'Unable to send message to client, error={e!r}')
+
+                agent.handle_command(command, send)
+
+        return Handler
+
+    def bind(self):
+        '''
+        Creates the socket, readable and writable only by this user, replacing
+        any left over from a previous run.
+        '''
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, self.get_handler_class())
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+
+    def serve_forever(self):
+        '''
+        Warms up all of the state and then serves commands until stopped.
+        '''
+        start_time = time.time()
+        self.refresh()
+        self.logger.info(f'Warmed up state for hosts={list(self.shutdowns)} in [{time.time() - start_time:.3f}] seconds')
+
+        self.bind()
+        refresh_thread = threading.Thread(target=self.refresh_loop, daemon=True)
+        refresh_thread.start()
+        self.logger.info(f'Listening on socket={self.socket_path}')
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,76 @@
+'''
+A minimal client for the esximanager agent, see esximanager.agent.Agent.
+
+It only imports from the standard library so that triggering a shutdown from
+apcupsd costs as little startup time as possible.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+
+DEFAULT_SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'esximanager', 'agent.sock')
+
+COMMAND_SHUTDOWN = 'shutdown'
+COMMAND_STATUS = 'status'
+COMMAND_PING = 'ping'
+COMMANDS = [COMMAND_SHUTDOWN, COMMAND_STATUS, COMMAND_PING]
+
+
+def send_command(socket_path, command, timeout=None):
+    '''
+    Sends the command to the agent and yields each of the json messages that
+    it sends back until it closes the connection.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(f'{command}\n'.encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+    finally:
+        sock.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Sends a command to a running esximanager agent')
+    parser.add_argument(
+        'command',
+        choices=COMMANDS,
+        nargs='?',
+        default=COMMAND_SHUTDOWN,
+        help='command to send to the agent')
+    parser.add_argument(
+        '--socket',
+        type=str,
+        default=DEFAULT_SOCKET_PATH,
+        help='path to the unix domain socket on which the agent is listening')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help='seconds to wait for the agent to respond')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    start_time = time.time()
+    args = parse_args(argv)
+    retval = 0
+    try:
+        for message in send_command(args.socket, args.command, args.timeout):
+            message['client_elapsed_seconds'] = round(time.time() - start_time, 6)
+            print(json.dumps(message), flush=True)
+            if message.get('error') is not None or message.get('ok') is False:
+                retval = 1
+    except OSError as e:
+        print(json.dumps(dict(error=f'Unable to talk to agent on socket={args.socket}: {e}')), flush=True)
+        retval = 2
+    return retval
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import re
+from collections import namedtuple
+
+
+class AutostartEntry(namedtuple('AutostartEntry', [
+        'vm_id', 'start_action', 'start_delay', 'start_order', 'stop_action', 'stop_delay', 'wait_for_heartbeat'])):
+    '''
+    The autostart manager settings of one vm, as set with
+    vim-cmd hostsvc/autostartmanager/update_autostartentry.  A delay or order
+    of -1 means the system default, or no order.
+    '''
+    __slots__ = ()
+
+    def matches(self, other):
+        '''
+        Whether the two entries are the same, ignoring the case of the
+        actions, which the host does not report the way that they were set.
+        '''
+        if other is None:
+            return False
+        return all(
+            str(a).lower() == str(b).lower()
+            for a, b in zip(self, other))
+
+
+class AutostartManager(object):
+    '''
+    Reads and updates the autostart manager of an esxi host, which hostd uses
+    to start the vms when the host boots and, more to the point, to stop them
+    in the reverse of their start order when the host is shut down.
+
+    When it is enabled and a vm has the guestShutdown stop action, hostd shuts
+    the guest down when the host is powered off and waits up to the stop delay
+    for it to power off, before powering it off and moving on to the next vm.
+    Delegating the shutdown of the vms to it means that the client only has
+    to issue the host poweroff during the outage.
+    '''
+
+    STOP_ACTION_GUEST_SHUTDOWN = 'guestShutdown'
+    # The stop delay that hostd uses for a delay of -1, unless it has been changed
+    DEFAULT_STOP_DELAY_SECONDS = 120
+    START_ACTION_NONE = 'none'
+    SYSTEM_DEFAULT = 'systemDefault'
+
+    KEY_RE = re.compile(r"^\s*key = 'vim\.VirtualMachine:([0-9]+)'")
+    FIELD_RE = re.compile(r'^\s*(\w+) = "?([^",]*)"?,?\s*$')
+    FIELDS = dict(
+        startAction='start_action',
+        startDelay='start_delay',
+        startOrder='start_order',
+        stopAction='stop_action',
+        stopDelay='stop_delay',
+        waitForHeartbeat='wait_for_heartbeat')
+
+    def __init__(self, transport, logger, dryrun=False):
+        self.transport = transport
+        self.logger = logger
+        self.dryrun = dryrun
+
+    def fab_get_autostartseq(self):
+        return self.transport.run('vim-cmd hostsvc/autostartmanager/get_autostartseq').stdout.splitlines()
+
+    def fab_enable_autostart(self):
+        return self.transport.run('vim-cmd hostsvc/autostartmanager/enable_autostart true').succeeded
+
+    def fab_update_autostartentry(self, entry):
+        return self.transport.run(
+            'vim-cmd hostsvc/autostartmanager/update_autostartentry '
+            f'{entry.vm_id} {entry.start_action} {entry.start_delay} {entry.start_order} '
+            f'{entry.stop_action} {entry.stop_delay} {entry.wait_for_heartbeat}').succeeded
+
+    @staticmethod
+    def parse_autostartseq(lines):
+        '''
+        Parses the output of get_autostartseq, a list of
+        (vim.host.AutoStartManager.AutoPowerInfo) blocks, into a dict of
+        vm_id to AutostartEntry.
+        '''
+        retval = {}
+        fields = None
+        for line in lines:
+            match = AutostartManager.KEY_RE.match(line)
+            if match is not None:
+                fields = dict(vm_id=int(match.group(1)))
+                continue
+            if fields is None:
+                continue
+            match = AutostartManager.FIELD_RE.match(line)
+            if match is not None and match.group(1) in AutostartManager.FIELDS:
+                value = match.group(2).strip()
+                fields[AutostartManager.FIELDS[match.group(1)]] = int(value) if re.match(r'^-?[0-9]+$', value) else value
+            if len(fields) == len(AutostartManager.FIELDS) + 1:
+                retval[fields['vm_id']] = AutostartEntry(**fields)
+                fields = None
+        return retval
+
+    def get_entries(self):
+        return AutostartManager.parse_autostartseq(self.fab_get_autostartseq())
+
+    @staticmethod
+    def get_desired_entries(waves, stop_delays, current):
+        '''
+        Returns the dict of vm_id to the AutostartEntry that makes hostd shut
+        down the vms in the order of waves, a list of lists of vm_ids, waiting
+        up to the stop delay, from the dict of vm_id to seconds, for each.
+
+        hostd stops the vms in the reverse of their start order, so the last
+        wave gets the first start orders.  The start settings of the vms are
+        otherwise left as they are in current, and vms without an entry are
+        not started automatically.
+        '''
+        retval = {}
+        order = 1
+        for wave in reversed(waves):
+            for vm_id in sorted(wave, reverse=True):
+                existing = current.get(vm_id)
+                retval[vm_id] = AutostartEntry(
+                    vm_id,
+                    existing.start_action if existing is not None else AutostartManager.START_ACTION_NONE,
+                    existing.start_delay if existing is not None else -1,
+                    order,
+                    AutostartManager.STOP_ACTION_GUEST_SHUTDOWN,
+                    stop_delays.get(vm_id, -1),
+                    existing.wait_for_heartbeat if existing is not None else AutostartManager.SYSTEM_DEFAULT)
+                order += 1
+        return retval
+
+    def sync(self, desired, current=None):
+        '''
+        Enables the autostart manager and updates only the entries of the vms
+        whose settings differ from desired, a dict of vm_id to
+        AutostartEntry.  Returns the number of entries that were updated, or
+        None if any of the updates failed.
+        '''
+        current = current if current is not None else self.get_entries()
+        changed = [entry for vm_id, entry in sorted(desired.items()) if not entry.matches(current.get(vm_id))]
+        self.logger.info(
+            f'Syncing autostart manager of host={self.transport.host}, '
+            f'num_vms={len(desired)}, num_changed={len(changed)}')
+        if self.dryrun:
+            for entry in changed:
+                self.logger.info(f'In dryrun mode, not updating autostart entry={entry}')
+            return len(changed)
+
+        succeeded = self.fab_enable_autostart()
+        for entry in changed:
+            if not self.fab_update_autostartentry(entry):
+                self.logger.error(f'Unable to update autostart entry={entry} on host={self.transport.host}')
+                succeeded = False
+        return len(changed) if succeeded else None
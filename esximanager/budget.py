@@ -0,0 +1,113 @@
+import re
+import time
+import subprocess
+
+
+class BudgetError(Exception):
+    pass
+
+
+class Budget(object):
+    '''
+    A total amount of time, in seconds, within which a shutdown must complete,
+    typically the runtime left on the UPS batteries, divided across the phases
+    of the shutdown.
+
+    Each phase is given an absolute deadline such that the time reserved for
+    all of the phases that follow it is still available.  Any time that a
+    phase does not use carries over to the next one.
+    '''
+
+    PHASE_GRACEFUL = 'graceful'
+    PHASE_FORCED = 'forced'
+    PHASE_HOST = 'host'
+    PHASES = [PHASE_GRACEFUL, PHASE_FORCED, PHASE_HOST]
+
+    '''
+    The share of the total budget reserved for each phase.
+    '''
+    DEFAULT_PHASE_SHARES = {
+        PHASE_GRACEFUL: 0.6,
+        PHASE_FORCED: 0.2,
+        PHASE_HOST: 0.2,
+        }
+
+    '''
+    Fraction of the apcupsd reported time left that is held back as a safety
+    margin, as the estimate is only as good as the UPS's battery model.
+    '''
+    DEFAULT_APCUPSD_MARGIN = 0.2
+
+    APCACCESS_CMD = ['apcaccess', '-p', 'TIMELEFT']
+
+    def __init__(self, total_seconds, phase_shares=None, start_time=None, clock=None):
+        if total_seconds <= 0:
+            raise BudgetError(f'Budget must be greater than 0, total_seconds={total_seconds}')
+        self.total_seconds = total_seconds
+        self.phase_shares = phase_shares if phase_shares is not None else Budget.DEFAULT_PHASE_SHARES
+        self.clock = clock if clock is not None else time.time
+        self.start_time = start_time if start_time is not None else self.clock()
+
+        share_sum = sum(self.phase_shares[phase] for phase in Budget.PHASES)
+        self.reserved = {
+            phase: total_seconds * self.phase_shares[phase] / share_sum
+            for phase in Budget.PHASES
+            }
+
+    @staticmethod
+    def parse_apcupsd_timeleft(output):
+        '''
+        Parses the TIMELEFT, in minutes, from apcaccess output such as
+        'TIMELEFT :  12.3 Minutes' or '12.3 Minutes' and returns it in
+        seconds.
+        '''
+        match = re.search(r'([0-9]+(?:\.[0-9]+)?)\s*Minutes', output)
+        if match is None:
+            raise BudgetError(f'Unable to parse TIMELEFT from apcaccess output={output!r}')
+        return float(match.group(1)) * 60
+
+    @staticmethod
+    def from_apcupsd(margin=DEFAULT_APCUPSD_MARGIN):
+        '''
+        Builds a Budget from the time left reported by apcupsd, less the
+        safety margin.
+        '''
+        result = subprocess.run(
+            Budget.APCACCESS_CMD,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode != 0:
+            raise BudgetError(f'Unable to query apcupsd, stderr={result.stderr}')
+        return Budget(Budget.parse_apcupsd_timeleft(result.stdout) * (1 - margin))
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def remaining(self):
+        return self.total_seconds - self.elapsed()
+
+    def deadline(self, phase):
+        '''
+        Returns the absolute time by which the phase must be complete to leave
+        the time reserved for all of the phases after it.
+        '''
+        later_phases = Budget.PHASES[Budget.PHASES.index(phase) + 1:]
+        reserved_after = sum(self.reserved[p] for p in later_phases)
+        return self.start_time + self.total_seconds - reserved_after
+
+    def time_left(self, phase):
+        return max(0, self.deadline(phase) - self.clock())
+
+    def would_overrun(self, phase, projected_seconds):
+        '''
+        Returns True if something that is projected to take projected_seconds,
+        started now, would finish after the deadline for the phase.
+        '''
+        return self.clock() + projected_seconds > self.deadline(phase)
+
+    def __repr__(self):
+        reserved = {phase: round(seconds, 1) for phase, seconds in self.reserved.items()}
+        return (
+            f'Budget(total_seconds={self.total_seconds:.1f}, '
+            f'remaining={self.remaining():.1f}, reserved={reserved})')
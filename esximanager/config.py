@@ -0,0 +1,139 @@
+import json
+
+
+class ConfigError(ValueError):
+    '''
+    Raised when the dependency configuration cannot be read or is invalid.
+    '''
+    pass
+
+
+class DependencyConfig(object):
+    '''
+    The dependencies between the vms, by the names returned by
+    Shutdown.get_all_vms, read from a json file of the form
+
+        {
+            "vms": {
+                "web-1": {"tags": ["app"], "depends_on": ["db"]},
+                "db-1": {"tags": ["db"], "depends_on": ["nas-1"], "ready": {"check": "heartbeat"}},
+                "nas-1": {"ready": {"check": "tcp", "host": "10.0.0.5", "port": 2049}}
+            },
+            "tags": {
+                "app": {"depends_on": ["db"]}
+            }
+        }
+
+    depends_on lists vm names or tags, which stand for every vm with that
+    tag, and can be given for a vm or for all of the vms with a tag.  A vm is
+    started only once all of the vms that it depends on are ready, and shut
+    down only once all of the vms that depend on it are off.
+
+    ready is the check used to decide that a vm is ready once it has been
+    powered on, see esximanager.startup.Startup.
+    '''
+
+    def __init__(self, vms=None, tags=None):
+        self.vms = vms if vms is not None else {}
+        self.tags = tags if tags is not None else {}
+        self.validate()
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ConfigError(f'Unable to read dependency config path={path}, error={e}') from e
+        if not isinstance(data, dict):
+            raise ConfigError(f'Dependency config path={path} must be a json object')
+        return DependencyConfig(vms=data.get('vms'), tags=data.get('tags'))
+
+    def validate(self):
+        for section in [self.vms, self.tags]:
+            if not isinstance(section, dict):
+                raise ConfigError('The vms and tags of the dependency config must be json objects')
+            for name, entry in section.items():
+                if not isinstance(entry, dict):
+                    raise ConfigError(f'The dependency config for name={name} must be a json object')
+                for key in ['tags', 'depends_on']:
+                    if not isinstance(entry.get(key, []), list):
+                        raise ConfigError(f'{key} of name={name} must be a list')
+
+    def get_tags(self, name):
+        return self.vms.get(name, {}).get('tags', [])
+
+    def get_readiness(self, name):
+        '''
+        Returns the dict of the readiness check for the vm, or None.
+        '''
+        return self.vms.get(name, {}).get('ready')
+
+    def resolve(self, reference, names):
+        '''
+        Returns the names, from names, that reference, a vm name or a tag,
+        stands for.
+        '''
+        if reference in names:
+            return {reference}
+        return {name for name in names if reference in self.get_tags(name)}
+
+    def get_dependencies(self, name, names):
+        '''
+        Returns the set of names, from names, that the vm depends on.
+        '''
+        references = list(self.vms.get(name, {}).get('depends_on', []))
+        for tag in self.get_tags(name):
+            references.extend(self.tags.get(tag, {}).get('depends_on', []))
+        retval = set()
+        for reference in references:
+            retval.update(self.resolve(reference, names))
+        retval.discard(name)
+        return retval
+
+    def get_dependency_graph(self, names):
+        '''
+        Returns a dict of each of the names to the set of names that it
+        depends on.
+        '''
+        names = set(names)
+        return {name: self.get_dependencies(name, names) for name in names}
+
+    @staticmethod
+    def get_waves(graph):
+        '''
+        Sorts the names of the graph, a dict of name to the set of names that
+        must come before it, topologically into waves, a list of lists of
+        names, so that every name only comes after names in earlier waves.
+        Raises a ConfigError if the graph has a cycle.
+        '''
+        waves = []
+        done = set()
+        while len(done) < len(graph):
+            wave = sorted(name for name, before in graph.items() if name not in done and before <= done)
+            if len(wave) == 0:
+                cycle = sorted(name for name in graph if name not in done)
+                raise ConfigError(f'The dependencies of vms={cycle} have a cycle')
+            waves.append(wave)
+            done.update(wave)
+        return waves
+
+    def get_startup_waves(self, names):
+        '''
+        The waves in which to start the vms, so that every vm is started after
+        the vms that it depends on.
+        '''
+        return DependencyConfig.get_waves(self.get_dependency_graph(names))
+
+    def get_shutdown_waves(self, names):
+        '''
+        The waves in which to shut down the vms, so that every vm is shut down
+        after the vms that depend on it.  Unlike the reverse of the startup
+        waves, vms that nothing depends on are all in the first wave.
+        '''
+        graph = self.get_dependency_graph(names)
+        dependents = {name: set() for name in graph}
+        for name, dependencies in graph.items():
+            for dependency in dependencies:
+                dependents[dependency].add(name)
+        return DependencyConfig.get_waves(dependents)
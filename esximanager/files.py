@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+
+def get_safe_name(host):
+    '''
+    The host name with any character that is not safe in a file name
+    replaced.
+    '''
+    return ''.join(c if c.isalnum() or c in '.-_' else '_' for c in host)
+
+
+def get_host_path(directory, prefix, host, extension='.json'):
+    '''
+    The path of the file, in directory, of one esxi host, such as
+    history-esxi1.example.com.json.
+    '''
+    return os.path.join(directory, f'{prefix}-{get_safe_name(host)}{extension}')
+
+
+def write_atomically(path, content):
+    '''
+    Writes content to a temporary file next to path and renames it over
+    path, so that a concurrent or interrupted write never leaves a partial
+    file behind.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.esximanager-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,72 @@
+from esximanager.pool import run_concurrently
+
+
+class Fleet(object):
+    '''
+    Runs a function against a number of esxi hosts concurrently, each in its
+    own worker thread with its own connection state, and reports the result
+    for each host.
+    '''
+
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, hosts, logger, max_workers=None, deadline=None):
+        '''
+        Providing a deadline, in seconds, bounds how long we will wait for all
+        of the hosts before reporting those that are not yet done as timed
+        out.  Their workers are daemon threads that are abandoned, see
+        esximanager.pool.run_concurrently, so that the process exits at the
+        deadline instead of waiting on them.  A value of None or less than or
+        equal to 0 means no deadline.
+        '''
+        self.hosts = hosts
+        self.logger = logger
+        if max_workers is not None and max_workers > 0:
+            self.max_workers = max_workers
+        else:
+            self.max_workers = Fleet.DEFAULT_MAX_WORKERS
+        self.deadline = deadline if deadline is not None and deadline > 0 else None
+
+    @staticmethod
+    def read_host_file(path):
+        '''
+        Reads one host per line, ignoring blank lines and comments starting
+        with a #.
+        '''
+        retval = []
+        with open(path) as f:
+            for line in f:
+                host = line.split('#', 1)[0].strip()
+                if host:
+                    retval.append(host)
+        return retval
+
+    @staticmethod
+    def get_hosts(hosts=None, host_file=None):
+        '''
+        Combines the hosts given directly with those in the host file, dropping
+        any duplicates but otherwise preserving their order.
+        '''
+        retval = list(hosts) if hosts is not None else []
+        if host_file is not None:
+            retval.extend(Fleet.read_host_file(host_file))
+        return list(dict.fromkeys(retval))
+
+    def run(self, funct):
+        '''
+        Calls funct(host) for each host and returns a dict of host to
+        esximanager.pool.Outcome.
+        '''
+        self.logger.info(
+            f'Running against hosts={self.hosts}, max_workers={self.max_workers}, deadline={self.deadline}')
+        return run_concurrently(funct, self.hosts, self.max_workers, timeout=self.deadline)
+
+    def log_summary(self, outcomes):
+        self.logger.info('Per host result summary:')
+        for host, outcome in outcomes.items():
+            if outcome.succeeded:
+                self.logger.info(
+                    f'esxihost={host}, result={outcome.result}, elapsed_seconds={outcome.elapsed:.2f}')
+            else:
+                self.logger.error(
+                    f'esxihost={host}, error={outcome.error!r}, elapsed_seconds={outcome.elapsed:.2f}')
@@ -0,0 +1,135 @@
+import json
+import math
+from esximanager.files import get_host_path, write_atomically
+
+
+class ShutdownHistory(object):
+    '''
+    An on-disk record, one json file per esxi host, of how long each vm, by
+    name, took to power off after its graceful shutdown was issued, and how
+    long the host itself took to go down, over the last max_samples
+    shutdowns.
+
+    The per-vm timeout is derived from it as the percentile of the samples
+    times margin, so that guests that reliably need longer are given it and
+    those that stop quickly are not waited on for the global timeout.  A vm
+    that had to be forcefully powered off only tells us that it needed longer
+    than we gave it, so its next timeout is at least margin times that.
+    '''
+
+    DEFAULT_MAX_SAMPLES = 20
+    DEFAULT_MIN_SAMPLES = 3
+    DEFAULT_PERCENTILE = 0.95
+    DEFAULT_MARGIN = 1.5
+    DEFAULT_MIN_TIMEOUT_SECONDS = 10
+    DEFAULT_MAX_TIMEOUT_SECONDS = 600
+
+    def __init__(
+            self,
+            logger,
+            history_dir,
+            max_samples=None,
+            min_samples=None,
+            percentile=None,
+            margin=None,
+            min_timeout=None,
+            max_timeout=None):
+        self.logger = logger
+        self.history_dir = history_dir
+        self.max_samples = max_samples if max_samples is not None else ShutdownHistory.DEFAULT_MAX_SAMPLES
+        self.min_samples = min_samples if min_samples is not None else ShutdownHistory.DEFAULT_MIN_SAMPLES
+        self.percentile = percentile if percentile is not None else ShutdownHistory.DEFAULT_PERCENTILE
+        self.margin = margin if margin is not None else ShutdownHistory.DEFAULT_MARGIN
+        self.min_timeout = min_timeout if min_timeout is not None else ShutdownHistory.DEFAULT_MIN_TIMEOUT_SECONDS
+        self.max_timeout = max_timeout if max_timeout is not None else ShutdownHistory.DEFAULT_MAX_TIMEOUT_SECONDS
+
+    def get_path(self, host):
+        return get_host_path(self.history_dir, 'history', host)
+
+    def load(self, host):
+        '''
+        Returns the history of the host, a dict with the vms, a dict of vm
+        name to dict(samples, forced_seconds), and the samples for the host,
+        empty if there is none or it cannot be read.
+        '''
+        path = self.get_path(host)
+        try:
+            with open(path) as f:
+                history = json.load(f)
+            history['vms'] = {
+                name: dict(samples=list(entry['samples']), forced_seconds=entry.get('forced_seconds'))
+                for name, entry in history['vms'].items()}
+            history['host_samples'] = list(history['host_samples'])
+            return history
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.warning(f'Ignoring unreadable shutdown history path={path}, error={e!r}')
+        return dict(vms={}, host_samples=[])
+
+    def save(self, host, history):
+        write_atomically(self.get_path(host), json.dumps(history))
+
+    def record(self, host, vm_seconds, forced_vm_seconds, host_seconds=None):
+        '''
+        Adds the results of a shutdown of the host to its history.
+
+        vm_seconds is a dict of vm name to the seconds it took to power off
+        after its graceful shutdown was issued, and forced_vm_seconds of vm
+        name to the seconds we waited before forcefully powering it off.
+        '''
+        history = self.load(host)
+        vms = history['vms']
+        for name, seconds in vm_seconds.items():
+            entry = vms.setdefault(name, dict(samples=[], forced_seconds=None))
+            entry['samples'] = (entry['samples'] + [round(seconds, 3)])[-self.max_samples:]
+            entry['forced_seconds'] = None
+        for name, seconds in forced_vm_seconds.items():
+            entry = vms.setdefault(name, dict(samples=[], forced_seconds=None))
+            entry['forced_seconds'] = round(max(seconds, entry['forced_seconds'] or 0), 3)
+        if host_seconds is not None:
+            history['host_samples'] = (history['host_samples'] + [round(host_seconds, 3)])[-self.max_samples:]
+        self.save(host, history)
+        self.logger.info(
+            f'Recorded shutdown history for host={host}, num_vms={len(vm_seconds)}, '
+            f'num_forced_vms={len(forced_vm_seconds)}')
+
+    @staticmethod
+    def get_percentile(samples, percentile):
+        '''
+        Returns the nearest rank percentile of the samples, or None if there
+        are none.
+        '''
+        if len(samples) == 0:
+            return None
+        ordered = sorted(samples)
+        rank = max(1, int(math.ceil(percentile * len(ordered))))
+        return ordered[rank - 1]
+
+    def get_timeout(self, entry, default):
+        '''
+        Returns the timeout, in seconds, for a vm with the given history
+        entry, or default if we have not seen it shut down enough times to
+        know better.
+        '''
+        if entry is None:
+            return default
+        if len(entry['samples']) >= self.min_samples:
+            timeout = ShutdownHistory.get_percentile(entry['samples'], self.percentile) * self.margin
+        else:
+            timeout = default
+        if entry['forced_seconds'] is not None:
+            forced_timeout = entry['forced_seconds'] * self.margin
+            timeout = max(timeout, forced_timeout) if timeout is not None else forced_timeout
+        if timeout is None:
+            return None
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def get_vm_timeouts(self, history, vm_names, default):
+        '''
+        Returns a dict of vm_id to its timeout for the dict of vm_id to vm
+        name, None for vms that should never be forcefully powered off.
+        '''
+        return {
+            vm_id: self.get_timeout(history['vms'].get(name), default)
+            for vm_id, name in vm_names.items()}
@@ -0,0 +1,284 @@
+import time
+import shlex
+from collections import namedtuple
+from esximanager.transport import TransportError
+
+
+class ProgressEvent(namedtuple('ProgressEvent', ['timestamp', 'event', 'args'])):
+    '''
+    One progress line reported by the host executor script: the host's epoch
+    time, the event name and the rest of the fields of the line.
+    '''
+    __slots__ = ()
+
+
+class HostExecutor(object):
+    '''
+    Runs the whole graceful shutdown, wait, forced poweroff and wait of a set
+    of vms on the esxi host itself, so that polling the power states of the
+    vms costs a local vim-cmd instead of a network round trip per poll.
+
+    The script is passed inline to sh -c on the host, and started detached
+    with nohup, writing its progress lines to a log file in log_dir.  The
+    client follows the log with tail -f over a single streamed command.  If
+    the connection drops, the script carries on and the client reconnects and
+    picks up the log after the last line that it has seen.
+
+    Each progress line is of the form
+
+        EXM <epoch seconds> <event> [<fields>...]
+
+    with the events:
+
+        start <num vms>
+        shutdown <vm_id> ok|failed
+        off <vm_id>
+        escalate <vm_id>...
+        poweroff <vm_id> ok|failed
+        done OK|TIMEDOUT [<vm_id>...]
+    '''
+
+    LINE_PREFIX = 'EXM'
+    SCRIPT_NAME = 'esximanager-hostexec'
+
+    EVENT_START = 'start'
+    EVENT_SHUTDOWN = 'shutdown'
+    EVENT_OFF = 'off'
+    EVENT_ESCALATE = 'escalate'
+    EVENT_POWEROFF = 'poweroff'
+    EVENT_DONE = 'done'
+
+    DEFAULT_POLL_SECONDS = 1
+    DEFAULT_CONCURRENCY = 8
+    DEFAULT_LOG_DIR = '/tmp'
+    DEFAULT_FOLLOW_ATTEMPTS = 5
+    DEFAULT_FOLLOW_RETRY_SECONDS = 1
+    # The longest that a single follow command runs for when there is no timeout
+    DEFAULT_FOLLOW_SECONDS = 3600
+
+    '''
+    Runs under the busybox ash shell of esxi.  Takes the graceful and forced
+    timeouts, -1 for none, the poll interval, the number of vim-cmd commands
+    to run at once and the ids of the vms to shut down.  A vm id can be given
+    as <vm_id>:<timeout> for a vm with its own graceful timeout, which is
+    otherwise the graceful timeout.  Each vm is forcefully powered off as
+    soon as its own timeout passes, and once all of the vms still running
+    have been, they are waited on for up to the forced timeout.
+    '''
+    SCRIPT = '''
+gt=$1; ft=$2; poll=$3; conc=$4; shift 4
+now() { date +%s; }
+emit() { echo "EXM $(now) $*"; }
+is_on() { vim-cmd vmsvc/power.getstate $1 2>&1 | grep -q 'Powered on'; }
+each() {
+  n=0
+  for id in $3; do
+    ( if vim-cmd vmsvc/$1 $id >/dev/null 2>&1; then emit $2 $id ok; else emit $2 $id failed; fi ) &
+    n=$((n + 1))
+    if [ $n -ge $conc ]; then wait; n=0; fi
+  done
+  wait
+}
+wait_graceful() {
+  forced=""
+  while [ -n "$running" ]; do
+    still=""; expired=""; waiting=""
+    for id in $running; do
+      if ! is_on $id; then emit off $id; continue; fi
+      still="$still $id"
+      case " $forced " in *" $id "*) continue ;; esac
+      eval "dl=\\$dl_$id"
+      if [ $dl -ge 0 ] && [ $(now) -ge $dl ]; then expired="$expired $id"; else waiting="$waiting $id"; fi
+    done
+    running="$still"
+    if [ -n "$expired" ]; then
+      emit escalate $expired
+      each power.off poweroff "$expired"
+      forced="$forced $expired"
+    fi
+    if [ -z "$waiting" ]; then break; fi
+    sleep $poll
+  done
+}
+wait_off() {
+  deadline=$(( $(now) + $1 ))
+  while [ -n "$running" ]; do
+    still=""
+    for id in $running; do
+      if is_on $id; then still="$still $id"; else emit off $id; fi
+    done
+    running="$still"
+    if [ -z "$running" ]; then break; fi
+    if [ $1 -ge 0 ] && [ $(now) -ge $deadline ]; then break; fi
+    sleep $poll
+  done
+}
+start=$(now)
+running=""
+for vm in "$@"; do
+  id=${vm%%:*}; t=${vm#*:}
+  if [ "$t" = "$vm" ]; then t=$gt; fi
+  if [ $t -ge 0 ]; then t=$((start + t)); fi
+  eval "dl_$id=$t"
+  running="$running $id"
+done
+emit start $#
+each power.shutdown shutdown "$running"
+wait_graceful
+if [ -n "$running" ]; then
+  wait_off $ft
+fi
+if [ -z "$running" ]; then emit done OK; else emit done TIMEDOUT $running; fi
+'''
+
+    def __init__(
+            self,
+            transport,
+            logger,
+            poll=None,
+            concurrency=None,
+            log_dir=None,
+            run_id=None,
+            follow_attempts=None,
+            sleep=None,
+            clock=None):
+        self.transport = transport
+        self.logger = logger
+        self.poll = poll if poll is not None and poll > 0 else HostExecutor.DEFAULT_POLL_SECONDS
+        self.concurrency = concurrency if concurrency is not None and concurrency > 0 else HostExecutor.DEFAULT_CONCURRENCY
+        self.log_dir = log_dir if log_dir is not None else HostExecutor.DEFAULT_LOG_DIR
+        self.run_id = run_id if run_id is not None else f'{int(time.time())}-{id(self):x}'
+        if follow_attempts is not None and follow_attempts > 0:
+            self.follow_attempts = follow_attempts
+        else:
+            self.follow_attempts = HostExecutor.DEFAULT_FOLLOW_ATTEMPTS
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.clock = clock if clock is not None else time.time
+        # The number of times that the script has been launched, once per wave
+        self.launches = 0
+
+    def get_log_path(self):
+        '''
+        Each launch of the script, one per shutdown wave, gets its own log,
+        as a launch is skipped if its log already exists.
+        '''
+        if self.launches <= 1:
+            return f'{self.log_dir}/{HostExecutor.SCRIPT_NAME}-{self.run_id}.log'
+        return f'{self.log_dir}/{HostExecutor.SCRIPT_NAME}-{self.run_id}-{self.launches}.log'
+
+    def get_launch_command(self, vm_ids, graceful_timeout, forced_timeout, vm_timeouts=None):
+        '''
+        The launch only starts the script if its log does not exist yet, so it
+        is safe to retry if the connection drops while it is being run.
+        '''
+        log_path = self.get_log_path()
+        vm_timeouts = vm_timeouts if vm_timeouts is not None else {}
+        vm_args = [f'{vm_id}:{vm_timeouts[vm_id]}' if vm_id in vm_timeouts else vm_id for vm_id in vm_ids]
+        args = ' '.join(str(a) for a in [graceful_timeout, forced_timeout, self.poll, self.concurrency] + vm_args)
+        return (
+            f'if [ ! -e {log_path} ]; then : > {log_path}; '
+            f'nohup sh -c {shlex.quote(HostExecutor.SCRIPT)} {HostExecutor.SCRIPT_NAME} {args} '
+            f'>> {log_path} 2>&1 < /dev/null & fi')
+
+    def get_follow_command(self, lines_seen, max_seconds):
+        '''
+        Streams the log from the line after lines_seen until it is killed
+        after max_seconds, so that it never outlives the client by long.
+        '''
+        return (
+            f'tail -n +{lines_seen + 1} -f {self.get_log_path()} & pid=$!; '
+            f'sleep {int(max_seconds) + 1}; kill $pid')
+
+    @staticmethod
+    def get_timeout_arg(seconds):
+        if seconds is None or seconds < 0:
+            return -1
+        return int(seconds + 0.999)
+
+    @staticmethod
+    def parse_line(line):
+        '''
+        Returns the ProgressEvent for a progress line or None for any other
+        line.
+        '''
+        tokens = line.split()
+        if len(tokens) < 3 or tokens[0] != HostExecutor.LINE_PREFIX or not tokens[1].isdigit():
+            return None
+        return ProgressEvent(int(tokens[1]), tokens[2], tokens[3:])
+
+    def launch(self, vm_ids, graceful_timeout, forced_timeout, vm_timeouts=None):
+        '''
+        Starts the script on the host, returning True if it was started.
+
+        vm_timeouts is an optional dict of vm_id to the graceful timeout of
+        that vm, None for none, in place of graceful_timeout.
+        '''
+        self.launches += 1
+        vm_timeouts = vm_timeouts if vm_timeouts is not None else {}
+        command = self.get_launch_command(
+            vm_ids,
+            HostExecutor.get_timeout_arg(graceful_timeout),
+            HostExecutor.get_timeout_arg(forced_timeout),
+            {vm_id: HostExecutor.get_timeout_arg(timeout) for vm_id, timeout in vm_timeouts.items()})
+        try:
+            result = self.transport.run(command)
+        except TransportError as e:
+            self.logger.error(f'Unable to launch host executor on host={self.transport.host}, error={e!r}')
+            return False
+        if not result.succeeded:
+            self.logger.error(
+                f'Unable to launch host executor on host={self.transport.host}, '
+                f'return_code={result.return_code}, output={result.stdout.strip()}')
+            return False
+        self.logger.info(f'Launched host executor on host={self.transport.host}, log={self.get_log_path()}')
+        return True
+
+    def follow(self, on_event, timeout=None):
+        '''
+        Follows the progress lines of the script, calling on_event with each
+        ProgressEvent, until the script reports that it is done and returns
+        the done event.
+
+        Returns None if we could not follow it to the end within timeout
+        seconds, or after follow_attempts failed attempts.
+        '''
+        deadline = self.clock() + timeout if timeout is not None else None
+        state = dict(lines_seen=0, done=None)
+
+        def on_line(line):
+            state['lines_seen'] += 1
+            event = HostExecutor.parse_line(line)
+            if event is None:
+                self.logger.warning(f'Unexpected host executor output line={line}')
+                return True
+            on_event(event)
+            if event.event == HostExecutor.EVENT_DONE:
+                state['done'] = event
+                return False
+            return True
+
+        failures = 0
+        while state['done'] is None:
+            remaining = deadline - self.clock() if deadline is not None else HostExecutor.DEFAULT_FOLLOW_SECONDS
+            if remaining <= 0 or failures >= self.follow_attempts:
+                self.logger.error(
+                    f'Gave up following host executor on host={self.transport.host}, '
+                    f'lines_seen={state["lines_seen"]}, failures={failures}')
+                return None
+            try:
+                return_code = self.transport.stream(self.get_follow_command(state['lines_seen'], remaining), on_line)
+                # A zero exit status means that the follow ran for its whole
+                # max_seconds, which is not a failure when there is no timeout
+                if state['done'] is None and return_code != 0:
+                    failures += 1
+                    self.logger.warning(
+                        f'Following host executor on host={self.transport.host} ended early, '
+                        f'return_code={return_code}')
+            except TransportError as e:
+                failures += 1
+                self.logger.warning(
+                    f'Lost connection following host executor on host={self.transport.host}, '
+                    f'failures={failures}, error={e!r}')
+            if state['done'] is None and failures > 0:
+                self.sleep(HostExecutor.DEFAULT_FOLLOW_RETRY_SECONDS)
+        return state['done']
@@ -0,0 +1,180 @@
+import os
+import re
+import json
+import time
+import logging
+from collections import namedtuple
+from esximanager.files import get_host_path, write_atomically
+
+
+class InventoryError(Exception):
+    '''
+    Raised when the inventory of the host cannot be scanned, such as while
+    hostd is still starting up and vim-cmd is unable to log in to it.
+    '''
+    pass
+
+class VmRecord(namedtuple('VmRecord', ['name', 'datastore', 'file', 'guest_os', 'version', 'annotation'])):
+    '''
+    One vm from the output of vim-cmd vmsvc/getallvms.
+    '''
+    __slots__ = ()
+
+
+class GetAllVmsParser(object):
+    '''
+    Parses the output of vim-cmd vmsvc/getallvms one line at a time.
+
+    vim-cmd pads the columns to line up under the header, but names, datastore
+    names and file paths can all contain spaces and the Annotation column can
+    be empty or run over several lines, so splitting on whitespace is not
+    enough.  Each line is matched on the shape of the columns that can be
+    recognised, the bracketed datastore, the .vmx file and the vmx-NN version,
+    falling back to the column offsets from the header.  Lines that do not
+    start a new vm are continuations of the annotation of the previous one.
+    '''
+
+    HEADER_PREFIX = 'Vmid'
+    SKIPPED_VM_PREFIX = 'Skipping invalid VM'
+    HEADER_COLUMN_RE = re.compile(r'\S+(?: \S+)*')
+    VM_LINE_RE = re.compile(
+        r'^(?P<vm_id>\d+)\s+(?P<name>.*?)\s+(?P<datastore>\[[^\]]*\])\s+(?P<file>.*?\.vmx)'
+        r'\s+(?P<guest_os>\S+)\s+(?P<version>vmx-\d+)(?:\s+(?P<annotation>.*))?$')
+
+    def __init__(self, logger):
+        self.logger = logger
+        # Whether the header was seen, which vim-cmd prints even for no vms
+        self.found_header = False
+        # (start, end) of each of the columns in the header, if one was seen
+        self.columns = None
+
+    def parse_header(self, line):
+        offsets = [match.start() for match in GetAllVmsParser.HEADER_COLUMN_RE.finditer(line)]
+        if len(offsets) < 6:
+            return None
+        return list(zip(offsets, offsets[1:] + [None]))
+
+    def parse_line(self, line):
+        '''
+        Returns a (vm_id, VmRecord) for a line that starts a new vm, or None.
+        '''
+        match = GetAllVmsParser.VM_LINE_RE.match(line)
+        if match is not None:
+            return int(match.group('vm_id')), VmRecord(
+                match.group('name'),
+                match.group('datastore'),
+                match.group('file'),
+                match.group('guest_os'),
+                match.group('version'),
+                match.group('annotation') or '')
+
+        if self.columns is None:
+            return None
+        fields = [line[start:end].strip() for start, end in self.columns]
+        vm_id, name, file_field = fields[0], fields[1], fields[2]
+        if not vm_id.isdigit() or not file_field.startswith('[') or '] ' not in file_field:
+            return None
+        datastore, file = file_field.split('] ', 1)
+        annotation = ' '.join(fields[5:]) if len(fields) > 5 else ''
+        return int(vm_id), VmRecord(name, datastore + ']', file, fields[3], fields[4], annotation)
+
+    def parse(self, lines):
+        '''
+        Yields a (vm_id, VmRecord) for each vm in lines, an iterable of the
+        lines of output.  Each raw line is only logged at debug level.
+        '''
+        log_lines = self.logger.isEnabledFor(logging.DEBUG)
+        pending = None
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if log_lines:
+                self.logger.debug('Parsing raw vm output line=%s', line)
+            if len(line.strip()) == 0:
+                continue
+            if self.columns is None and line.startswith(GetAllVmsParser.HEADER_PREFIX):
+                self.found_header = True
+                self.columns = self.parse_header(line)
+                continue
+            if line.startswith(GetAllVmsParser.SKIPPED_VM_PREFIX):
+                self.logger.warning(f'esxi host reported line={line}')
+                continue
+
+            parsed = self.parse_line(line)
+            if parsed is not None:
+                if pending is not None:
+                    yield pending
+                pending = parsed
+            elif pending is not None:
+                vm_id, record = pending
+                annotation = f'{record.annotation}\n{line}' if record.annotation else line.strip()
+                pending = (vm_id, record._replace(annotation=annotation))
+            else:
+                self.logger.warning(f'Unable to parse getallvms line={line}')
+
+        if pending is not None:
+            yield pending
+
+
+class InventoryCache(object):
+    '''
+    An on-disk cache, one json file per esxi host, of the parsed vm inventory
+    returned by Shutdown.get_all_vms, so that the shutdown does not have to
+    scan the inventory at the time that the power fails.
+
+    Entries older than the ttl are ignored.  The cache is meant to be kept
+    fresh ahead of time by running the refresh-inventory subcommand from cron.
+    '''
+
+    DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'esximanager')
+    DEFAULT_TTL_SECONDS = 24 * 60 * 60
+    # Bumped whenever the layout of the cached vms changes
+    FORMAT_VERSION = 2
+
+    def __init__(self, logger, cache_dir=None, ttl=None):
+        self.logger = logger
+        self.cache_dir = cache_dir if cache_dir is not None else InventoryCache.DEFAULT_CACHE_DIR
+        self.ttl = ttl if ttl is not None and ttl > 0 else InventoryCache.DEFAULT_TTL_SECONDS
+
+    def get_path(self, host):
+        return get_host_path(self.cache_dir, 'inventory', host)
+
+    def load(self, host):
+        '''
+        Returns the cached dict of vm_id to VmRecord for the host, or None if
+        there is no entry, it has expired or it cannot be read.
+        '''
+        path = self.get_path(host)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if entry.get('version') != InventoryCache.FORMAT_VERSION:
+                raise ValueError(f'Unsupported cache version={entry.get("version")}')
+            age = time.time() - entry['timestamp']
+            vms = {int(vm_id): VmRecord(*vm_data) for vm_id, vm_data in entry['vms'].items()}
+        except FileNotFoundError:
+            self.logger.info(f'No cached inventory for host={host}')
+            return None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.warning(f'Ignoring unreadable cached inventory path={path}, error={e!r}')
+            return None
+
+        if age > self.ttl or age < 0:
+            self.logger.info(f'Cached inventory for host={host} has expired, age={age:.0f}, ttl={self.ttl}')
+            return None
+
+        self.logger.info(f'Using cached inventory for host={host}, age={age:.0f}, num_vms={len(vms)}')
+        return vms
+
+    def save(self, host, vms):
+        '''
+        Writes the entry for the host atomically, so that a concurrent or
+        interrupted write never leaves a partial file behind.
+        '''
+        entry = dict(version=InventoryCache.FORMAT_VERSION, host=host, timestamp=time.time(), vms=vms)
+        write_atomically(self.get_path(host), json.dumps(entry))
+
+    def invalidate(self, host):
+        try:
+            os.unlink(self.get_path(host))
+        except FileNotFoundError:
+            pass
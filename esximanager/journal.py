@@ -0,0 +1,159 @@
+import os
+import json
+import time
+from esximanager.files import get_host_path
+
+
+class ShutdownJournal(object):
+    '''
+    An append-only journal, one file of json lines per esxi host, of the
+    progress of a shutdown: the phases started, the vms that were running, the
+    vms that commands were issued to and the vms that were seen powered off.
+
+    Every record is flushed and fdatasync'd as it is written, so that if the
+    process is killed partway through a shutdown the next run can pick up
+    where it left off, see ShutdownJournal.get_resume_state.  The per-vm
+    records are written once per batch of vms rather than once per vm, to
+    keep the number of syncs down.
+
+    The journal of a host is started afresh, truncating the previous one, by
+    each run that does not resume.
+    '''
+
+    DEFAULT_MAX_AGE_SECONDS = 60 * 60
+
+    EVENT_START = 'start'
+    EVENT_PHASE = 'phase'
+    EVENT_RUNNING_VMS = 'running_vms'
+    EVENT_SHUTDOWN_ISSUED = 'shutdown_issued'
+    EVENT_POWEROFF_ISSUED = 'poweroff_issued'
+    EVENT_VMS_OFF = 'vms_off'
+    EVENT_HOST_POWEROFF_ISSUED = 'host_poweroff_issued'
+    EVENT_DONE = 'done'
+
+    def __init__(self, logger, journal_dir, max_age=None):
+        '''
+        Journals whose run started more than max_age seconds ago are not
+        resumed.
+        '''
+        self.logger = logger
+        self.journal_dir = journal_dir
+        self.max_age = max_age if max_age is not None and max_age > 0 else ShutdownJournal.DEFAULT_MAX_AGE_SECONDS
+        # host -> open file of the journal
+        self.files = {}
+
+    def get_path(self, host):
+        return get_host_path(self.journal_dir, 'journal', host, extension='.jsonl')
+
+    def read(self, host):
+        '''
+        Returns the list of records in the journal of the host.  A torn last
+        line, from being killed in the middle of writing it, is ignored.
+        '''
+        records = []
+        try:
+            with open(self.get_path(host)) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        self.logger.warning(f'Ignoring unreadable journal line={line.strip()} for host={host}')
+        except FileNotFoundError:
+            pass
+        return records
+
+    def get_resume_state(self, host):
+        '''
+        Returns a dict describing the unfinished shutdown of the host to
+        resume, or None if the last one finished, is too old or there is none.
+
+        The dict has the last phase started, the dict of vm_id to name of the
+        vms that were running at the start, the set of vm_ids that were seen
+        powered off and the sets of vm_ids that shutdown and poweroff commands
+        were issued to, and whether the host poweroff was issued.
+        '''
+        records = self.read(host)
+        if len(records) == 0 or records[0].get('event') != ShutdownJournal.EVENT_START:
+            return None
+        if records[-1].get('event') == ShutdownJournal.EVENT_DONE:
+            return None
+        age = time.time() - records[0]['time']
+        if age > self.max_age or age < 0:
+            self.logger.info(f'Not resuming the journal for host={host}, age={age:.0f}')
+            return None
+
+        state = dict(
+            phase=None,
+            running_vms={},
+            vms_off=set(),
+            shutdown_issued=set(),
+            poweroff_issued=set(),
+            host_poweroff_issued=False)
+        for record in records[1:]:
+            event = record.get('event')
+            if event == ShutdownJournal.EVENT_PHASE:
+                state['phase'] = record['phase']
+            elif event == ShutdownJournal.EVENT_RUNNING_VMS:
+                state['running_vms'] = {int(vm_id): name for vm_id, name in record['vms'].items()}
+            elif event == ShutdownJournal.EVENT_SHUTDOWN_ISSUED:
+                state['shutdown_issued'].update(record['vm_ids'])
+            elif event == ShutdownJournal.EVENT_POWEROFF_ISSUED:
+                state['poweroff_issued'].update(record['vm_ids'])
+            elif event == ShutdownJournal.EVENT_VMS_OFF:
+                state['vms_off'].update(record['vm_ids'])
+            elif event == ShutdownJournal.EVENT_HOST_POWEROFF_ISSUED:
+                state['host_poweroff_issued'] = True
+        return state
+
+    def get_last_running_vms(self, host):
+        '''
+        Returns the dict of vm_id to name of the vms that were running at the
+        start of the last shutdown of the host, finished or not, or None if
+        there is no journal of one.
+        '''
+        running_vms = None
+        for record in self.read(host):
+            if record.get('event') == ShutdownJournal.EVENT_RUNNING_VMS:
+                running_vms = {int(vm_id): name for vm_id, name in record['vms'].items()}
+        return running_vms
+
+    def start(self, host):
+        '''
+        Starts a new journal for the host, discarding the previous one.
+        '''
+        self.close(host)
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.files[host] = open(self.get_path(host), 'w')
+        self.write(host, ShutdownJournal.EVENT_START)
+
+    def resume(self, host):
+        '''
+        Continues appending to the existing journal of the host.
+        '''
+        self.close(host)
+        self.files[host] = open(self.get_path(host), 'a')
+
+    def write(self, host, event, **fields):
+        f = self.files.get(host)
+        if f is None:
+            return
+        record = dict(time=round(time.time(), 3), event=event)
+        record.update(fields)
+        try:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            ShutdownJournal.sync(f.fileno())
+        except OSError as e:
+            self.logger.error(f'Unable to write journal for host={host}, error={e!r}')
+
+    @staticmethod
+    def sync(fd):
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+
+    def close(self, host):
+        f = self.files.pop(host, None)
+        if f is not None:
+            f.close()
@@ -0,0 +1,107 @@
+import sys
+import json
+import queue
+import logging
+import logging.handlers
+
+DEFAULT_FORMAT = '%(asctime)s,%(levelname)s,%(module)s,%(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats each record as a single line json object, for log shippers.
+    '''
+
+    def format(self, record):
+        entry = dict(
+            time=round(record.created, 3),
+            level=record.levelname,
+            module=record.module,
+            thread=record.threadName,
+            message=record.getMessage())
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Puts each record on the queue as it is, so that its message is only
+    formatted, from its msg and args, by the writer thread, and drops the
+    record rather than blocking if the queue is full because the writer has
+    fallen behind.
+
+    As the args are formatted later, they should not be changed after they
+    are logged.
+    '''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    '''
+    Waits for room on a full queue to tell the writer to stop, rather than
+    failing, so that stopping always writes out the records on the queue.
+    '''
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogging(object):
+    '''
+    Routes all logging through a queue to a background writer thread, so that
+    a slow stdout, such as a pipe to syslog from apcupsd, can never delay
+    the thread that is shutting down the hosts.  Logging a record costs no
+    more than putting it on the queue.
+    '''
+
+    DEFAULT_MAX_QUEUE = 10000
+
+    def __init__(self, level='INFO', json_format=False, stream=None, max_queue=None):
+        self.level = level.upper() if isinstance(level, str) else level
+        self.stream = stream if stream is not None else sys.stdout
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(DEFAULT_FORMAT))
+        self.handler = handler
+        max_queue = max_queue if max_queue is not None and max_queue > 0 else AsyncLogging.DEFAULT_MAX_QUEUE
+        self.queue_handler = DeferredQueueHandler(queue.Queue(max_queue))
+        self.listener = DrainingQueueListener(self.queue_handler.queue, handler)
+
+    def start(self):
+        '''
+        Replaces the handlers of the root logger with the queue.
+        '''
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        '''
+        Writes out the records still on the queue and stops the writer.
+        '''
+        logging.getLogger().removeHandler(self.queue_handler)
+        self.listener.stop()
+        if self.queue_handler.dropped > 0:
+            self.handler.handle(logging.makeLogRecord(dict(
+                name=__name__,
+                levelno=logging.WARNING,
+                levelname='WARNING',
+                module='logsetup',
+                msg=f'Dropped [{self.queue_handler.dropped}] log records as the writer fell behind')))
+        self.handler.flush()
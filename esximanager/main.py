@@ -1,13 +1,28 @@
+import time
+
+# Used to report how long after process start the first shutdown command is issued
+PROCESS_START_TIME = time.time()
+
 import sys
+import json
+import copy
 import logging
 import argparse
+from esximanager.agent import Agent
+from esximanager.agentclient import DEFAULT_SOCKET_PATH
+from esximanager.budget import Budget, BudgetError
+from esximanager.config import ConfigError, DependencyConfig
+from esximanager.fleet import Fleet
+from esximanager.history import ShutdownHistory
+from esximanager.inventory import InventoryCache
+from esximanager.journal import ShutdownJournal
+from esximanager.logsetup import AsyncLogging
+from esximanager.metrics import write_json_report, write_prometheus_textfile
+from esximanager.probe import HostProbe
 from esximanager.shutdown import Shutdown
-
-# For the time-being, we are just logging to the console
-logging.basicConfig(
-    format='%(asctime)s,%(levelname)s,%(module)s,%(message)s',
-    level=logging.INFO,
-    stream=sys.stdout)
+from esximanager.startup import Startup
+from esximanager.status import StatusCache
+from esximanager.transport import DEFAULT_TRANSPORT, TRANSPORTS, create_transport
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +35,51 @@ def parse_args():
     shared.add_argument(
         '--esxihost',
         type=str,
-        required=True,
-        help='esxi host to shutdown')
+        nargs='+',
+        default=[],
+        help='one or more esxi hosts to operate on')
+
+    shared.add_argument(
+        '--esxihost-file',
+        type=str,
+        help='file containing esxi hosts to operate on, one per line')
+
+    shared.add_argument(
+        '--max-workers',
+        type=int,
+        default=Fleet.DEFAULT_MAX_WORKERS,
+        help='maximum number of esxi hosts to operate on concurrently')
+
+    shared.add_argument(
+        '--deadline-seconds',
+        type=float,
+        default=0,
+        help='overall time limit, in seconds, for all of the hosts; 0 for none')
+
+    shared.add_argument(
+        '--transport',
+        type=str,
+        choices=list(TRANSPORTS),
+        default=DEFAULT_TRANSPORT,
+        help='how to run commands on the esxi hosts: paramiko, the system openssh '
+             'client multiplexed over one connection, or an in-memory fake for testing')
+
+    shared.add_argument(
+        '--cache-dir',
+        type=str,
+        default=InventoryCache.DEFAULT_CACHE_DIR,
+        help='directory in which to cache the vm inventory of each esxi host')
+
+    shared.add_argument(
+        '--inventory-ttl',
+        type=float,
+        default=InventoryCache.DEFAULT_TTL_SECONDS,
+        help='age, in seconds, after which a cached vm inventory is no longer used')
+
+    shared.add_argument(
+        '--dependency-config',
+        type=str,
+        help='json file of the dependencies between the vms and how to check that each is ready')
 
     shared.add_argument(
         '--loglevel',
@@ -29,33 +87,484 @@ def parse_args():
         default='INFO',
         help='logging output level configuration')
 
+    shared.add_argument(
+        '--log-json',
+        action='store_true',
+        help='log one json object per line instead of comma separated text')
+
     shared.add_argument(
         '--dryrun',
         action='store_true',
         help='Run in dryrun mode')
 
+    # Default set of args for all child parsers that shutdown hosts ###########
+    shutdown_shared = argparse.ArgumentParser(add_help=False)
+    parser = shutdown_shared
+    parser.add_argument(
+        '--vm-concurrency',
+        type=int,
+        default=Shutdown.DEFAULT_VM_COMMAND_CONCURRENCY,
+        help='maximum number of vm shutdown or poweroff commands to issue in parallel per host')
+    parser.add_argument(
+        '--budget-seconds',
+        type=float,
+        help='total time, in seconds, within which the hosts must be powered off')
+    parser.add_argument(
+        '--budget-from-apcupsd',
+        action='store_true',
+        help='use the time left reported by apcupsd as the budget')
+    parser.add_argument(
+        '--budget-margin',
+        type=float,
+        default=Budget.DEFAULT_APCUPSD_MARGIN,
+        help='fraction of the apcupsd time left to hold back as a safety margin')
+    parser.add_argument(
+        '--probe-ports',
+        type=int,
+        nargs='+',
+        default=list(HostProbe.DEFAULT_PORTS),
+        help='tcp ports to probe to determine if the esxi host is still up')
+    parser.add_argument(
+        '--probe-misses',
+        type=int,
+        default=HostProbe.DEFAULT_MISSES,
+        help='number of consecutive unanswered probes after which the esxi host is considered down')
+    parser.add_argument(
+        '--no-icmp',
+        action='store_true',
+        help='do not send ICMP echo requests when probing the esxi host')
+    parser.add_argument(
+        '--no-inventory-cache',
+        action='store_true',
+        help='always scan the vm inventory instead of using the cached one')
+    parser.add_argument(
+        '--host-executor',
+        action='store_true',
+        help='shut down, poll and power off the vms with a script run on the esxi host itself')
+    parser.add_argument(
+        '--autostart',
+        action='store_true',
+        help='leave the shutdown of the vms to the autostart manager of the esxi host, set up by sync-autostart')
+    parser.add_argument(
+        '--no-history',
+        action='store_true',
+        help='do not record how long each vm takes to shut down nor use it to time out each vm')
+    parser.add_argument(
+        '--no-journal',
+        action='store_true',
+        help='do not journal the progress of the shutdown nor resume an interrupted one')
+
     # Shutdown ################################################################
     parser = child_parsers.add_parser(
         'shutdown',
-        parents=[shared],
+        parents=[shared, shutdown_shared],
         help='Shuts down the esxi by first powering off vms and then the host itself')
+    parser.add_argument(
+        '--report-json',
+        type=str,
+        help='path to which to write a json report of the timings of the shutdown of each host')
+    parser.add_argument(
+        '--prometheus-textfile',
+        type=str,
+        help='path to which to write the timings in the prometheus textfile collector format')
     parser.set_defaults(funct=shutdown)
 
-    return parent_parser.parse_args()
+    # Agent ###################################################################
+    parser = child_parsers.add_parser(
+        'agent',
+        parents=[shared, shutdown_shared],
+        help='Runs a resident agent that keeps connections and state warm and '
+             'shuts down the esxi hosts when triggered with esximanager-trigger')
+    parser.add_argument(
+        '--socket',
+        type=str,
+        default=DEFAULT_SOCKET_PATH,
+        help='path to the unix domain socket on which to listen')
+    parser.add_argument(
+        '--refresh-seconds',
+        type=float,
+        default=Agent.DEFAULT_REFRESH_SECONDS,
+        help='interval, in seconds, at which to refresh the power states of the vms')
+    parser.set_defaults(funct=agent)
+
+    # Plan ####################################################################
+    parser = child_parsers.add_parser(
+        'plan',
+        parents=[shared, shutdown_shared],
+        help='Predicts how long a shutdown of the esxi hosts would take from the history of previous '
+             'shutdowns, without shutting anything down')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print the plan as json instead of a table')
+    parser.set_defaults(funct=plan)
+
+    # Status ##################################################################
+    parser = child_parsers.add_parser(
+        'status',
+        parents=[shared],
+        help='Prints a snapshot of the vms on the esxi hosts and whether each is running, '
+             'without changing anything')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print the snapshot as json instead of a table')
+    parser.add_argument(
+        '--status-ttl',
+        type=float,
+        default=0,
+        help='reuse a snapshot of a host taken within this many seconds instead of querying it; 0 to always query')
+    parser.set_defaults(funct=status)
+
+    # Startup #################################################################
+    parser = child_parsers.add_parser(
+        'startup',
+        parents=[shared],
+        help='Powers the vms of the esxi hosts back on, in parallel and in dependency order, '
+             'once the hosts are up again')
+    parser.add_argument(
+        '--vm',
+        type=str,
+        nargs='+',
+        help='names of the vms to start; by default those running before the last shutdown, '
+             'or else those in the dependency config')
+    parser.add_argument(
+        '--startup-concurrency',
+        type=int,
+        default=Startup.DEFAULT_CONCURRENCY,
+        help='maximum number of vms booting at once per host')
+    parser.add_argument(
+        '--ready-timeout',
+        type=float,
+        default=Startup.DEFAULT_READY_TIMEOUT,
+        help='time, in seconds, after it is powered on within which a vm must be ready')
+    parser.add_argument(
+        '--host-timeout',
+        type=float,
+        default=Startup.DEFAULT_HOST_TIMEOUT,
+        help='time, in seconds, to wait for each esxi host to come up')
+    parser.set_defaults(funct=startup)
+
+    # Sync Autostart ##########################################################
+    parser = child_parsers.add_parser(
+        'sync-autostart',
+        parents=[shared, shutdown_shared],
+        help='Sets up the autostart manager of the esxi hosts to shut down their vms in dependency order, '
+             'for use by shutdown --autostart')
+    parser.set_defaults(funct=sync_autostart)
+
+    # Refresh Inventory #######################################################
+    parser = child_parsers.add_parser(
+        'refresh-inventory',
+        parents=[shared],
+        help='Scans the vm inventory of the esxi hosts and caches it for use by shutdown')
+    parser.set_defaults(funct=refresh_inventory)
+
+    args = parent_parser.parse_args()
+    args.esxihosts = Fleet.get_hosts(args.esxihost, args.esxihost_file)
+    if len(args.esxihosts) == 0:
+        parent_parser.error('at least one of --esxihost or --esxihost-file is required')
+    return args
+
+def get_host_args(args, esxihost):
+    '''
+    Returns a copy of the args for operating on a single esxi host.
+    '''
+    host_args = copy.copy(args)
+    host_args.esxihost = esxihost
+    return host_args
+
+def get_budget(args, logger):
+    '''
+    The budget is only an optimisation, so if it cannot be had we log the
+    error and shut down with the fixed timeouts instead.
+    '''
+    budget = None
+    try:
+        if args.budget_seconds is not None:
+            budget = Budget(args.budget_seconds)
+        elif args.budget_from_apcupsd:
+            budget = Budget.from_apcupsd(args.budget_margin)
+    except (BudgetError, OSError) as e:
+        logger.error(f'Unable to get the shutdown budget, using the fixed timeouts instead, error={e!r}')
+        return None
+    if budget is not None:
+        logger.info(f'Shutting down within budget={budget}')
+    return budget
+
+def get_inventory_cache(args, logger):
+    return InventoryCache(logger, cache_dir=args.cache_dir, ttl=args.inventory_ttl)
+
+def get_history(args, logger):
+    if args.no_history:
+        return None
+    return ShutdownHistory(logger, args.cache_dir)
+
+def get_journal(args, logger):
+    if args.no_journal:
+        return None
+    return ShutdownJournal(logger, args.cache_dir)
+
+def get_dependency_config(args, logger):
+    '''
+    Returns the DependencyConfig from --dependency-config, an empty one if
+    none was given, or None if it cannot be read.
+    '''
+    if args.dependency_config is None:
+        return DependencyConfig()
+    try:
+        return DependencyConfig.load(args.dependency_config)
+    except ConfigError as e:
+        logger.error(str(e))
+        return None
+
+def run_fleet(args, logger, funct, deadline=None):
+    '''
+    Runs funct(esxihost) against all of the esxi hosts and logs and returns
+    the outcome for each.
+    '''
+    deadline = deadline if deadline is not None else args.deadline_seconds
+    fleet = Fleet(args.esxihosts, logger, args.max_workers, deadline)
+    outcomes = fleet.run(funct)
+    fleet.log_summary(outcomes)
+    return outcomes
+
+def get_shutdown(args, logger, esxihost, budget=None, dependency_config=None):
+    '''
+    Builds the Shutdown for the esxi host from the args in the shutdown_shared
+    parser.  An unreadable dependency config must not stop a shutdown, so it
+    is loaded once up front and all of the vms are shut down at once without
+    it.
+    '''
+    inventory_cache = None if args.no_inventory_cache else get_inventory_cache(args, logger)
+    return Shutdown(
+        get_host_args(args, esxihost),
+        logger,
+        transport=create_transport(args.transport, esxihost, logger),
+        vm_command_concurrency=args.vm_concurrency,
+        budget=budget,
+        probe=HostProbe(
+            esxihost,
+            logger,
+            ports=args.probe_ports,
+            misses=args.probe_misses,
+            use_icmp=not args.no_icmp),
+        inventory_cache=inventory_cache,
+        host_executor=args.host_executor,
+        history=get_history(args, logger),
+        journal=get_journal(args, logger),
+        dependency_config=dependency_config,
+        autostart=args.autostart)
+
+def write_reports(args, logger, runs):
+    '''
+    Writes the metrics of the given runs to the report files, if any were
+    requested.  Failing to write a report never changes the exit code.
+    '''
+    for path, funct in [(args.report_json, write_json_report), (args.prometheus_textfile, write_prometheus_textfile)]:
+        if path is None:
+            continue
+        try:
+            funct(path, runs)
+            logger.info(f'Wrote shutdown metrics to path={path}')
+        except OSError as e:
+            logger.error(f'Unable to write shutdown metrics to path={path}, error={e!r}')
 
 def shutdown(args, logger):
-    shutdown = Shutdown(args, logger)
-    shutdown.shutdown()
+    budget = get_budget(args, logger)
+    dependency_config = get_dependency_config(args, logger)
+    shutdowns = {}
+
+    def shutdown_host(esxihost):
+        shutdown = get_shutdown(args, logger, esxihost, budget, dependency_config)
+        shutdowns[esxihost] = shutdown
+        result = shutdown.shutdown()
+        if shutdown.first_command_time is not None:
+            logger.info(
+                f'esxihost={esxihost}, process_start_to_first_command_seconds='
+                f'{shutdown.first_command_time - PROCESS_START_TIME:.3f}')
+        return result
+
+    deadline = args.deadline_seconds
+    if budget is not None and deadline <= 0:
+        deadline = budget.remaining()
+
+    outcomes = run_fleet(args, logger, shutdown_host, deadline)
+    write_reports(args, logger, [shutdowns[host].metrics for host in args.esxihosts if host in shutdowns])
+    all_ok = all(o.succeeded and o.result == Shutdown.RESULT_OK for o in outcomes.values())
+    return 0 if all_ok else 1
+
+def agent(args, logger):
+    dependency_config = get_dependency_config(args, logger)
+    shutdowns = {
+        esxihost: get_shutdown(args, logger, esxihost, dependency_config=dependency_config)
+        for esxihost in args.esxihosts}
+    agent = Agent(
+        shutdowns,
+        logger,
+        socket_path=args.socket,
+        refresh_interval=args.refresh_seconds,
+        max_workers=args.max_workers,
+        budget_factory=lambda: get_budget(args, logger))
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping agent')
+    return 0
+
+def format_seconds(seconds):
+    return f'{seconds:.1f}' if seconds is not None else '-'
+
+def print_plan(plan):
+    print(f'esxihost={plan["host"]}')
+    print(f'  {"vm_id":>6}  {"name":<32} {"samples":>7} {"median":>8} {"timeout":>8} {"predicted":>9}')
+    for vm in sorted(plan['vms'], key=lambda vm: -(vm['predicted_seconds'] or float('inf'))):
+        print(
+            f'  {vm["vm_id"]:>6}  {str(vm["name"]):<32} {vm["samples"]:>7} '
+            f'{format_seconds(vm["median_seconds"]):>8} {format_seconds(vm["timeout_seconds"]):>8} '
+            f'{format_seconds(vm["predicted_seconds"]):>9}')
+    print(
+        f'  inventory={format_seconds(plan["inventory_seconds"])}s '
+        f'vms={format_seconds(plan["vms_seconds"])}s '
+        f'host={format_seconds(plan["host_seconds"])}s '
+        f'total={format_seconds(plan["total_seconds"])}s')
+
+def plan(args, logger):
+    dependency_config = get_dependency_config(args, logger)
+
+    def plan_host(esxihost):
+        shutdown = get_shutdown(args, logger, esxihost, dependency_config=dependency_config)
+        with shutdown.transport:
+            return shutdown.plan()
+
+    outcomes = run_fleet(args, logger, plan_host)
+    plans = [outcomes[host].result for host in args.esxihosts if outcomes[host].succeeded]
+    if args.json:
+        print(json.dumps(plans, indent=2))
+    else:
+        for host_plan in plans:
+            print_plan(host_plan)
+    return 0 if len(plans) == len(args.esxihosts) else 1
+
+def print_status(snapshot):
+    if 'error' in snapshot:
+        print(f'esxihost={snapshot["host"]} error={snapshot["error"]}')
+        return
+    print(f'esxihost={snapshot["host"]} running={snapshot["num_running"]}/{snapshot["num_vms"]}')
+    print(f'  {"vm_id":>6}  {"name":<32} {"state":<4} guest_os')
+    for vm in snapshot['vms']:
+        state = 'on' if vm['powered_on'] else 'off'
+        print(f'  {vm["vm_id"]:>6}  {vm["name"]:<32} {state:<4} {vm["guest_os"]}')
+
+def status(args, logger):
+    inventory_cache = get_inventory_cache(args, logger)
+    status_cache = StatusCache(logger, args.cache_dir, ttl=args.status_ttl) if args.status_ttl > 0 else None
+
+    def status_host(esxihost):
+        snapshot = status_cache.load(esxihost) if status_cache is not None else None
+        if snapshot is not None:
+            return snapshot
+        shutdown = Shutdown(
+            get_host_args(args, esxihost),
+            logger,
+            transport=create_transport(args.transport, esxihost, logger),
+            inventory_cache=inventory_cache)
+        with shutdown.transport:
+            snapshot = shutdown.status()
+        if status_cache is not None:
+            try:
+                status_cache.save(esxihost, snapshot)
+            except OSError as e:
+                logger.error(f'Unable to cache status for esxihost={esxihost}, error={e!r}')
+        return snapshot
+
+    outcomes = run_fleet(args, logger, status_host)
+    snapshots = [
+        outcomes[host].result if outcomes[host].succeeded else dict(host=host, error=repr(outcomes[host].error))
+        for host in args.esxihosts]
+    if args.json:
+        print(json.dumps(snapshots, indent=2))
+    else:
+        for snapshot in snapshots:
+            print_status(snapshot)
+    return 0 if all(o.succeeded for o in outcomes.values()) else 1
+
+def startup(args, logger):
+    config = get_dependency_config(args, logger)
+    if config is None:
+        return 1
+    inventory_cache = get_inventory_cache(args, logger)
+    journal = ShutdownJournal(logger, args.cache_dir)
+
+    def startup_host(esxihost):
+        shutdown = Shutdown(
+            get_host_args(args, esxihost),
+            logger,
+            transport=create_transport(args.transport, esxihost, logger),
+            inventory_cache=inventory_cache)
+        startup = Startup(
+            shutdown,
+            logger,
+            config=config,
+            concurrency=args.startup_concurrency,
+            ready_timeout=args.ready_timeout,
+            journal=journal)
+        with shutdown.transport:
+            result, _ = startup.start(names=args.vm, host_timeout=args.host_timeout)
+        return result
+
+    outcomes = run_fleet(args, logger, startup_host)
+    all_ok = all(o.succeeded and o.result == Shutdown.RESULT_OK for o in outcomes.values())
+    return 0 if all_ok else 1
+
+def sync_autostart(args, logger):
+    dependency_config = get_dependency_config(args, logger)
+    if dependency_config is None:
+        return 1
+
+    def sync_host(esxihost):
+        shutdown = get_shutdown(args, logger, esxihost, dependency_config=dependency_config)
+        with shutdown.transport:
+            vms, _ = shutdown.get_inventory_and_running_vms()
+            entries = shutdown.sync_autostart(vms)
+        if entries is None:
+            raise RuntimeError(f'Unable to sync the autostart manager of esxihost={esxihost}')
+        return f'num_vms={len(entries)}'
+
+    args.autostart = True
+    outcomes = run_fleet(args, logger, sync_host)
+    return 0 if all(o.succeeded for o in outcomes.values()) else 1
+
+def refresh_inventory(args, logger):
+    inventory_cache = get_inventory_cache(args, logger)
+
+    def refresh_host(esxihost):
+        shutdown = Shutdown(
+            get_host_args(args, esxihost),
+            logger,
+            transport=create_transport(args.transport, esxihost, logger),
+            inventory_cache=inventory_cache)
+        with shutdown.transport:
+            vms = shutdown.refresh_inventory()
+        return f'num_vms={len(vms)}'
+
+    outcomes = run_fleet(args, logger, refresh_host)
+    return 0 if all(o.succeeded for o in outcomes.values()) else 1
 
 def main():
     args = parse_args()
-    # Reconfigure logger
+    # Logged to the console from a background thread, so that a slow console
+    # never holds up a shutdown
+    async_logging = AsyncLogging(logging.INFO, json_format=args.log_json).start()
     logger.setLevel(args.loglevel.upper())
-    args.funct(args, logger)
+    try:
+        return args.funct(args, logger)
+    finally:
+        async_logging.stop()
 
 ###############################################################################
 # MAIN
 ###############################################################################
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,214 @@
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+from esximanager.files import write_atomically
+
+
+class RunMetrics(object):
+    '''
+    Timings collected during the shutdown of one esxi host: the duration of
+    each phase, the count and duration of each kind of remote command, the
+    time spent sleeping between polls, the time each vm took to power off
+    after its shutdown was issued and the time each wave of vms took to shut
+    down.
+
+    Remote commands can run concurrently, so the time blocked on them can
+    add up to more than the wall time of a phase.
+    '''
+
+    PHASE_INVENTORY = 'inventory'
+    PHASE_GRACEFUL_SHUTDOWN = 'graceful_shutdown'
+    PHASE_GRACEFUL_WAIT = 'graceful_wait'
+    PHASE_FORCED_POWEROFF = 'forced_poweroff'
+    PHASE_FORCED_WAIT = 'forced_wait'
+    PHASE_HOST_EXECUTOR = 'host_executor'
+    PHASE_AUTOSTART_SYNC = 'autostart_sync'
+    PHASE_HOST_POWEROFF = 'host_poweroff'
+    PHASE_HOST_WAIT = 'host_wait'
+
+    COMMAND_KIND_RES = [
+        (re.compile(r'^for id in .*power\.getstate'), 'power.getstate.batched'),
+        (re.compile(r'^if \[ ! -e \S+esximanager-hostexec'), 'hostexec.launch'),
+        (re.compile(r'^tail -n \+\d+ -f \S+esximanager-hostexec'), 'hostexec.follow'),
+        (re.compile(r'^vim-cmd vmsvc/([\w.]+)'), None),
+        (re.compile(r'^vim-cmd hostsvc/([\w./]+)'), None),
+        (re.compile(r'^(\S+)'), None),
+        ]
+
+    def __init__(self, host, clock=None):
+        self.host = host
+        self.clock = clock if clock is not None else time.time
+        self.lock = threading.Lock()
+
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.phases = []
+        # command kind -> dict(count, failures, seconds)
+        self.commands = {}
+        self.sleep_seconds = 0
+        # vm_id -> time the shutdown or poweroff was issued
+        self.vm_issue_times = {}
+        # vm_id -> dict(name, seconds)
+        self.vm_poweroff_seconds = {}
+        # dict(wave, vms, start, seconds) for each wave of vms shut down in turn
+        self.waves = []
+
+    def start(self):
+        self.start_time = self.clock()
+
+    def finish(self, result):
+        self.end_time = self.clock()
+        self.result = result
+
+    @contextmanager
+    def phase(self, name):
+        start_time = self.clock()
+        try:
+            yield
+        finally:
+            end_time = self.clock()
+            with self.lock:
+                self.phases.append(dict(
+                    name=name,
+                    start=start_time,
+                    seconds=end_time - start_time))
+
+    @staticmethod
+    def get_command_kind(command):
+        for regex, kind in RunMetrics.COMMAND_KIND_RES:
+            match = regex.match(command)
+            if match is not None:
+                return kind if kind is not None else match.group(1)
+        return 'unknown'
+
+    def record_command(self, command, seconds, succeeded):
+        kind = RunMetrics.get_command_kind(command)
+        with self.lock:
+            stats = self.commands.setdefault(kind, dict(count=0, failures=0, seconds=0))
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            if not succeeded:
+                stats['failures'] += 1
+
+    def record_sleep(self, seconds):
+        with self.lock:
+            self.sleep_seconds += seconds
+
+    def record_vms_issued(self, vm_ids):
+        now = self.clock()
+        with self.lock:
+            for vm_id in vm_ids:
+                self.vm_issue_times.setdefault(vm_id, now)
+
+    def record_vm_off(self, vm_id, name=None):
+        now = self.clock()
+        with self.lock:
+            issue_time = self.vm_issue_times.get(vm_id)
+            if issue_time is not None and vm_id not in self.vm_poweroff_seconds:
+                self.vm_poweroff_seconds[vm_id] = dict(name=name, seconds=now - issue_time)
+
+    def record_wave(self, wave, vm_names, start_time):
+        end_time = self.clock()
+        with self.lock:
+            self.waves.append(dict(
+                wave=wave,
+                vms=list(vm_names),
+                start=start_time,
+                seconds=end_time - start_time))
+
+    def get_phase_seconds(self):
+        '''
+        Returns a dict of phase name to the total time spent in it.
+        '''
+        retval = {}
+        for phase in self.phases:
+            retval[phase['name']] = retval.get(phase['name'], 0) + phase['seconds']
+        return retval
+
+    def to_dict(self):
+        with self.lock:
+            return dict(
+                host=self.host,
+                result=self.result,
+                start_time=self.start_time,
+                end_time=self.end_time,
+                duration_seconds=(
+                    self.end_time - self.start_time
+                    if self.start_time is not None and self.end_time is not None else None),
+                phases=list(self.phases),
+                phase_seconds=self.get_phase_seconds(),
+                commands={kind: dict(stats) for kind, stats in self.commands.items()},
+                remote_commands=sum(stats['count'] for stats in self.commands.values()),
+                command_seconds=sum(stats['seconds'] for stats in self.commands.values()),
+                sleep_seconds=self.sleep_seconds,
+                vm_poweroff_seconds={str(vm_id): dict(v) for vm_id, v in self.vm_poweroff_seconds.items()},
+                waves=[dict(wave) for wave in self.waves])
+
+
+def write_json_report(path, runs):
+    '''
+    Writes the RunMetrics of all of the hosts as a single json document.
+    '''
+    report = dict(generated_at=time.time(), hosts=[run.to_dict() for run in runs])
+    write_atomically(path, json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(runs):
+    '''
+    Formats the RunMetrics of all of the hosts in the prometheus text
+    exposition format, as read by the node_exporter textfile collector.
+    '''
+    metrics = [
+        ('esximanager_shutdown_duration_seconds', 'gauge', 'Wall time of the last shutdown of the host.'),
+        ('esximanager_shutdown_last_run_timestamp_seconds', 'gauge', 'Time at which the last shutdown of the host finished.'),
+        ('esximanager_shutdown_success', 'gauge', '1 if the last shutdown confirmed that the host powered off.'),
+        ('esximanager_shutdown_phase_seconds', 'gauge', 'Time spent in each phase of the last shutdown.'),
+        ('esximanager_shutdown_remote_commands', 'gauge', 'Number of remote commands of each kind run in the last shutdown.'),
+        ('esximanager_shutdown_remote_command_seconds', 'gauge', 'Time blocked on remote commands of each kind in the last shutdown.'),
+        ('esximanager_shutdown_sleep_seconds', 'gauge', 'Time spent sleeping between polls in the last shutdown.'),
+        ('esximanager_shutdown_vm_poweroff_seconds', 'gauge', 'Time from issuing the shutdown of each vm to seeing it powered off.'),
+        ('esximanager_shutdown_wave_seconds', 'gauge', 'Time taken to shut down each wave of vms in the last shutdown.'),
+        ]
+    samples = {name: [] for name, _, _ in metrics}
+
+    for run in runs:
+        data = run.to_dict()
+        host = f'host="{escape_label(run.host)}"'
+        if data['duration_seconds'] is not None:
+            samples['esximanager_shutdown_duration_seconds'].append((host, data['duration_seconds']))
+        if data['end_time'] is not None:
+            samples['esximanager_shutdown_last_run_timestamp_seconds'].append((host, data['end_time']))
+        samples['esximanager_shutdown_success'].append((host, 1 if data['result'] == 'OK' else 0))
+        for phase, seconds in data['phase_seconds'].items():
+            samples['esximanager_shutdown_phase_seconds'].append((f'{host},phase="{escape_label(phase)}"', seconds))
+        for kind, stats in data['commands'].items():
+            labels = f'{host},command="{escape_label(kind)}"'
+            samples['esximanager_shutdown_remote_commands'].append((labels, stats['count']))
+            samples['esximanager_shutdown_remote_command_seconds'].append((labels, stats['seconds']))
+        samples['esximanager_shutdown_sleep_seconds'].append((host, data['sleep_seconds']))
+        for vm_id, vm in data['vm_poweroff_seconds'].items():
+            labels = f'{host},vm_id="{vm_id}",vm="{escape_label(vm["name"])}"'
+            samples['esximanager_shutdown_vm_poweroff_seconds'].append((labels, vm['seconds']))
+        for wave in data['waves']:
+            samples['esximanager_shutdown_wave_seconds'].append((f'{host},wave="{wave["wave"]}"', wave['seconds']))
+
+    lines = []
+    for name, metric_type, help_text in metrics:
+        if len(samples[name]) == 0:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples[name]:
+            lines.append(f'{name}{{{labels}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(path, runs):
+    write_atomically(path, format_prometheus(runs))
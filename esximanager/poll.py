@@ -0,0 +1,95 @@
+import time
+
+
+class PollScheduler(object):
+    '''
+    Tracks, for each item being polled, the time at which it is next due to be
+    checked.
+
+    Every item starts out being polled every min_interval seconds and each time
+    that a check finds that it is not yet done its interval is multiplied by
+    backoff, up to max_interval.  That way we poll densely right after a
+    command is issued, when fast items are likely to finish, and back off on
+    the items that are taking longer.
+    '''
+
+    DEFAULT_BACKOFF = 1.5
+
+    def __init__(
+            self,
+            items,
+            min_interval,
+            max_interval,
+            backoff=DEFAULT_BACKOFF,
+            start_time=None,
+            coalesce=None):
+        '''
+        Items whose next check is due within coalesce seconds of the earliest
+        one are polled together to save round trips; it defaults to half of
+        min_interval.
+        '''
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.coalesce = coalesce if coalesce is not None else self.min_interval / 2
+
+        start_time = start_time if start_time is not None else time.time()
+        # item -> [next due time, current interval]
+        self.schedule = {}
+        for item in items:
+            self.add(item, start_time)
+
+    def __len__(self):
+        return len(self.schedule)
+
+    def __contains__(self, item):
+        return item in self.schedule
+
+    def items(self):
+        return list(self.schedule)
+
+    def add(self, item, due_time, interval=None):
+        self.schedule[item] = [due_time, interval if interval is not None else self.min_interval]
+
+    def remove(self, item):
+        self.schedule.pop(item, None)
+
+    def next_due_time(self):
+        '''
+        Returns the earliest time at which any item is due, or None if there
+        are no items left.
+        '''
+        if len(self.schedule) == 0:
+            return None
+        return min(due_time for due_time, _ in self.schedule.values())
+
+    def due(self, now=None):
+        '''
+        Returns the items that are due to be checked at now, including those
+        due within the coalesce window after it.
+        '''
+        now = now if now is not None else time.time()
+        return [
+            item for item, (due_time, _) in self.schedule.items()
+            if due_time <= now + self.coalesce
+            ]
+
+    def reschedule(self, item, now=None):
+        '''
+        Schedules the next check of an item that is not yet done, backing off
+        its interval.
+        '''
+        now = now if now is not None else time.time()
+        entry = self.schedule[item]
+        entry[1] = min(entry[1] * self.backoff, self.max_interval)
+        entry[0] = now + entry[1]
+
+    def sleep_time(self, now=None):
+        '''
+        Returns how long to sleep until the next item is due.
+        '''
+        now = now if now is not None else time.time()
+        next_due_time = self.next_due_time()
+        if next_due_time is None:
+            return 0
+        return max(0, next_due_time - now)
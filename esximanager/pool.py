@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import deque, namedtuple
+
+
+class Outcome(namedtuple('Outcome', ['result', 'error', 'elapsed'])):
+    '''
+    The result of calling a function for one item in run_concurrently, the
+    exception that it raised, if any, and the time in seconds that it took.
+    '''
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+class PoolTimeoutError(Exception):
+    '''
+    Set as the error of the Outcome for every item that had not completed
+    before the timeout passed to run_concurrently.
+    '''
+    pass
+
+
+def run_concurrently(funct, items, max_workers, timeout=None):
+    '''
+    Calls funct(item) for each of the items on a pool of at most max_workers
+    threads and returns a dict of item to Outcome, in the order of items.
+
+    If a timeout, in seconds, is given we only wait that long for all of the
+    calls to complete.  Calls that have not yet completed are reported with a
+    PoolTimeoutError and those not yet started are never made.  The workers
+    are daemon threads, so that a call that is still running, such as the
+    shutdown of a host that hangs, is abandoned rather than holding up the
+    exit of the process once the timeout has passed.
+    '''
+    items = list(items)
+    if len(items) == 0:
+        return {}
+
+    def timed_funct(item):
+        start_time = time.time()
+        try:
+            return Outcome(funct(item), None, time.time() - start_time)
+        except Exception as e:
+            return Outcome(None, e, time.time() - start_time)
+
+    pending = deque(items)
+    outcomes = {}
+    condition = threading.Condition()
+    # Set once we stop waiting, so that the workers start no more calls
+    expired = threading.Event()
+
+    def worker():
+        while True:
+            with condition:
+                if len(pending) == 0 or expired.is_set():
+                    return
+                item = pending.popleft()
+            outcome = timed_funct(item)
+            with condition:
+                outcomes[item] = outcome
+                condition.notify_all()
+
+    start_time = time.time()
+    for i in range(max(1, min(max_workers, len(items)))):
+        threading.Thread(target=worker, name=f'pool-worker-{i}', daemon=True).start()
+
+    deadline = start_time + timeout if timeout is not None else None
+    retval = {}
+    with condition:
+        while len(outcomes) < len(items):
+            wait_seconds = deadline - time.time() if deadline is not None else None
+            if wait_seconds is not None and wait_seconds <= 0:
+                break
+            condition.wait(wait_seconds)
+        expired.set()
+        for item in items:
+            if item in outcomes:
+                retval[item] = outcomes[item]
+            else:
+                retval[item] = Outcome(
+                    None,
+                    PoolTimeoutError(f'Did not complete within timeout={timeout}'),
+                    time.time() - start_time)
+    return retval
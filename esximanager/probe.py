@@ -0,0 +1,157 @@
+import os
+import socket
+import struct
+import select
+import time
+from esximanager.pool import run_concurrently
+
+
+class HostProbe(object):
+    '''
+    Checks whether a host is up from within this process, without forking a
+    ping subprocess per check.
+
+    Each probe sends a TCP connect to each of the ports and, where the kernel
+    permits us to open an ICMP socket, an ICMP echo request, all concurrently.
+    The host is alive if any of them get an answer; a refused connection is an
+    answer too.  The host is only declared down after misses consecutive
+    probes without an answer, so a single dropped packet does not count.
+    '''
+
+    DEFAULT_PORTS = (22, 443)
+    DEFAULT_TIMEOUT_SECONDS = 0.3
+    DEFAULT_MISSES = 2
+
+    ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+
+    def __init__(
+            self,
+            host,
+            logger,
+            ports=DEFAULT_PORTS,
+            timeout=DEFAULT_TIMEOUT_SECONDS,
+            misses=DEFAULT_MISSES,
+            use_icmp=True):
+        self.host = host
+        self.logger = logger
+        self.ports = tuple(ports)
+        self.timeout = timeout
+        self.misses = misses if misses > 0 else HostProbe.DEFAULT_MISSES
+        self.use_icmp = use_icmp
+
+        self.address = None
+        self.consecutive_misses = 0
+        self.icmp_seq = 0
+
+    def resolve(self):
+        '''
+        Resolves the host once so that we do not do a name lookup per probe.
+        '''
+        if self.address is None:
+            self.address = socket.getaddrinfo(self.host, None, proto=socket.IPPROTO_TCP)[0][4][0]
+        return self.address
+
+    def tcp_check(self, port):
+        try:
+            sock = socket.create_connection((self.resolve(), port), timeout=self.timeout)
+            sock.close()
+            return True
+        except ConnectionRefusedError:
+            # Something on the host answered, so it is still up
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def checksum(data):
+        if len(data) % 2:
+            data += b'\x00'
+        total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+        total = (total >> 16) + (total & 0xffff)
+        total += total >> 16
+        return ~total & 0xffff
+
+    def open_icmp_socket(self):
+        '''
+        Returns an ICMP socket, trying an unprivileged datagram socket first
+        and then a raw socket, or None if we are not permitted either.
+        '''
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                return socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+            except OSError:
+                continue
+        return None
+
+    def icmp_check(self):
+        '''
+        Returns True if the host answers an ICMP echo request within the
+        timeout, False if it does not and None if we cannot send one.
+        '''
+        address = self.resolve()
+        if ':' in address:
+            return None
+
+        sock = self.open_icmp_socket()
+        if sock is None:
+            self.logger.info('Not permitted to open an ICMP socket, probing with TCP only')
+            self.use_icmp = False
+            return None
+
+        try:
+            self.icmp_seq = (self.icmp_seq + 1) & 0xffff
+            ident = os.getpid() & 0xffff
+            header = struct.pack('!BBHHH', HostProbe.ICMP_ECHO_REQUEST, 0, 0, ident, self.icmp_seq)
+            payload = b'esximanager'
+            packet = struct.pack(
+                '!BBHHH',
+                HostProbe.ICMP_ECHO_REQUEST,
+                0,
+                HostProbe.checksum(header + payload),
+                ident,
+                self.icmp_seq) + payload
+            sock.sendto(packet, (address, 0))
+
+            deadline = time.time() + self.timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                readable, _, _ = select.select([sock], [], [], remaining)
+                if not readable:
+                    return False
+                data, (from_address, _) = sock.recvfrom(1024)
+                if sock.type == socket.SOCK_RAW:
+                    # Raw sockets include the IP header
+                    data = data[(data[0] & 0x0f) * 4:]
+                if from_address == address and len(data) >= 8 and data[0] == HostProbe.ICMP_ECHO_REPLY:
+                    return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def is_alive(self):
+        '''
+        Sends all of the checks concurrently and returns True if any of them
+        got an answer.
+        '''
+        checks = [lambda port=port: self.tcp_check(port) for port in self.ports]
+        if self.use_icmp:
+            checks.append(self.icmp_check)
+        outcomes = run_concurrently(lambda check: check(), checks, len(checks))
+        return any(outcome.result for outcome in outcomes.values())
+
+    def probe(self):
+        '''
+        Probes the host once and returns True unless it has now missed the
+        configured number of consecutive probes.
+        '''
+        if self.is_alive():
+            self.consecutive_misses = 0
+        else:
+            self.consecutive_misses += 1
+        self.logger.debug(
+            'Probed host=%s, consecutive_misses=%d, misses=%d', self.host, self.consecutive_misses, self.misses)
+        return self.consecutive_misses < self.misses
@@ -1,20 +1,60 @@
+import io
+import math
 import time
-from fabric.api import run, env, local, settings
+from esximanager.autostart import AutostartManager
+from esximanager.budget import Budget
+from esximanager.config import ConfigError
+from esximanager.history import ShutdownHistory
+from esximanager.hostexec import HostExecutor
+from esximanager.inventory import GetAllVmsParser, InventoryCache, InventoryError
+from esximanager.journal import ShutdownJournal
+from esximanager.metrics import RunMetrics
+from esximanager.poll import PollScheduler
+from esximanager.pool import run_concurrently
+from esximanager.probe import HostProbe
+from esximanager.transport import DEFAULT_TRANSPORT, TransportError, create_transport
 
 class Shutdown(object):
 
+    '''
+    Marker line echoed before the output of each vm in the batched
+    power.getstate command so that the combined output can be split back into
+    per-vm results.
+    '''
+    POWER_GETSTATE_MARKER = '__esximanager_vmid__'
+
+    '''
+    Each vm is first polled DEFAULT_VM_POWEROFF_MIN_POLL_SECONDS after its
+    shutdown is issued, backing off by a factor of
+    DEFAULT_VM_POWEROFF_POLL_BACKOFF per poll up to the poll interval.
+    '''
+    DEFAULT_VM_POWEROFF_MIN_POLL_SECONDS = 0.25
+    DEFAULT_VM_POWEROFF_POLL_BACKOFF = 1.5
     DEFAULT_VM_POWEROFF_POLL_SECONDS = 2
     DEFAULT_VM_POWEROFF_TIMEOUT = 60
     RESULT_OK = 'OK'
     RESULT_WAIT = 'WAIT'
     RESULT_TIMEDOUT = 'TIMEDOUT'
+    RESULT_FAILED = 'FAILED'
 
-    DEFAULT_EXSI_HOST_POWEROFF_POLL_SECONDS = 2
+    '''
+    Maximum number of vm shutdown or poweroff commands that are in flight on
+    the esxi host at once.  Each one is a separate channel on the ssh
+    connection so this should stay below the MaxSessions of the host's sshd.
+    '''
+    DEFAULT_VM_COMMAND_CONCURRENCY = 8
+
+    '''
+    Probing the host is cheap, see esximanager.probe.HostProbe, so we poll it
+    densely to notice that it has gone down as soon as possible.
+    '''
+    DEFAULT_EXSI_HOST_POWEROFF_MIN_POLL_SECONDS = 0.25
+    DEFAULT_EXSI_HOST_POWEROFF_POLL_SECONDS = 0.5
     DEFAULT_EXSI_HOST_POWEROFF_TIMEOUT = 60
 
     '''
     Amount of time, in seconds, that we will wait to exit the Shutdown.shutdown
-    function after we can no longer ping the esxi host . . . giving it a bit
+    function after we can no longer reach the esxi host . . . giving it a bit
     more time to shutdown before returning to the host that is directly
     issuing the shutdown commands.
     '''
@@ -27,88 +67,366 @@ class Shutdown(object):
             vm_poweroff_poll=None,
             vm_poweroff_timeout=None,
             esxi_poweroff_poll=None,
-            esxi_poweroff_timeout=None):
+            esxi_poweroff_timeout=None,
+            vm_command_concurrency=None,
+            transport=None,
+            budget=None,
+            probe=None,
+            inventory_cache=None,
+            host_executor=None,
+            history=None,
+            journal=None,
+            dependency_config=None,
+            autostart=None,
+            clock=None,
+            sleep=None):
         '''
         Providing a value of -1 for poweroff_timeout means we do not timeout
         when attempting to verify that the vms have shutdown.
+
+        If an esximanager.budget.Budget is provided, each phase of the
+        shutdown is also bounded by its deadline in the budget, and we move on
+        to the next phase early if waiting any longer would overrun it.
+
+        All remote commands are run through the transport, see
+        esximanager.transport, which keeps a single connection to the esxi
+        host open for the life of this object.  One of the DEFAULT_TRANSPORT
+        type is created for args.esxihost if not provided, as is the
+        esximanager.probe.HostProbe used to check if the host is up.
+
+        If an esximanager.inventory.InventoryCache is provided, the vm
+        inventory is read from it, when fresh, instead of scanned.
+
+        If host_executor is True, the vms are shut down, polled and forcefully
+        powered off by a script run on the esxi host itself, see
+        esximanager.hostexec.HostExecutor, instead of from here.
+
+        If an esximanager.history.ShutdownHistory is provided, how long each
+        vm takes to shut down is recorded in it, and each vm is forcefully
+        powered off when its own timeout, learned from its history, passes.
+
+        If an esximanager.journal.ShutdownJournal is provided, the progress of
+        the shutdown is journaled to it and a shutdown that was interrupted is
+        resumed from where it left off.
+
+        If an esximanager.config.DependencyConfig is provided, the vms are
+        shut down in waves, see Shutdown.get_shutdown_waves, each wave only
+        once the vms of the previous one are off.
+
+        If autostart is True, the shutdown of the vms is delegated to the
+        autostart manager of the host, see esximanager.autostart, and we only
+        make sure that it is set up before powering off the host.
+
+        clock and sleep are used for all of the timing of the shutdown, so
+        that it can be run against a virtual clock, see
+        esximanager.simulator.VirtualClock.
         '''
         self.esxihost = args.esxihost
         self.dryrun = args.dryrun
         self.logger = logger
+        self.clock = clock if clock is not None else time.time
+        self.sleep_funct = sleep if sleep is not None else time.sleep
 
         # Do not allow values less then 0
         if vm_poweroff_poll is not None and vm_poweroff_poll > 0:
             self.vm_poweroff_poll = vm_poweroff_poll
         else:
             self.vm_poweroff_poll = Shutdown.DEFAULT_VM_POWEROFF_POLL_SECONDS
+        self.vm_poweroff_min_poll = min(Shutdown.DEFAULT_VM_POWEROFF_MIN_POLL_SECONDS, self.vm_poweroff_poll)
+        self.vm_poweroff_poll_backoff = Shutdown.DEFAULT_VM_POWEROFF_POLL_BACKOFF
         self.vm_poweroff_timeout = vm_poweroff_timeout if vm_poweroff_timeout is not None else Shutdown.DEFAULT_VM_POWEROFF_TIMEOUT
 
         if esxi_poweroff_poll is not None and esxi_poweroff_poll > 0:
             self.esxi_poweroff_poll = esxi_poweroff_poll
         else:
             self.esxi_poweroff_poll = Shutdown.DEFAULT_EXSI_HOST_POWEROFF_POLL_SECONDS
+        self.esxi_poweroff_min_poll = min(Shutdown.DEFAULT_EXSI_HOST_POWEROFF_MIN_POLL_SECONDS, self.esxi_poweroff_poll)
         self.esxi_poweroff_timeout = esxi_poweroff_timeout if esxi_poweroff_timeout is not None else Shutdown.DEFAULT_EXSI_HOST_POWEROFF_TIMEOUT
 
-        env.user = 'root'
-        env.host_string = self.esxihost
-        env.shell = '/bin/sh -l -c'
+        if vm_command_concurrency is not None and vm_command_concurrency > 0:
+            self.vm_command_concurrency = vm_command_concurrency
+        else:
+            self.vm_command_concurrency = Shutdown.DEFAULT_VM_COMMAND_CONCURRENCY
+
+        if transport is not None:
+            self.transport = transport
+        else:
+            self.transport = create_transport(DEFAULT_TRANSPORT, self.esxihost, logger)
+        self.budget = budget
+        self.probe = probe if probe is not None else HostProbe(self.esxihost, logger)
+        self.inventory_cache = inventory_cache
+        self.history = history
+        self.journal = journal
+        self.dependency_config = dependency_config
+
+        self.metrics = RunMetrics(self.esxihost, clock=self.clock)
+        self.transport.observer = self.metrics.record_command
+
+        if host_executor is True:
+            self.host_executor = HostExecutor(
+                self.transport,
+                logger,
+                concurrency=self.vm_command_concurrency,
+                sleep=self.sleep,
+                clock=self.clock)
+        else:
+            self.host_executor = None
+
+        if autostart is True:
+            self.autostart = AutostartManager(self.transport, logger, dryrun=self.dryrun)
+        else:
+            self.autostart = None
+
+        # The inventory of the host, once it has been scanned or loaded
+        self.inventory = None
+        # The time at which the inventory was scanned or loaded
+        self.inventory_time = None
+        # The time at which we issued the first shutdown or poweroff command
+        self.first_command_time = None
+        # vm_id -> seconds after its shutdown was issued that it was forcefully powered off
+        self.forced_vms = {}
+        # vm_id -> name of the vms of the interrupted shutdown that we resumed, if any
+        self.resumed_vm_names = None
+        # Seconds that hostd may spend stopping the vms after the host poweroff
+        self.host_stop_seconds = 0
 
     def fab_get_all_vms(self):
-        retval = run('vim-cmd vmsvc/getallvms').stdout.splitlines()
+        '''
+        Returns the lines of the output as a file like object so that they
+        can be parsed one at a time.  Raises InventoryError if the command
+        failed, such as when hostd is not ready.
+        '''
+        result = self.transport.run('vim-cmd vmsvc/getallvms')
+        if not result.succeeded:
+            raise InventoryError(
+                f'Unable to scan the inventory of esxihost={self.esxihost}, '
+                f'return_code={result.return_code}, output={result.stdout.strip()!r}')
+        retval = io.StringIO(result.stdout)
         return retval
 
+    def fab_get_running_vm_names(self):
+        '''
+        Returns the names of all of the vms that have a running vmx process on
+        the host, from esxcli, whether or not they are in our inventory, or
+        None if the command failed.
+        '''
+        result = self.transport.run('esxcli vm process list')
+        if not result.succeeded:
+            return None
+        return Shutdown.parse_vm_process_list(result.stdout.splitlines())
+
     def fab_power_getstate(self, vm_id):
-        retval = run(f'vim-cmd vmsvc/power.getstate {vm_id}').stdout.splitlines()
+        retval = self.transport.run(f'vim-cmd vmsvc/power.getstate {vm_id}').stdout.splitlines()
+        return retval
+
+    def fab_power_getstates(self, vm_ids):
+        '''
+        Gets the power state of all of the given vms with a single remote
+        command.  The output for each vm is preceded by a marker line so that
+        it can be parsed with Shutdown.parse_power_getstates.
+        '''
+        ids = ' '.join(str(vm_id) for vm_id in vm_ids)
+        retval = self.transport.run(
+            f'for id in {ids}; do '
+            f'echo "{Shutdown.POWER_GETSTATE_MARKER} $id"; '
+            'vim-cmd vmsvc/power.getstate $id 2>&1; '
+            'done').stdout.splitlines()
         return retval
 
     def fab_shutdown_vm(self, vm_id):
         '''
         Issues a graceful shutdown of the vm.
         '''
-        return run(f'vim-cmd vmsvc/power.shutdown {vm_id}').succeeded
+        return self.transport.run(f'vim-cmd vmsvc/power.shutdown {vm_id}').succeeded
 
     def fab_poweroff_vm(self, vm_id):
         '''
         Powers off the vm, NOT a graceful shutdown.
         '''
-        return run(f'vim-cmd vmsvc/power.off {vm_id}').succeeded
+        return self.transport.run(f'vim-cmd vmsvc/power.off {vm_id}').succeeded
 
     def fab_poweroff_esxihost(self):
+        self.mark_first_command()
+        # Journaled before it is issued as the host may take us down with it
+        self.journal_write(ShutdownJournal.EVENT_HOST_POWEROFF_ISSUED)
         if self.dryrun:
             self.logger.info('In dryrun mode, just returning with an OK result')
             return True
-        return run(f'poweroff').succeeded
+        try:
+            return self.transport.run('poweroff', retry=False).succeeded
+        except TransportError as e:
+            '''
+            The host can drop the connection as it goes down before we get the
+            exit status of the command.  We will find out if it actually went
+            down when we wait for it to shutdown.
+            '''
+            self.logger.warning(f'Connection lost while powering off esxihost={self.esxihost}, error={e.__cause__}')
+            return True
 
     def get_all_vms(self):
-        retval = {}
-        fab_result = self.fab_get_all_vms()
+        '''
+        Returns a dict of vm_id to esximanager.inventory.VmRecord for all of
+        the vms registered on the host.
 
-        if len(fab_result) == 1:
-            return retval
+        Raises InventoryError if the scan failed, rather than returning an
+        empty inventory that would have us power off the host without
+        shutting down any of its vms.
+        '''
+        parser = GetAllVmsParser(self.logger)
+        retval = dict(parser.parse(self.fab_get_all_vms()))
+        if not parser.found_header:
+            raise InventoryError(f'No getallvms header in the inventory of esxihost={self.esxihost}')
+        self.logger.info(f'Parsed inventory of esxihost={self.esxihost}, num_vms={len(retval)}')
+        return retval
+
+    def get_running_vms(self, vms):
+        vm_states = self.get_vm_power_states(list(vms))
+        return [vm_id for vm_id, running in vm_states.items() if running]
+
+    def get_vm_power_states(self, vm_ids):
+        '''
+        Returns a dict of vm_id to a boolean indicating whether or not that vm
+        is running, querying all of the vms in one remote command.
+        '''
+        vm_states, _ = self.query_vm_power_states(vm_ids)
+        return vm_states
+
+    def query_vm_power_states(self, vm_ids):
+        '''
+        Returns the same dict as get_vm_power_states along with a list of the
+        vm_ids for which the host did not return a power state at all, which
+        usually means that they are no longer registered on the host.
+        '''
+        if len(vm_ids) == 0:
+            return {}, []
+
+        outputs = Shutdown.parse_power_getstates(self.fab_power_getstates(vm_ids))
+        vm_states = {
+            vm_id: Shutdown.is_power_state_running(outputs.get(vm_id, []))
+            for vm_id in vm_ids
+            }
+        invalid_vm_ids = [
+            vm_id for vm_id in vm_ids
+            if not Shutdown.is_power_state_valid(outputs.get(vm_id, []))
+            ]
+        return vm_states, invalid_vm_ids
 
-        for line in fab_result[1:]:
-            self.logger.info(f'Parsing raw vm output line={line}')
-            tokens = line.split()
-            vm_data = dict(
-                name=tokens[1],
-                datastore=tokens[2],
-                file=tokens[3],
-                guest_os=tokens[4],
-                version=tokens[5],
-                )
-            retval[int(tokens[0])] = vm_data
+    def get_inventory_and_running_vms(self):
+        '''
+        Returns the dict of all vms on the host, as returned by get_all_vms,
+        and the list of those that are running.
+
+        If we already have the inventory in memory, or an inventory cache with
+        an entry for the host, we use it and skip the inventory scan, unless
+        it is stale, see Shutdown.is_inventory_current, in which case we
+        re-scan.  The inventory in memory expires after the ttl of the
+        inventory cache, or its default ttl, so that a resident agent sees the
+        vms added since.  An empty inventory is always re-scanned, as hostd
+        reports no vms while it is still loading them after the host boots.
+        '''
+        vms = self.inventory
+        ttl = self.inventory_cache.ttl if self.inventory_cache is not None else InventoryCache.DEFAULT_TTL_SECONDS
+        if vms is not None and self.clock() - self.inventory_time > ttl:
+            self.logger.info(f'Inventory of esxihost={self.esxihost} in memory has expired, ttl={ttl}')
+            vms = None
+        loaded = False
+        if vms is None and self.inventory_cache is not None:
+            vms = self.inventory_cache.load(self.esxihost)
+            loaded = True
+        if vms is not None and len(vms) > 0:
+            running_vms = self.get_current_running_vms(vms)
+            if running_vms is not None:
+                if loaded:
+                    self.set_inventory(vms)
+                return vms, running_vms
+            self.logger.warning(f'Cached inventory for esxihost={self.esxihost} is stale, re-scanning')
+
+        vms = self.refresh_inventory()
+        return vms, self.get_running_vms(vms)
+
+    def get_current_running_vms(self, vms):
+        '''
+        Returns the list of the vms in the inventory, a dict as returned by
+        get_all_vms, that are running, or None if the inventory is stale: the
+        host does not recognize one of its vms, or a vm is running on the host
+        that is not one of the running vms of the inventory, such as one that
+        was registered since it was scanned.
+        '''
+        vm_states, invalid_vm_ids = self.query_vm_power_states(list(vms))
+        if len(invalid_vm_ids) > 0:
+            self.logger.warning(f'Inventory of esxihost={self.esxihost} has unknown vm_ids={invalid_vm_ids}')
+            return None
+        running_vms = [vm_id for vm_id, running in vm_states.items() if running]
+
+        running_names = self.fab_get_running_vm_names()
+        if running_names is None:
+            self.logger.warning(f'Unable to list the running vms of esxihost={self.esxihost}')
+            return None
+        inventory_names = sorted(vms[vm_id].name for vm_id in running_vms)
+        if sorted(running_names) != inventory_names:
+            self.logger.warning(
+                f'Running vms of esxihost={self.esxihost} do not match its inventory, '
+                f'running_vms={sorted(running_names)}, inventory_running_vms={inventory_names}')
+            return None
+        return running_vms
+
+    def refresh_inventory(self):
+        '''
+        Scans the inventory of the host and updates the inventory cache, if we
+        have one.
+        '''
+        vms = self.get_all_vms()
+        if self.inventory_cache is not None:
+            try:
+                self.inventory_cache.save(self.esxihost, vms)
+            except OSError as e:
+                self.logger.warning(f'Unable to save the inventory cache for esxihost={self.esxihost}, error={e!r}')
+        self.set_inventory(vms)
+        return vms
+
+    def set_inventory(self, vms):
+        self.inventory = vms
+        self.inventory_time = self.clock()
 
+    @staticmethod
+    def parse_power_getstates(fab_output):
+        '''
+        Splits the output of Shutdown.fab_power_getstates into a dict of vm_id
+        to the list of output lines for that vm.
+        '''
+        retval = {}
+        vm_output = None
+        for line in fab_output:
+            if line.startswith(Shutdown.POWER_GETSTATE_MARKER):
+                vm_output = []
+                retval[int(line.split()[1])] = vm_output
+            elif vm_output is not None:
+                vm_output.append(line)
         return retval
 
-    def get_running_vms(self, vms):
+    @staticmethod
+    def parse_vm_process_list(fab_output):
+        '''
+        Returns the display names from the output of esxcli vm process list,
+        a block of indented fields for each running vm.
+        '''
         retval = []
-        for vm_id, _ in vms.items():
-            if self.is_vm_running(vm_id):
-                retval.append(vm_id)
+        for line in fab_output:
+            key, _, value = line.strip().partition(': ')
+            if key == 'Display Name':
+                retval.append(value)
         return retval
 
     def is_vm_running(self, vm_id):
         fab_output = self.fab_power_getstate(vm_id)
+        return Shutdown.is_power_state_running(fab_output)
+
+    @staticmethod
+    def is_power_state_valid(fab_output):
+        return len(fab_output) > 0 and 'Retrieved runtime info' in fab_output[0]
+
+    @staticmethod
+    def is_power_state_running(fab_output):
         # If we don't even have two lines of output this vm is considered NOT running
         if len(fab_output) < 2:
             return False
@@ -121,31 +439,88 @@ class Shutdown(object):
 
         return True if 'Powered on' in fab_output[1] else False
 
-    def shutdown_vms(self, vms):
-        for vm_id in vms:
-            if self.fab_shutdown_vm(vm_id) is False:
-                self.logger.error(f'Unable to issue shutdown command for vm_id={vm_id}')
+    def mark_first_command(self):
+        if self.first_command_time is None:
+            self.first_command_time = self.clock()
+
+    def dispatch_vm_commands(self, funct, vms):
+        '''
+        Calls funct(vm_id) for each of the vms, issuing up to
+        vm_command_concurrency of the commands in parallel, and returns a dict
+        of vm_id to esximanager.pool.Outcome.
+        '''
+        return run_concurrently(funct, vms, self.vm_command_concurrency)
+
+    def shutdown_vms(self, vms, vm_metadata=None):
+        '''
+        Issues a graceful shutdown to all of the vms concurrently and returns a
+        dict of vm_id to a boolean indicating whether the command succeeded.
+        '''
+        self.mark_first_command()
+        self.metrics.record_vms_issued(vms)
+        retval = self.check_vm_command_outcomes(
+            'shutdown', self.dispatch_vm_commands(self.fab_shutdown_vm, vms), vm_metadata)
+        self.journal_write(ShutdownJournal.EVENT_SHUTDOWN_ISSUED, vm_ids=list(vms))
+        return retval
 
     def poweroff_vms(self, vms, vm_metadata):
+        '''
+        Forcefully powers off all of the vms concurrently and returns a dict of
+        vm_id to a boolean indicating whether the command succeeded.
+        '''
+        self.mark_first_command()
+        self.record_forced_vms(vms)
+        retval = self.check_vm_command_outcomes(
+            'poweroff', self.dispatch_vm_commands(self.fab_poweroff_vm, vms), vm_metadata)
+        self.journal_write(ShutdownJournal.EVENT_POWEROFF_ISSUED, vm_ids=list(vms))
+        return retval
+
+    def record_forced_vms(self, vms):
+        now = self.clock()
         for vm_id in vms:
-            if self.fab_poweroff_vm(vm_id) is False:
-                self.logger.error(f'Unable to issue poweroff command for vm_id={vm_id}, metadata={vm_metadata[vm_id]}')
-
-    def fab_ping_esxihost(self):
-        with settings(warn_only=True):
-            result = local(f'ping -c 1 -w 1 {self.esxihost}', capture=True)
-            self.logger.info(f'ping result stdout={result.stdout}, stderr={result.stderr}')
-            if result.return_code == 0:
-                return True
-            else:
-                return False
+            self.forced_vms.setdefault(vm_id, now - self.metrics.vm_issue_times.get(vm_id, now))
+        self.metrics.record_vms_issued(vms)
+
+    def check_vm_command_outcomes(self, command, outcomes, vm_metadata):
+        retval = {}
+        for vm_id, outcome in outcomes.items():
+            retval[vm_id] = outcome.succeeded and outcome.result is not False
+            if retval[vm_id] is False:
+                metadata = vm_metadata.get(vm_id) if vm_metadata is not None else None
+                self.logger.error(
+                    f'Unable to issue {command} command for vm_id={vm_id}, '
+                    f'metadata={metadata}, error={outcome.error}')
+        return retval
+
+    def sleep(self, seconds):
+        self.metrics.record_sleep(seconds)
+        self.sleep_funct(seconds)
+
+    def get_vm_name(self, vm_id):
+        if self.inventory is None or vm_id not in self.inventory:
+            if self.resumed_vm_names is not None:
+                return self.resumed_vm_names.get(vm_id)
+            return None
+        return self.inventory[vm_id].name
 
     @staticmethod
-    def wait_to_return(logger, funct, polltime, timeout):
-        start_time = time.time()
+    def wait_to_return(
+            logger, funct, polltime, timeout, deadline=None, max_polltime=None, backoff=1, sleep=None, clock=None):
+        '''
+        Calls funct every polltime seconds until it returns RESULT_OK or the
+        timeout, in seconds, elapses.  The optional deadline is an absolute
+        time past which we will not sleep, regardless of the timeout.
+
+        If a max_polltime is given, the polltime is multiplied by backoff after
+        each poll until it reaches max_polltime.
+        '''
+        sleep = sleep if sleep is not None else time.sleep
+        clock = clock if clock is not None else time.time
+        start_time = clock()
+        max_polltime = max_polltime if max_polltime is not None else polltime
         while True:
             # Determine if we have exceeded the timeout if we are so configured
-            if timeout > 0 and  (time.time() - start_time) > timeout:
+            if timeout > 0 and  (clock() - start_time) > timeout:
                 return Shutdown.RESULT_TIMEDOUT
 
             result = funct()
@@ -153,103 +528,720 @@ class Shutdown(object):
                 return result
 
             if result == Shutdown.RESULT_WAIT:
-                logger.info(f'Sleeping for polltime={polltime}')
-                time.sleep(polltime)
+                if deadline is not None and clock() + polltime > deadline:
+                    logger.warning('Polling again would overrun the deadline, giving up')
+                    return Shutdown.RESULT_TIMEDOUT
+                logger.debug('Sleeping for polltime=%s', polltime)
+                sleep(polltime)
+                polltime = min(polltime * backoff, max_polltime)
 
     def wait_for_esxihost_to_shutdown(self):
         def wait_funct():
-            ping_result = self.fab_ping_esxihost()
+            probe_start_time = self.clock()
+            probe_result = self.probe.probe()
+            self.metrics.record_command('probe', self.clock() - probe_start_time, True)
 
             if self.dryrun:
-                self.logger.info('In dryrun mode, just ping once and return OK')
+                self.logger.info('In dryrun mode, just probe once and return OK')
                 return Shutdown.RESULT_OK
 
-            if ping_result is True:
+            if probe_result is True:
                 return Shutdown.RESULT_WAIT
             else:
                 return Shutdown.RESULT_OK
 
+        timeout = self.esxi_poweroff_timeout
+        if timeout > 0:
+            timeout += self.host_stop_seconds
         retval = Shutdown.wait_to_return(
-            self.logger, wait_funct, self.esxi_poweroff_poll, self.esxi_poweroff_timeout)
+            self.logger,
+            wait_funct,
+            self.esxi_poweroff_min_poll,
+            timeout,
+            deadline=self.get_phase_deadline(Budget.PHASE_HOST),
+            max_polltime=self.esxi_poweroff_poll,
+            backoff=PollScheduler.DEFAULT_BACKOFF,
+            sleep=self.sleep,
+            clock=self.clock)
+        return retval
+
+    def get_host_executor_timeouts(self):
+        '''
+        Returns the graceful and forced timeouts for the host executor, None
+        for no timeout, bounded by the budget for each phase if we have one.
+        '''
+        graceful_timeout = self.vm_poweroff_timeout if self.vm_poweroff_timeout >= 0 else None
+        forced_timeout = graceful_timeout
+        if self.budget is not None:
+            graceful_left = self.budget.time_left(Budget.PHASE_GRACEFUL)
+            forced_left = self.budget.deadline(Budget.PHASE_FORCED) - max(
+                self.clock(), self.budget.deadline(Budget.PHASE_GRACEFUL))
+            graceful_timeout = min(graceful_left, graceful_timeout) if graceful_timeout is not None else graceful_left
+            forced_timeout = min(forced_left, forced_timeout) if forced_timeout is not None else forced_left
+            forced_timeout = max(0, forced_timeout)
+        return graceful_timeout, forced_timeout
+
+    def get_host_executor_vm_timeouts(self, vm_ids):
+        '''
+        Returns a dict of vm_id to the graceful timeout of each vm for the
+        host executor, see Shutdown.get_vm_timeouts, bounded by the budget for
+        the graceful phase if we have one.
+        '''
+        graceful_left = self.budget.time_left(Budget.PHASE_GRACEFUL) if self.budget is not None else None
+        retval = {}
+        for vm_id, timeout in self.get_vm_timeouts(vm_ids).items():
+            if graceful_left is not None:
+                timeout = min(graceful_left, timeout) if timeout is not None else graceful_left
+            retval[vm_id] = timeout
         return retval
 
-    def wait_for_vms_to_shutdown(self, vms):
+    def run_host_executor(self, vm_ids):
+        '''
+        Shuts down the vms, waits for them and forcefully powers off any that
+        did not shut down in time, all from the esxi host itself.
+
+        If we have a history, each vm is given its own timeout, learned from
+        its history, as when shutting the vms down from here.
+
+        Returns the same tuple as wait_for_vms_to_shutdown, or None if the
+        executor could not be started, in which case nothing was done to the
+        vms.
+        '''
+        if len(vm_ids) == 0:
+            return Shutdown.RESULT_OK, []
+
+        graceful_timeout, forced_timeout = self.get_host_executor_timeouts()
+        vm_timeouts = None
+        if self.history is not None:
+            vm_timeouts = self.get_host_executor_vm_timeouts(vm_ids)
+            # The graceful phase lasts until the last of the vms times out
+            if any(timeout is None for timeout in vm_timeouts.values()):
+                graceful_timeout = None
+            else:
+                graceful_timeout = max(vm_timeouts.values())
+        self.mark_first_command()
+        if not self.host_executor.launch(vm_ids, graceful_timeout, forced_timeout, vm_timeouts):
+            return None
+        self.metrics.record_vms_issued(vm_ids)
+        self.journal_write(ShutdownJournal.EVENT_SHUTDOWN_ISSUED, vm_ids=list(vm_ids))
+
+        still_running = set(vm_ids)
+
+        def on_event(event):
+            if event.event == HostExecutor.EVENT_OFF:
+                vm_id = int(event.args[0])
+                still_running.discard(vm_id)
+                self.metrics.record_vm_off(vm_id, self.get_vm_name(vm_id))
+                self.journal_write(ShutdownJournal.EVENT_VMS_OFF, vm_ids=[vm_id])
+            elif event.event in (HostExecutor.EVENT_SHUTDOWN, HostExecutor.EVENT_POWEROFF):
+                if event.args[1] != 'ok':
+                    self.logger.warning(
+                        f'Host executor unable to {event.event} vm_id={event.args[0]}, '
+                        f'vm_name={self.get_vm_name(int(event.args[0]))}')
+            elif event.event == HostExecutor.EVENT_ESCALATE:
+                self.logger.warning(f'Host executor forcefully powering off vms={event.args}')
+                self.record_forced_vms([int(vm_id) for vm_id in event.args])
+                self.journal_write(ShutdownJournal.EVENT_POWEROFF_ISSUED, vm_ids=[int(vm_id) for vm_id in event.args])
+            self.logger.debug('Host executor event=%s', event)
+
+        follow_timeout = None
+        if graceful_timeout is not None and forced_timeout is not None:
+            # Leave time for the last poll and the forced poweroff commands
+            follow_timeout = graceful_timeout + forced_timeout + 2 * self.host_executor.poll + 30
+        done = self.host_executor.follow(on_event, follow_timeout)
+        if done is None:
+            return Shutdown.RESULT_TIMEDOUT, sorted(still_running)
+        if done.args[0] == Shutdown.RESULT_OK:
+            return Shutdown.RESULT_OK, []
+        return Shutdown.RESULT_TIMEDOUT, [int(vm_id) for vm_id in done.args[1:]]
+
+    def get_phase_deadline(self, phase):
+        if self.budget is None:
+            return None
+        return self.budget.deadline(phase)
+
+    def log_phase(self, phase):
+        self.journal_write(ShutdownJournal.EVENT_PHASE, phase=phase)
+        if self.budget is not None:
+            self.logger.info(
+                f'Starting phase={phase} on esxihost={self.esxihost}, '
+                f'time_left_in_phase={self.budget.time_left(phase):.1f}, budget={self.budget}')
+
+    def wait_for_vms_to_shutdown(self, vms, phase=Budget.PHASE_GRACEFUL, vm_deadlines=None):
         '''
         We poll the vms to see if they are powered off, if there were any to
         power on in the first place.
 
+        Each vm is polled on its own schedule, see
+        esximanager.poll.PollScheduler, starting every vm_poweroff_min_poll
+        seconds and backing off to every vm_poweroff_poll seconds.  All of the
+        vms that are due at the same time are queried together and we only
+        wake up when the next one is due.
+
         Will return a tuple that is a message indicating the shutdown result as
         well as the vms that have not yet shutdown if that is the case.  If
         they are all shutdown it will return an appropriate message and an
         empty dict.
+
+        If we have a budget, we also return RESULT_TIMEDOUT as soon as another
+        poll would finish after the deadline for the given phase.
+
+        A poll that fails, such as while the connection to the host is down,
+        leaves the state of the vms unknown, so they are taken to be still
+        running and polled again, over a new connection, vm_poweroff_poll
+        seconds later.  That way a short drop of the link does not abort the
+        shutdown, and the vms are still forcefully powered off and the host
+        powered off when the time for them comes.
+
+        If vm_deadlines, a dict of vm_id to the time at which to give up on
+        its graceful shutdown, is given, each vm is forcefully powered off as
+        soon as its own deadline passes and we keep waiting for it, for up to
+        vm_poweroff_timeout seconds, instead of timing out all of the vms at
+        once.
         '''
         if len(vms) == 0:
             return Shutdown.RESULT_OK, []
 
-        start_time = time.time()
+        start_time = self.clock()
+        scheduler = PollScheduler(
+            vms,
+            self.vm_poweroff_min_poll,
+            self.vm_poweroff_poll,
+            backoff=self.vm_poweroff_poll_backoff,
+            start_time=start_time)
 
-        wait_to_power_off = True
-        while wait_to_power_off is True:
-            vm_still_running = False
+        def still_running():
+            return [vm_id for vm_id in vms if vm_id in scheduler]
 
-            # Determine if we have exceeded our timeout if we are so configured
-            if self.vm_poweroff_timeout > 0 and (time.time() - start_time) > self.vm_poweroff_timeout:
-                return Shutdown.RESULT_TIMEDOUT, vms
+        # vm_id -> time at which we stop waiting for it once it has been forced
+        give_up_times = {}
 
-            vms_shutdown = set()
+        def get_timeout_time():
+            if vm_deadlines is None:
+                return start_time + self.vm_poweroff_timeout if self.vm_poweroff_timeout > 0 else None
+            if any(vm_id not in give_up_times for vm_id in scheduler.items()):
+                return None
+            return max(give_up_times[vm_id] for vm_id in scheduler.items())
 
-            for vm_id in vms:
-                if self.is_vm_running(vm_id):
-                    vm_still_running = True
-                else:
-                    vms_shutdown.add(vm_id)
+        def get_next_deadline():
+            if vm_deadlines is None:
+                return None
+            deadlines = [
+                vm_deadlines[vm_id] for vm_id in scheduler.items()
+                if vm_id in vm_deadlines and vm_id not in give_up_times]
+            return min(deadlines) if len(deadlines) > 0 else None
 
-            # Remove shutdown vms from the original running set
-            for shutdown_vm_id in vms_shutdown:
-                vms.remove(shutdown_vm_id)
+        while len(scheduler) > 0:
+            # Determine if we have exceeded our timeout if we are so configured
+            timeout_time = get_timeout_time()
+            if timeout_time is not None and self.clock() >= timeout_time:
+                return Shutdown.RESULT_TIMEDOUT, still_running()
 
-            wait_to_power_off = vm_still_running
+            query_start_time = self.clock()
+            due_vms = scheduler.due(query_start_time)
+            poll_failed = False
+            try:
+                vm_states = self.get_vm_power_states(due_vms)
+            except TransportError as e:
+                self.logger.warning(
+                    f'Unable to poll vms={[self.get_vm_name(vm_id) for vm_id in due_vms]} on '
+                    f'esxihost={self.esxihost}, assuming that they are still running, error={e!r}')
+                vm_states = {vm_id: True for vm_id in due_vms}
+                poll_failed = True
+            now = self.clock()
+            query_seconds = now - query_start_time
 
-            # Now wait a bit and then examine the hosts that were still running
-            num_vms_still_running = len(vms)
-            if num_vms_still_running > 0:
-                self.logger.info(f'Sleeping while we wait to for [{num_vms_still_running}] vms to shutdown')
-                time.sleep(self.vm_poweroff_poll)
+            vms_off = []
+            for vm_id in due_vms:
+                if poll_failed:
+                    # Give the connection a whole poll interval to come back
+                    scheduler.add(vm_id, now + self.vm_poweroff_poll, self.vm_poweroff_poll)
+                elif vm_states[vm_id]:
+                    scheduler.reschedule(vm_id, now)
+                else:
+                    scheduler.remove(vm_id)
+                    self.metrics.record_vm_off(vm_id, self.get_vm_name(vm_id))
+                    vms_off.append(vm_id)
+            if len(vms_off) > 0:
+                self.journal_write(ShutdownJournal.EVENT_VMS_OFF, vm_ids=vms_off)
 
             if self.dryrun:
                 self.logger.info('In dryrun mode, just returning with an OK result')
                 return Shutdown.RESULT_OK, []
 
-        if vm_still_running is False:
-            return Shutdown.RESULT_OK, []
+            num_vms_still_running = len(scheduler)
+            if num_vms_still_running == 0:
+                break
+
+            if vm_deadlines is not None:
+                self.poweroff_expired_vms(scheduler, vm_deadlines, give_up_times, now)
+
+            # Now wait until the next vm is due to be checked
+            sleep_seconds = scheduler.sleep_time(now)
+            for wake_time in [get_timeout_time(), get_next_deadline()]:
+                if wake_time is not None:
+                    sleep_seconds = min(sleep_seconds, max(0, wake_time - now))
+
+            if self.budget is not None and self.budget.would_overrun(phase, sleep_seconds + query_seconds):
+                self.logger.warning(
+                    f'Waiting on [{num_vms_still_running}] vms would overrun the budget '
+                    f'for phase={phase}, moving on to the next phase')
+                return Shutdown.RESULT_TIMEDOUT, still_running()
+
+            self.logger.debug(
+                'Sleeping for [%.2f] seconds while we wait for [%d] vms to shutdown',
+                sleep_seconds, num_vms_still_running)
+            self.sleep(sleep_seconds)
+
+        return Shutdown.RESULT_OK, []
+
+    def poweroff_expired_vms(self, scheduler, vm_deadlines, give_up_times, now):
+        '''
+        Forcefully powers off the vms whose deadline has passed, and polls
+        them from the start again.
+        '''
+        expired_vms = [
+            vm_id for vm_id in scheduler.items()
+            if vm_id not in give_up_times and vm_id in vm_deadlines and vm_deadlines[vm_id] <= now]
+        if len(expired_vms) == 0:
+            return
+        self.logger.warning(
+            f'vms={[self.get_vm_name(vm_id) for vm_id in expired_vms]} did not shutdown within '
+            'their own timeout, powering them off forcefully')
+        self.poweroff_vms(expired_vms, self.inventory)
+        poweroff_time = self.clock()
+        for vm_id in expired_vms:
+            give_up_times[vm_id] = (
+                poweroff_time + self.vm_poweroff_timeout if self.vm_poweroff_timeout > 0 else float('inf'))
+            scheduler.add(vm_id, poweroff_time)
+
+    def get_vm_timeouts(self, vm_ids):
+        '''
+        Returns a dict of vm_id to the seconds after its shutdown was issued
+        that we give up on it, learned from its history, or else
+        vm_poweroff_timeout, and None for no timeout.
+        '''
+        history = self.history.load(self.esxihost)
+        default = self.vm_poweroff_timeout if self.vm_poweroff_timeout > 0 else None
+        return self.history.get_vm_timeouts(history, {vm_id: self.get_vm_name(vm_id) for vm_id in vm_ids}, default)
+
+    def get_vm_deadlines(self, vm_ids):
+        '''
+        Returns a dict of vm_id to the time at which to forcefully power it
+        off, from the timeouts learned from its history, for the vms that
+        have one.
+        '''
+        now = self.clock()
+        retval = {}
+        for vm_id, timeout in self.get_vm_timeouts(vm_ids).items():
+            if timeout is not None:
+                retval[vm_id] = self.metrics.vm_issue_times.get(vm_id, now) + timeout
+            self.logger.debug('vm_id=%s, vm_name=%s, timeout=%s', vm_id, self.get_vm_name(vm_id), timeout)
+        return retval
+
+    def record_history(self, result):
+        '''
+        Records how long each vm took to shut down, or how long we waited
+        before forcing it off, and how long the host took to go down.
+        '''
+        vm_seconds = {}
+        for vm_id, vm in self.metrics.vm_poweroff_seconds.items():
+            if vm_id not in self.forced_vms and vm['name'] is not None:
+                vm_seconds[vm['name']] = vm['seconds']
+        forced_vm_seconds = {
+            self.get_vm_name(vm_id): seconds for vm_id, seconds in self.forced_vms.items()
+            if self.get_vm_name(vm_id) is not None}
+        host_seconds = None
+        if result == Shutdown.RESULT_OK:
+            phase_seconds = self.metrics.get_phase_seconds()
+            host_seconds = (
+                phase_seconds.get(RunMetrics.PHASE_HOST_POWEROFF, 0) + phase_seconds.get(RunMetrics.PHASE_HOST_WAIT, 0))
+        try:
+            self.history.record(self.esxihost, vm_seconds, forced_vm_seconds, host_seconds)
+        except OSError as e:
+            self.logger.error(f'Unable to record shutdown history for esxihost={self.esxihost}, error={e!r}')
+
+    def status(self):
+        '''
+        Returns a read-only snapshot of the vms on the host: a dict with the
+        host, the time it was taken, the number of vms and of running vms and
+        a list of dict(vm_id, name, guest_os, powered_on) for each vm.
+
+        It costs one remote command to get the power states of all of the vms
+        and, if the inventory is cached, one to check it against the running
+        vms, or else one to get the inventory.
+        '''
+        vms, running_vms = self.get_inventory_and_running_vms()
+        running_vms = set(running_vms)
+        return dict(
+            host=self.esxihost,
+            timestamp=self.clock(),
+            num_vms=len(vms),
+            num_running=len(running_vms),
+            vms=[
+                dict(vm_id=vm_id, name=vm.name, guest_os=vm.guest_os, powered_on=vm_id in running_vms)
+                for vm_id, vm in sorted(vms.items())])
+
+    def plan(self):
+        '''
+        Predicts, without shutting anything down, how long a shutdown of the
+        host would take from the history of previous shutdowns.
+
+        Returns a dict with the prediction for each running vm, the time to
+        get the inventory and the power states now and the predicted seconds
+        for the vms, the host and in total.  Vms with no history are assumed
+        to take their whole timeout, and a host with no history the whole
+        esxi_poweroff_timeout.  With a dependency config, the waves of vms are
+        predicted to shut down one after another.
+        '''
+        start_time = self.clock()
+        _, running_vms = self.get_inventory_and_running_vms()
+        inventory_seconds = self.clock() - start_time
+
+        history = self.history.load(self.esxihost) if self.history is not None else dict(vms={}, host_samples=[])
+        default = self.vm_poweroff_timeout if self.vm_poweroff_timeout > 0 else None
+        vms = []
+        for vm_id in running_vms:
+            name = self.get_vm_name(vm_id)
+            entry = history['vms'].get(name)
+            samples = entry['samples'] if entry is not None else []
+            timeout = self.history.get_timeout(entry, default) if self.history is not None else default
+            percentile = ShutdownHistory.get_percentile(samples, ShutdownHistory.DEFAULT_PERCENTILE)
+            forced = entry is not None and entry['forced_seconds'] is not None
+            if percentile is not None and not forced:
+                predicted = min(percentile, timeout) if timeout is not None else percentile
+            else:
+                predicted = timeout
+            vms.append(dict(
+                vm_id=vm_id,
+                name=name,
+                samples=len(samples),
+                median_seconds=ShutdownHistory.get_percentile(samples, 0.5),
+                timeout_seconds=timeout,
+                predicted_seconds=predicted))
+
+        predictions = {vm['vm_id']: vm['predicted_seconds'] for vm in vms}
+        if any(p is None for p in predictions.values()):
+            vms_seconds = None
+        else:
+            # The vms of each wave are shut down at once, so we wait on the
+            # slowest of each wave in turn
+            vms_seconds = sum(
+                max(predictions[vm_id] for vm_id in wave)
+                for wave in self.get_shutdown_waves(running_vms) if len(wave) > 0)
+        host_seconds = ShutdownHistory.get_percentile(history['host_samples'], 0.5)
+        if host_seconds is None:
+            host_seconds = self.esxi_poweroff_timeout
+        total_seconds = inventory_seconds + vms_seconds + host_seconds if vms_seconds is not None else None
+        return dict(
+            host=self.esxihost,
+            vms=vms,
+            inventory_seconds=inventory_seconds,
+            vms_seconds=vms_seconds,
+            host_seconds=host_seconds,
+            total_seconds=total_seconds)
 
     def shutdown(self):
-        vms = self.get_all_vms()
-        running_vms = self.get_running_vms(vms)
+        '''
+        Shuts down all of the vms and then the esxi host and returns
+        Shutdown.RESULT_OK if the host was confirmed to have powered off,
+        Shutdown.RESULT_TIMEDOUT if it was still up after the timeout, or
+        Shutdown.RESULT_FAILED if we were unable to issue the poweroff.
 
-        if self.dryrun is False:
-            self.shutdown_vms(vms=running_vms)
+        Timings for the run are collected in self.metrics.
+        '''
+        self.metrics.start()
+        retval = None
+        try:
+            retval = self._shutdown()
+            return retval
+        finally:
+            self.metrics.finish(retval)
+            # The vms shut down by hostd, and the host along with them, say
+            # nothing about how long each takes
+            if (self.history is not None and self.dryrun is False and self.resumed_vm_names is None
+                    and self.host_stop_seconds == 0):
+                self.record_history(retval)
+            if self.journal is not None:
+                self.journal.close(self.esxihost)
+            self.transport.close()
+            self.logger.info(f'Transport stats={self.transport.stats()}')
+            if self.first_command_time is not None:
+                self.logger.info(
+                    f'Issued the first shutdown command on esxihost={self.esxihost} '
+                    f'[{self.first_command_time - self.metrics.start_time:.3f}] seconds after starting the shutdown')
+            self.logger.info(f'Phase timings for esxihost={self.esxihost}: {self.metrics.get_phase_seconds()}')
+
+    def shutdown_and_wait(self, vms, running_vms, shutdown_issued=(), forced=False):
+        '''
+        Shuts down the running vms from here, waits for them and forcefully
+        powers off any that did not shut down in time.
 
-        wait_result, still_running_vms = self.wait_for_vms_to_shutdown(vms=running_vms)
+        When resuming, the vms in shutdown_issued are not shut down again, and
+        if forced is True, we go straight to powering off the vms.
+        '''
+        wait_result, still_running_vms = Shutdown.RESULT_TIMEDOUT, list(running_vms)
+        if not forced:
+            shutdown_vms = [vm_id for vm_id in running_vms if vm_id not in shutdown_issued]
+            if self.dryrun is False and len(shutdown_vms) > 0:
+                with self.metrics.phase(RunMetrics.PHASE_GRACEFUL_SHUTDOWN):
+                    self.shutdown_vms(shutdown_vms, vms)
+
+            vm_deadlines = self.get_vm_deadlines(running_vms) if self.history is not None else None
+            with self.metrics.phase(RunMetrics.PHASE_GRACEFUL_WAIT):
+                wait_result, still_running_vms = self.wait_for_vms_to_shutdown(
+                    vms=list(running_vms), vm_deadlines=vm_deadlines)
         if wait_result != Shutdown.RESULT_OK:
-            self.logger.warn('All vms did not shutdown cleanly, powering them off forcefully')
+            self.logger.warning('All vms did not shutdown cleanly, powering them off forcefully')
+            self.log_phase(Budget.PHASE_FORCED)
             # Force power off the vms
-            self.poweroff_vms(still_running_vms, vms)
+            with self.metrics.phase(RunMetrics.PHASE_FORCED_POWEROFF):
+                self.poweroff_vms(still_running_vms, vms)
             # Then give them a little time to be powered off
-            wait_result, still_running_vms = self.wait_for_vms_to_shutdown(vms)
-            self.logger.warn(
+            with self.metrics.phase(RunMetrics.PHASE_FORCED_WAIT):
+                wait_result, still_running_vms = self.wait_for_vms_to_shutdown(
+                    list(still_running_vms), phase=Budget.PHASE_FORCED)
+            self.logger.warning(
                 'After forcefully powering off vms '
                 f'wait_resut={wait_result} and still_running_vms={still_running_vms}')
+        return wait_result, still_running_vms
+
+    def journal_write(self, event, **fields):
+        if self.journal is not None and self.dryrun is False:
+            self.journal.write(self.esxihost, event, **fields)
+
+    def start_journal(self):
+        '''
+        Returns the state of the interrupted shutdown to resume, see
+        esximanager.journal.ShutdownJournal.get_resume_state, or None after
+        starting a new journal.
+        '''
+        if self.journal is None or self.dryrun:
+            return None
+        resume_state = None
+        try:
+            resume_state = self.journal.get_resume_state(self.esxihost)
+            if resume_state is not None:
+                self.journal.resume(self.esxihost)
+            else:
+                self.journal.start(self.esxihost)
+        except OSError as e:
+            self.logger.error(f'Unable to open the journal for esxihost={self.esxihost}, continuing without it, error={e!r}')
+            self.journal = None
+        return resume_state
+
+    def get_shutdown_waves(self, vm_ids):
+        '''
+        Groups the vm_ids into a list of waves, lists of vm_ids, from the
+        dependencies between their names, so that each vm is shut down before
+        the vms that it depends on.  All of the vms are in a single wave if we
+        have no dependency config, or if its dependencies have a cycle.
+        '''
+        if self.dependency_config is None or len(vm_ids) == 0:
+            return [list(vm_ids)]
+        vm_ids_by_name = {}
+        for vm_id in vm_ids:
+            vm_ids_by_name.setdefault(self.get_vm_name(vm_id), []).append(vm_id)
+        try:
+            waves = self.dependency_config.get_shutdown_waves(
+                [name for name in vm_ids_by_name if name is not None])
+        except ConfigError as e:
+            self.logger.error(f'Ignoring the vm dependencies, shutting down all of the vms at once, error={e}')
+            return [list(vm_ids)]
+        retval = [[vm_id for name in wave for vm_id in vm_ids_by_name[name]] for wave in waves]
+        # vms that we do not know the name of cannot have dependencies
+        if None in vm_ids_by_name:
+            if len(retval) == 0:
+                retval.append([])
+            retval[0] = vm_ids_by_name[None] + retval[0]
+        return retval
+
+    def get_autostart_stop_delays(self, vm_ids):
+        '''
+        Returns a dict of vm_id to the whole seconds that hostd should wait
+        for it to shut down, its timeout learned from its history if we have
+        one, or else vm_poweroff_timeout, and -1 for the system default.
+        '''
+        default = self.vm_poweroff_timeout if self.vm_poweroff_timeout > 0 else None
+        if self.history is not None:
+            timeouts = self.history.get_vm_timeouts(
+                self.history.load(self.esxihost), {vm_id: self.get_vm_name(vm_id) for vm_id in vm_ids}, default)
+        else:
+            timeouts = {vm_id: default for vm_id in vm_ids}
+        return {vm_id: int(math.ceil(timeout)) if timeout is not None else -1 for vm_id, timeout in timeouts.items()}
+
+    def sync_autostart(self, vms):
+        '''
+        Sets up the autostart manager to shut down all of the vms in the
+        inventory, in the order of their shutdown waves, pushing only the
+        entries that differ from what the host has.  Returns the dict of
+        vm_id to esximanager.autostart.AutostartEntry, or None if it could not
+        be set up.
+        '''
+        vm_ids = sorted(vms)
+        current = self.autostart.get_entries()
+        desired = AutostartManager.get_desired_entries(
+            self.get_shutdown_waves(vm_ids), self.get_autostart_stop_delays(vm_ids), current)
+        if self.autostart.sync(desired, current) is None:
+            return None
+        return desired
+
+    def delegate_to_autostart(self, vms, running_vms):
+        '''
+        Leaves the shutdown of the running vms to hostd, which stops them one
+        at a time when the host is powered off, so the wait for the host is
+        extended by their stop delays.  Returns False if the autostart
+        manager could not be set up.
+        '''
+        try:
+            with self.metrics.phase(RunMetrics.PHASE_AUTOSTART_SYNC):
+                entries = self.sync_autostart(vms)
+        except TransportError as e:
+            self.logger.error(f'Unable to sync the autostart manager of esxihost={self.esxihost}, error={e!r}')
+            entries = None
+        if entries is None:
+            return False
+        self.host_stop_seconds = sum(
+            entries[vm_id].stop_delay if entries[vm_id].stop_delay >= 0 else AutostartManager.DEFAULT_STOP_DELAY_SECONDS
+            for vm_id in running_vms if vm_id in entries)
+        self.logger.info(
+            f'Delegated the shutdown of [{len(running_vms)}] vms to the autostart manager of '
+            f'esxihost={self.esxihost}, host_stop_seconds={self.host_stop_seconds}')
+        return True
+
+    def shutdown_running_vms(self, vms, running_vms, shutdown_issued=(), forced=False):
+        '''
+        Shuts down the running vms, a wave at a time, starting each wave as
+        soon as the vms of the previous one are off.
+        '''
+        waves = self.get_shutdown_waves(running_vms)
+        for i, wave in enumerate(waves):
+            wave_start_time = self.clock()
+            if len(waves) > 1:
+                self.logger.info(
+                    f'Shutting down wave=[{i + 1}/{len(waves)}] of esxihost={self.esxihost}, '
+                    f'vms={[self.get_vm_name(vm_id) for vm_id in wave]}')
+            self.shutdown_wave(vms, wave, shutdown_issued, forced)
+            self.metrics.record_wave(i + 1, [self.get_vm_name(vm_id) for vm_id in wave], wave_start_time)
+            self.logger.info(
+                f'Shut down wave=[{i + 1}/{len(waves)}] of esxihost={self.esxihost} '
+                f'in [{self.clock() - wave_start_time:.1f}] seconds')
+
+    def shutdown_wave(self, vms, running_vms, shutdown_issued=(), forced=False):
+        executor_result = None
+        if self.host_executor is not None and self.dryrun is False:
+            with self.metrics.phase(RunMetrics.PHASE_HOST_EXECUTOR):
+                executor_result = self.run_host_executor(list(running_vms))
+            if executor_result is None:
+                self.logger.warning('Unable to run the host executor, shutting down the vms from here instead')
+
+        if executor_result is None:
+            self.shutdown_and_wait(vms, running_vms, shutdown_issued, forced)
+        elif executor_result[0] != Shutdown.RESULT_OK:
+            self.logger.warning(f'Host executor did not power off still_running_vms={executor_result[1]}')
+
+    def get_unjournaled_running_vms(self, vm_names, running_vms):
+        '''
+        Returns the list of the vms running on the host that are not in
+        vm_names, the dict of vm_id to name of the journaled vms, of which
+        running_vms are running, such as those autostarted after the host
+        rebooted partway through the shutdown.
+
+        Costs a single command when the names of the running vms match those
+        of the journal, and only otherwise a look at the inventory.
+        '''
+        running_names = self.fab_get_running_vm_names()
+        if running_names is not None and sorted(running_names) == sorted(
+                str(vm_names[vm_id]) for vm_id in running_vms):
+            return []
+        self.logger.warning(
+            f'Running vms of esxihost={self.esxihost} do not match the journal, '
+            f'running_vms={running_names}, checking the inventory')
+        _, all_running_vms = self.get_inventory_and_running_vms()
+        return [vm_id for vm_id in all_running_vms if vm_id not in vm_names]
+
+    def resume_shutdown(self, resume_state):
+        '''
+        Picks up an interrupted shutdown, checking the power states of all of
+        the journaled vms with a single command and only shutting down those
+        that are running, along with any running vms that are not in the
+        journal.
+
+        A vm that is running although it was seen powered off, or although the
+        host poweroff had been issued, has been started again since, such as
+        after the host rebooted, so its shutdown is issued afresh.
+        '''
+        self.resumed_vm_names = dict(resume_state['running_vms'])
+        remaining_vms = [vm_id for vm_id in resume_state['running_vms'] if vm_id not in resume_state['vms_off']]
+        self.logger.warning(
+            f'Resuming interrupted shutdown of esxihost={self.esxihost}, phase={resume_state["phase"]}, '
+            f'remaining_vms={remaining_vms}, host_poweroff_issued={resume_state["host_poweroff_issued"]}')
+
+        with self.metrics.phase(RunMetrics.PHASE_INVENTORY):
+            running_vms = self.get_running_vms(list(resume_state['running_vms']))
+            unjournaled_vms = self.get_unjournaled_running_vms(resume_state['running_vms'], running_vms)
+        vms_off = [vm_id for vm_id in remaining_vms if vm_id not in running_vms]
+        if len(vms_off) > 0:
+            self.journal_write(ShutdownJournal.EVENT_VMS_OFF, vm_ids=vms_off)
+        if len(unjournaled_vms) > 0:
+            self.logger.warning(
+                f'vms={[self.get_vm_name(vm_id) for vm_id in unjournaled_vms]} are running but not in the '
+                'journal, shutting them down too')
+            for vm_id in unjournaled_vms:
+                self.resumed_vm_names[vm_id] = self.get_vm_name(vm_id)
+            self.journal_write(ShutdownJournal.EVENT_RUNNING_VMS, vms=self.resumed_vm_names)
+            running_vms = running_vms + unjournaled_vms
+        if len(running_vms) == 0:
+            return
+
+        if resume_state['host_poweroff_issued']:
+            self.logger.warning(f'vms={running_vms} are running again since the host poweroff was issued')
+            shutdown_issued = ()
+            forced = False
+        else:
+            shutdown_issued = resume_state['shutdown_issued'] - resume_state['vms_off']
+            # The vms that are not in the journal have yet to be shut down gracefully
+            forced = resume_state['phase'] == Budget.PHASE_FORCED and len(unjournaled_vms) == 0
+        self.shutdown_running_vms(
+            self.inventory,
+            running_vms,
+            shutdown_issued=shutdown_issued,
+            forced=forced)
+
+    def _shutdown(self):
+        resume_state = self.start_journal()
+        if resume_state is not None:
+            self.resume_shutdown(resume_state)
+        else:
+            self.log_phase(Budget.PHASE_GRACEFUL)
+            with self.metrics.phase(RunMetrics.PHASE_INVENTORY):
+                vms, running_vms = self.get_inventory_and_running_vms()
+            self.journal_write(
+                ShutdownJournal.EVENT_RUNNING_VMS,
+                vms={vm_id: self.get_vm_name(vm_id) for vm_id in running_vms})
+            if self.autostart is None or not self.delegate_to_autostart(vms, running_vms):
+                if self.autostart is not None:
+                    self.logger.warning('Unable to delegate to the autostart manager, shutting down the vms from here')
+                self.shutdown_running_vms(vms, running_vms)
 
         self.logger.info(f'All vms have been shutdown, shutting down the esxihost={self.esxihost}')
-        esxihost_poweroff_success = self.fab_poweroff_esxihost()
+        self.log_phase(Budget.PHASE_HOST)
+        with self.metrics.phase(RunMetrics.PHASE_HOST_POWEROFF):
+            esxihost_poweroff_success = self.fab_poweroff_esxihost()
         if esxihost_poweroff_success is False:
             self.logger.error(
                 'Unable to successfully run fab command to poweroff '
                 f'esxihost={self.esxihost}.  It is unknown if the '
                 'esxi host has been powered off.')
+            retval = Shutdown.RESULT_FAILED
         else:
-            self.wait_for_esxihost_to_shutdown()
-            self.logger.info(f'esxihost={self.esxihost} is powered off')
+            with self.metrics.phase(RunMetrics.PHASE_HOST_WAIT):
+                retval = self.wait_for_esxihost_to_shutdown()
+            if retval == Shutdown.RESULT_OK:
+                self.logger.info(f'esxihost={self.esxihost} is powered off')
+            else:
+                self.logger.error(f'esxihost={self.esxihost} still responding after poweroff, result={retval}')
 
+        self.journal_write(ShutdownJournal.EVENT_DONE, result=retval)
         self.logger.info('Exiting esximanager.Shudown.shutdown')
+        return retval
@@ -0,0 +1,579 @@
+import re
+import time
+import heapq
+import random
+import threading
+from argparse import Namespace
+from collections import Counter
+from esximanager.autostart import AutostartEntry, AutostartManager
+from esximanager.shutdown import Shutdown
+from esximanager.transport.base import CommandResult, ConnectionLostError
+from esximanager.transport.fake import FakeTransport
+
+GETALLVMS_HDR = 'Vmid   Name   File   Guest OS   Version   Annotation'
+POWER_GETSTATE_ON = 'Retrieved runtime info\nPowered on\n'
+POWER_GETSTATE_OFF = 'Retrieved runtime info\nPowered off\n'
+VM_NOT_FOUND = (
+    '(vim.fault.NotFound) {\n'
+    '   faultCause = (vmodl.MethodFault) null,\n'
+    '   faultMessage = <unset>\n'
+    '   msg = "Unable to find a VM corresponding to "{vm_id}""\n'
+    '}\n')
+INVALID_POWER_STATE = (
+    '(vim.fault.InvalidPowerState) {\n'
+    '   faultCause = (vmodl.MethodFault) null,\n'
+    '   faultMessage = <unset>\n'
+    '   requestedState = "poweredOn",\n'
+    '   existingState = "poweredOff",\n'
+    '   msg = "The attempted operation cannot be performed in the current state (Powered off)."\n'
+    '}\n')
+INVALID_POWER_STATE_ON = (
+    INVALID_POWER_STATE
+    .replace('requestedState = "poweredOn"', 'requestedState = "poweredOff"')
+    .replace('existingState = "poweredOff"', 'existingState = "poweredOn"')
+    .replace('(Powered off)', '(Powered on)'))
+HEARTBEAT_GREEN = 'green\n'
+HEARTBEAT_GRAY = 'gray\n'
+
+
+def constant(seconds):
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma):
+    '''
+    A long tailed distribution of guest shutdown times, as most guests stop
+    quickly and a few take much longer.
+    '''
+    return lambda rng: rng.lognormvariate(0, sigma) * median
+
+
+class VirtualClock(object):
+    '''
+    A clock for running the real shutdown logic in virtual time, in which
+    sleep advances the time at once instead of waiting, so that hours of
+    simulated polling take a fraction of a second.
+
+    The commands that esximanager.pool.run_concurrently runs in parallel
+    each sleep, for their simulated latency, on a worker thread.  Each of
+    those sleeps takes the earliest free of concurrency lanes, so that n
+    commands take about n / concurrency times the latency, as they would for
+    real, or all run at once if concurrency is None.  A worker reads the time
+    at which its last sleep ended, or else the time of the owner.  The owner
+    thread, the one that created the clock, catches up to the last of the
+    lanes to finish the next time that it reads the clock, which it only does
+    once the commands have all completed.
+    '''
+
+    def __init__(self, start_time=0, concurrency=None):
+        self.now = start_time
+        self.concurrency = concurrency
+        self.owner = threading.current_thread()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # The times at which the lanes in use since the owner last read the clock are free
+        self.lanes = []
+        self.batch = 0
+
+    def is_owner(self):
+        return threading.current_thread() is self.owner
+
+    def catch_up(self):
+        if len(self.lanes) > 0:
+            self.now = max([self.now] + self.lanes)
+            self.lanes = []
+        self.batch += 1
+
+    def time(self):
+        with self.lock:
+            if self.is_owner():
+                self.catch_up()
+                return self.now
+            if getattr(self.local, 'batch', None) != self.batch:
+                return self.now
+            return self.local.now
+
+    def sleep(self, seconds):
+        seconds = max(0, seconds)
+        with self.lock:
+            if self.is_owner():
+                self.catch_up()
+                self.now += seconds
+                return
+            if self.concurrency is not None and len(self.lanes) >= self.concurrency:
+                start_time = heapq.heappop(self.lanes)
+            else:
+                start_time = self.now
+            heapq.heappush(self.lanes, start_time + seconds)
+            self.local.batch = self.batch
+            self.local.now = start_time + seconds
+
+
+class SimulatedVm(object):
+    __slots__ = (
+        'vm_id', 'name', 'shutdown_latency', 'hung', 'powered_on', 'off_time', 'boot_latency', 'ready_time',
+        'powered_off_time')
+
+    def __init__(self, vm_id, name, shutdown_latency, hung, powered_on=True, boot_latency=0):
+        self.vm_id = vm_id
+        self.name = name
+        self.shutdown_latency = shutdown_latency
+        self.hung = hung
+        self.powered_on = powered_on
+        # The time at which a shutdown in progress completes
+        self.off_time = None
+        self.boot_latency = boot_latency
+        # The time at which the guest of a powered on vm reports a heartbeat
+        self.ready_time = 0
+        # The time at which the vm last actually powered off
+        self.powered_off_time = None
+
+
+class SimulatedEsxiHost(object):
+    '''
+    An in-memory stand-in for an esxi host that answers the vim-cmd commands
+    that Shutdown runs, including the batched power.getstate, the way a real
+    host does.  Use SimulatedEsxiHost.create_transport and
+    SimulatedEsxiHost.create_probe to run a Shutdown against it.
+
+    Each vm takes a shutdown latency drawn from the given distribution to
+    power off after a graceful shutdown is issued.  Hung vms accept the
+    shutdown but never power off until they are powered off forcefully.  The
+    host itself stops answering poweroff_latency seconds after the poweroff
+    command.
+
+    A vm that is powered on reports a green guest heartbeat a boot latency,
+    drawn from its own distribution, later.
+    '''
+
+    BATCHED_GETSTATE_RE = re.compile(r'^for id in ([0-9 ]*); do ')
+    HOSTEXEC_LAUNCH_RE = re.compile(
+        r'^if \[ ! -e (\S+) \].* esximanager-hostexec (-?[0-9]+) (-?[0-9]+) ([0-9.]+) [0-9]+((?: [0-9]+(?::-?[0-9]+)?)*) >>',
+        re.DOTALL)
+    HOSTEXEC_FOLLOW_RE = re.compile(r'^tail -n \+([0-9]+) -f (\S+) ')
+    AUTOSTART_UPDATE_RE = re.compile(
+        r'^vim-cmd hostsvc/autostartmanager/update_autostartentry ([0-9]+) (\S+) (-?[0-9]+) (-?[0-9]+) (\S+) (-?[0-9]+) (\S+)$')
+    VM_COMMAND_RE = re.compile(r'^vim-cmd vmsvc/(power\.getstate|power\.shutdown|power\.off|power\.on|get\.guestheartbeatStatus) ([0-9]+)$')
+
+    def __init__(
+            self,
+            num_vms,
+            shutdown_latency=None,
+            hung_fraction=0,
+            powered_off_fraction=0,
+            command_latency=0,
+            poweroff_latency=0,
+            seed=None,
+            boot_latency=None,
+            clock=time.time,
+            sleep=time.sleep):
+        '''
+        command_latency is the round trip time, in seconds, that every
+        command takes.  clock and sleep are used for all timing so that the
+        host can be driven by a virtual clock.
+        '''
+        self.command_latency = command_latency
+        self.poweroff_latency = poweroff_latency
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.commands = Counter()
+        # vim-cmd commands run by the host executor on the host itself
+        self.local_commands = Counter()
+        self.poweroff_time = None
+        # log path -> the arguments of the host executor, and then its lines
+        self.executors = {}
+        self.autostart_enabled = False
+        # vm_id -> AutostartEntry
+        self.autostart_entries = {}
+
+        rng = random.Random(seed)
+        shutdown_latency = shutdown_latency if shutdown_latency is not None else constant(0)
+        self.vms = {}
+        for vm_id in range(1, num_vms + 1):
+            self.vms[vm_id] = SimulatedVm(
+                vm_id,
+                f'vm-{vm_id}',
+                shutdown_latency(rng),
+                rng.random() < hung_fraction,
+                powered_on=rng.random() >= powered_off_fraction)
+        # Drawn separately so that adding boot latencies does not change the rest
+        boot_rng = random.Random(seed)
+        boot_latency = boot_latency if boot_latency is not None else constant(0)
+        for vm in self.vms.values():
+            vm.boot_latency = boot_latency(boot_rng)
+
+    def create_transport(self, logger, host='esxi.simulated'):
+        return FakeTransport(host, logger, responder=self.execute)
+
+    def create_probe(self):
+        return SimulatedProbe(self)
+
+    def is_up(self):
+        return self.poweroff_time is None or self.clock() < self.poweroff_time + self.poweroff_latency
+
+    def update(self, now):
+        for vm in self.vms.values():
+            if vm.powered_on and vm.off_time is not None and now >= vm.off_time:
+                vm.powered_on = False
+                vm.powered_off_time = vm.off_time
+
+    def running_vms(self):
+        with self.lock:
+            self.update(self.clock())
+            return [vm.vm_id for vm in self.vms.values() if vm.powered_on]
+
+    def execute(self, command):
+        '''
+        Answers a command the way that an esxi host would, returning a
+        CommandResult, or raising ConnectionLostError once the host is down.
+        '''
+        if self.command_latency > 0:
+            self.sleep(self.command_latency)
+
+        match = SimulatedEsxiHost.HOSTEXEC_FOLLOW_RE.match(command)
+        if match is not None and self.is_up():
+            self.commands['hostexec.follow'] += 1
+            lines = self.follow_executor(match.group(2))
+            return CommandResult(''.join(f'{line}\n' for line in lines[int(match.group(1)) - 1:]), 0)
+
+        with self.lock:
+            if not self.is_up():
+                raise ConnectionLostError() from ConnectionRefusedError('Connection refused')
+
+            now = self.clock()
+            self.update(now)
+
+            match = SimulatedEsxiHost.BATCHED_GETSTATE_RE.match(command)
+            if match is not None:
+                self.commands['power.getstate.batched'] += 1
+                return self.getstates([int(vm_id) for vm_id in match.group(1).split()])
+
+            match = SimulatedEsxiHost.HOSTEXEC_LAUNCH_RE.match(command)
+            if match is not None:
+                self.commands['hostexec.launch'] += 1
+                if match.group(1) not in self.executors:
+                    vm_args = [vm_arg.split(':') for vm_arg in match.group(5).split()]
+                    self.executors[match.group(1)] = (
+                        [int(vm_arg[0]) for vm_arg in vm_args],
+                        int(match.group(2)),
+                        int(match.group(3)),
+                        float(match.group(4)),
+                        {int(vm_arg[0]): int(vm_arg[1]) for vm_arg in vm_args if len(vm_arg) > 1})
+                return CommandResult('', 0)
+
+            if command == 'vim-cmd vmsvc/getallvms':
+                self.commands['getallvms'] += 1
+                return self.getallvms()
+
+            if command == 'esxcli vm process list':
+                self.commands['esxcli.vm.process.list'] += 1
+                return self.vm_process_list()
+
+            if command == 'poweroff':
+                self.commands['poweroff'] += 1
+                self.poweroff_time = now + self.stop_autostart_vms(now)
+                return CommandResult('', 0)
+
+            if command.startswith('vim-cmd hostsvc/autostartmanager/'):
+                return self.autostart_command(command)
+
+            match = SimulatedEsxiHost.VM_COMMAND_RE.match(command)
+            if match is None:
+                self.commands['unknown'] += 1
+                return CommandResult(f'sh: {command.split()[0]}: not found\n', 127)
+
+            vm_command, vm_id = match.group(1), int(match.group(2))
+            self.commands[vm_command] += 1
+            return self.vm_command(vm_command, vm_id, now)
+
+    def vm_command(self, vm_command, vm_id, now):
+        vm = self.vms.get(vm_id)
+        if vm is None:
+            return CommandResult(VM_NOT_FOUND.replace('{vm_id}', str(vm_id)), 1)
+        if vm_command == 'power.getstate':
+            return CommandResult(POWER_GETSTATE_ON if vm.powered_on else POWER_GETSTATE_OFF, 0)
+        if vm_command == 'get.guestheartbeatStatus':
+            return CommandResult(HEARTBEAT_GREEN if vm.powered_on and now >= vm.ready_time else HEARTBEAT_GRAY, 0)
+        if vm_command == 'power.on':
+            if vm.powered_on:
+                return CommandResult(INVALID_POWER_STATE_ON, 1)
+            vm.powered_on = True
+            vm.off_time = None
+            vm.ready_time = now + vm.boot_latency
+            return CommandResult('', 0)
+        if not vm.powered_on:
+            return CommandResult(INVALID_POWER_STATE, 1)
+        if vm_command == 'power.shutdown':
+            if not vm.hung and vm.off_time is None:
+                vm.off_time = now + vm.shutdown_latency
+        else:
+            vm.powered_on = False
+            vm.powered_off_time = now
+        return CommandResult('', 0)
+
+    def autostart_command(self, command):
+        if command.endswith('/get_autostartseq'):
+            self.commands['autostartmanager.get_autostartseq'] += 1
+            return self.get_autostartseq()
+        if command.endswith('/enable_autostart true'):
+            self.commands['autostartmanager.enable_autostart'] += 1
+            self.autostart_enabled = True
+            return CommandResult('', 0)
+        match = SimulatedEsxiHost.AUTOSTART_UPDATE_RE.match(command)
+        if match is None or int(match.group(1)) not in self.vms:
+            self.commands['unknown'] += 1
+            return CommandResult(f'Unknown command: {command}\n', 1)
+        self.commands['autostartmanager.update_autostartentry'] += 1
+        vm_id = int(match.group(1))
+        self.autostart_entries[vm_id] = AutostartEntry(
+            vm_id,
+            match.group(2),
+            int(match.group(3)),
+            int(match.group(4)),
+            match.group(5),
+            int(match.group(6)),
+            match.group(7))
+        return CommandResult('', 0)
+
+    def get_autostartseq(self):
+        output = ['(vim.host.AutoStartManager.AutoPowerInfo) [']
+        for vm_id, entry in sorted(self.autostart_entries.items()):
+            output.extend([
+                '   (vim.host.AutoStartManager.AutoPowerInfo) {',
+                f"      key = 'vim.VirtualMachine:{vm_id}',",
+                f'      startOrder = {entry.start_order},',
+                f'      startDelay = {entry.start_delay},',
+                f'      waitForHeartbeat = "{entry.wait_for_heartbeat}",',
+                f'      startAction = "{entry.start_action}",',
+                f'      stopDelay = {entry.stop_delay},',
+                f'      stopAction = "{entry.stop_action}"',
+                '   },'])
+        output.append(']')
+        return CommandResult('\n'.join(output) + '\n', 0)
+
+    def stop_autostart_vms(self, now):
+        '''
+        Does what hostd does when the host is powered off with the autostart
+        manager enabled: shuts down the running vms with the guestShutdown
+        stop action one at a time, in the reverse of their start order,
+        waiting up to the stop delay for each before powering it off.
+        Returns the seconds that it takes.
+        '''
+        if not self.autostart_enabled:
+            return 0
+        entries = sorted(
+            (entry for entry in self.autostart_entries.values() if entry.stop_action == 'guestShutdown'),
+            key=lambda entry: -entry.start_order)
+        seconds = 0
+        for entry in entries:
+            vm = self.vms[entry.vm_id]
+            if not vm.powered_on:
+                continue
+            stop_delay = entry.stop_delay if entry.stop_delay >= 0 else AutostartManager.DEFAULT_STOP_DELAY_SECONDS
+            seconds += stop_delay if vm.hung else min(vm.shutdown_latency, stop_delay)
+            vm.off_time = now + seconds
+        return seconds
+
+    def local_vm_command(self, vm_command, vm_id):
+        with self.lock:
+            now = self.clock()
+            self.update(now)
+            self.local_commands[vm_command] += 1
+            return self.vm_command(vm_command, vm_id, now)
+
+    def follow_executor(self, log_path):
+        '''
+        Runs the host executor started with log_path to completion, the first
+        time that it is followed, and returns all of its progress lines.
+        '''
+        executor = self.executors.get(log_path)
+        if executor is None:
+            return []
+        if isinstance(executor, list):
+            return executor
+        lines = self.run_executor(*executor)
+        self.executors[log_path] = lines
+        return lines
+
+    def run_executor(self, vm_ids, graceful_timeout, forced_timeout, poll, vm_timeouts):
+        '''
+        Does what the esximanager.hostexec.HostExecutor script does, against
+        the simulated vms, and returns its progress lines.
+        '''
+        lines = []
+
+        def emit(*fields):
+            lines.append(' '.join(['EXM', str(int(self.clock()))] + [str(f) for f in fields]))
+
+        def each(vm_command, event, running):
+            for vm_id in running:
+                result = self.local_vm_command(vm_command, vm_id)
+                emit(event, vm_id, 'ok' if result.succeeded else 'failed')
+
+        def is_on(vm_id):
+            return self.local_vm_command('power.getstate', vm_id).stdout == POWER_GETSTATE_ON
+
+        def wait_graceful(running):
+            forced = set()
+            while len(running) > 0:
+                still, expired, waiting = [], [], []
+                for vm_id in running:
+                    if not is_on(vm_id):
+                        emit('off', vm_id)
+                        continue
+                    still.append(vm_id)
+                    if vm_id in forced:
+                        continue
+                    if deadlines[vm_id] is not None and self.clock() >= deadlines[vm_id]:
+                        expired.append(vm_id)
+                    else:
+                        waiting.append(vm_id)
+                running = still
+                if len(expired) > 0:
+                    emit('escalate', *expired)
+                    each('power.off', 'poweroff', expired)
+                    forced.update(expired)
+                if len(waiting) == 0:
+                    break
+                self.sleep(poll)
+            return running
+
+        def wait_off(timeout, running):
+            deadline = self.clock() + timeout
+            while len(running) > 0:
+                still = []
+                for vm_id in running:
+                    if is_on(vm_id):
+                        still.append(vm_id)
+                    else:
+                        emit('off', vm_id)
+                running = still
+                if len(running) == 0 or (timeout >= 0 and self.clock() >= deadline):
+                    break
+                self.sleep(poll)
+            return running
+
+        start_time = self.clock()
+        deadlines = {}
+        for vm_id in vm_ids:
+            timeout = vm_timeouts.get(vm_id, graceful_timeout)
+            deadlines[vm_id] = start_time + timeout if timeout >= 0 else None
+        emit('start', len(vm_ids))
+        each('power.shutdown', 'shutdown', vm_ids)
+        running = wait_graceful(vm_ids)
+        if len(running) > 0:
+            running = wait_off(forced_timeout, running)
+        if len(running) == 0:
+            emit('done', 'OK')
+        else:
+            emit('done', 'TIMEDOUT', *running)
+        return lines
+
+    def getallvms(self):
+        lines = [GETALLVMS_HDR]
+        for vm in self.vms.values():
+            lines.append(
+                f'{vm.vm_id}      {vm.name}   [datastore1] {vm.name}/{vm.name}.vmx   '
+                'centos7_64Guest   vmx-14')
+        return CommandResult('\n'.join(lines) + '\n', 0)
+
+    def vm_process_list(self):
+        output = []
+        for vm in self.vms.values():
+            if vm.powered_on:
+                output.extend([
+                    vm.name,
+                    f'   World ID: {1000 + vm.vm_id}',
+                    f'   Display Name: {vm.name}',
+                    f'   Config File: /vmfs/volumes/datastore1/{vm.name}/{vm.name}.vmx',
+                    ''])
+        return CommandResult('\n'.join(output), 0)
+
+    def getstates(self, vm_ids):
+        output = []
+        for vm_id in vm_ids:
+            output.append(f'{Shutdown.POWER_GETSTATE_MARKER} {vm_id}\n')
+            vm = self.vms.get(vm_id)
+            if vm is None:
+                output.append(VM_NOT_FOUND.replace('{vm_id}', str(vm_id)))
+            else:
+                output.append(POWER_GETSTATE_ON if vm.powered_on else POWER_GETSTATE_OFF)
+        return CommandResult(''.join(output), 0)
+
+
+class SimulatedProbe(object):
+    '''
+    Stands in for esximanager.probe.HostProbe against a SimulatedEsxiHost.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.probes = 0
+
+    def probe(self):
+        self.probes += 1
+        return self.host.is_up()
+
+
+def simulate_shutdown(num_vms, logger, host_kwargs=None, **shutdown_kwargs):
+    '''
+    Runs a full Shutdown.shutdown() against a SimulatedEsxiHost of num_vms
+    vms, created with host_kwargs, on a VirtualClock, so that a shutdown that
+    would take minutes completes in a fraction of a second.  The
+    shutdown_kwargs are passed to Shutdown, to try out its poll intervals,
+    timeouts and the like.
+
+    Returns a dict of
+        result: the result of the shutdown
+        seconds: the simulated seconds that the shutdown took
+        wall_seconds: the real seconds that the simulation took
+        commands: a dict of each kind of remote command to the number run
+        num_commands: the total number of remote commands
+        num_forced: the number of vms that were forcefully powered off
+        vm_lateness: the most seconds between a vm powering off and the
+            shutdown seeing that it was off, or None
+        host_lateness: the seconds between the host going down and the
+            shutdown returning, or None if it never went down
+    '''
+    concurrency = shutdown_kwargs.get('vm_command_concurrency') or Shutdown.DEFAULT_VM_COMMAND_CONCURRENCY
+    clock = VirtualClock(concurrency=concurrency)
+    host = SimulatedEsxiHost(num_vms, clock=clock.time, sleep=clock.sleep, **(host_kwargs or {}))
+    shutdown = Shutdown(
+        Namespace(esxihost='esxi.simulated', dryrun=False),
+        logger,
+        transport=host.create_transport(logger),
+        probe=host.create_probe(),
+        clock=clock.time,
+        sleep=clock.sleep,
+        **shutdown_kwargs)
+
+    wall_start_time = time.time()
+    result = shutdown.shutdown()
+    wall_seconds = time.time() - wall_start_time
+
+    metrics = shutdown.metrics
+    vm_lateness = None
+    for vm_id, vm in metrics.vm_poweroff_seconds.items():
+        powered_off_time = host.vms[vm_id].powered_off_time if vm_id in host.vms else None
+        if powered_off_time is None:
+            continue
+        lateness = metrics.vm_issue_times[vm_id] + vm['seconds'] - powered_off_time
+        vm_lateness = lateness if vm_lateness is None else max(vm_lateness, lateness)
+    host_lateness = None
+    if host.poweroff_time is not None and metrics.end_time is not None:
+        host_lateness = metrics.end_time - (host.poweroff_time + host.poweroff_latency)
+
+    return dict(
+        result=result,
+        seconds=metrics.end_time - metrics.start_time,
+        wall_seconds=wall_seconds,
+        commands=dict(host.commands),
+        num_commands=sum(host.commands.values()),
+        num_forced=len(shutdown.forced_vms),
+        vm_lateness=vm_lateness,
+        host_lateness=host_lateness)
@@ -0,0 +1,253 @@
+import time
+import socket
+from esximanager.config import ConfigError, DependencyConfig
+from esximanager.inventory import InventoryError
+from esximanager.pool import run_concurrently
+from esximanager.shutdown import Shutdown
+from esximanager.transport import TransportError
+
+
+class Startup(object):
+    '''
+    Powers the vms of an esxi host back on after a power failure, in
+    parallel, while keeping to the order of the dependencies between them,
+    see esximanager.config.DependencyConfig.
+
+    A vm is powered on as soon as every vm that it depends on is ready,
+    rather than in fixed waves, and at most concurrency vms are booting at
+    any one time so that the boot storm does not saturate the datastores.  A
+    vm is booting from the time that it is powered on until its readiness
+    check passes, which is one of
+
+        power: the vm is powered on, the default
+        heartbeat: vmware tools in the guest report a green heartbeat
+        tcp: a tcp connection can be made to the given host and port
+
+    A vm that is not ready within ready_timeout seconds is given up on, and
+    the vms that depend on it are started anyway.
+    '''
+
+    READY_POWER = 'power'
+    READY_HEARTBEAT = 'heartbeat'
+    READY_TCP = 'tcp'
+    HEARTBEAT_GREEN = 'green'
+
+    STATE_READY = 'ready'
+    STATE_TIMEDOUT = 'timedout'
+    STATE_FAILED = 'failed'
+
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_READY_TIMEOUT = 300
+    DEFAULT_POLL_SECONDS = 1
+    DEFAULT_HOST_TIMEOUT = 600
+    DEFAULT_TCP_TIMEOUT = 1
+
+    def __init__(
+            self,
+            shutdown,
+            logger,
+            config=None,
+            concurrency=None,
+            ready_timeout=None,
+            poll=None,
+            journal=None,
+            sleep=None):
+        '''
+        The esximanager.shutdown.Shutdown for the host is used for its
+        transport and clock and to get the inventory and the power states of
+        the vms.
+
+        If an esximanager.journal.ShutdownJournal is provided, the vms that
+        were running before the last shutdown are the ones started by
+        default.
+        '''
+        self.shutdown = shutdown
+        self.esxihost = shutdown.esxihost
+        self.dryrun = shutdown.dryrun
+        self.logger = logger
+        self.config = config if config is not None else DependencyConfig()
+        self.concurrency = concurrency if concurrency is not None and concurrency > 0 else Startup.DEFAULT_CONCURRENCY
+        if ready_timeout is not None and ready_timeout > 0:
+            self.ready_timeout = ready_timeout
+        else:
+            self.ready_timeout = Startup.DEFAULT_READY_TIMEOUT
+        self.poll = poll if poll is not None and poll > 0 else Startup.DEFAULT_POLL_SECONDS
+        self.journal = journal
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.clock = shutdown.clock
+
+    def fab_power_on_vm(self, vm_id):
+        if self.dryrun:
+            return True
+        return self.shutdown.transport.run(f'vim-cmd vmsvc/power.on {vm_id}').succeeded
+
+    def fab_get_heartbeat(self, vm_id):
+        return self.shutdown.transport.run(f'vim-cmd vmsvc/get.guestheartbeatStatus {vm_id}').stdout.strip()
+
+    def is_tcp_ready(self, host, port):
+        try:
+            with socket.create_connection((host, port), timeout=Startup.DEFAULT_TCP_TIMEOUT):
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def wait_for_host(self, timeout):
+        '''
+        Gets the inventory and power states of the vms, retrying until the
+        host is up after the power has been restored, and returns the same
+        tuple as Shutdown.get_inventory_and_running_vms, or None if the host
+        did not come up within timeout seconds.
+
+        sshd comes up before hostd, which then reports no vms until it has
+        loaded its inventory, so until the inventory can be scanned and has
+        vms in it the host is not ready.
+        '''
+        deadline = self.clock() + timeout
+        while True:
+            try:
+                vms, running_vms = self.shutdown.get_inventory_and_running_vms()
+                if len(vms) > 0:
+                    return vms, running_vms
+                error = 'no vms in the inventory'
+            except TransportError as e:
+                error = e.__cause__
+            except InventoryError as e:
+                error = e
+            if self.clock() >= deadline:
+                self.logger.error(
+                    f'esxihost={self.esxihost} did not come up within [{timeout}] seconds, error={error}')
+                return None
+            self.logger.info(f'Waiting for esxihost={self.esxihost} to come up, error={error}')
+            self.sleep(self.poll)
+
+    def get_vms_to_start(self, vms, names=None):
+        '''
+        Returns a dict of vm name to vm_id of the vms to start: those named,
+        or else those that were running before the last shutdown, or else
+        those in the dependency config.
+        '''
+        if names is None and self.journal is not None:
+            running_vms = self.journal.get_last_running_vms(self.esxihost)
+            if running_vms is not None:
+                names = [name for name in running_vms.values() if name is not None]
+                self.logger.info(f'Starting the [{len(names)}] vms that were running before the last shutdown')
+        if names is None:
+            names = list(self.config.vms)
+
+        vm_ids = {}
+        for vm_id, vm in sorted(vms.items()):
+            if vm.name in vm_ids:
+                self.logger.warning(f'Found more than one vm with name={vm.name}, starting vm_id={vm_ids[vm.name]}')
+            else:
+                vm_ids[vm.name] = vm_id
+        retval = {}
+        for name in names:
+            if name in vm_ids:
+                retval[name] = vm_ids[name]
+            else:
+                self.logger.warning(f'No vm with name={name} on esxihost={self.esxihost}')
+        return retval
+
+    def check_ready(self, name, vm_id):
+        readiness = self.config.get_readiness(name) or {}
+        check = readiness.get('check', Startup.READY_POWER)
+        if check == Startup.READY_HEARTBEAT:
+            return self.fab_get_heartbeat(vm_id) == Startup.HEARTBEAT_GREEN
+        if check == Startup.READY_TCP:
+            return self.is_tcp_ready(readiness['host'], readiness['port'])
+        return True
+
+    def get_ready_vms(self, booting):
+        '''
+        Returns the names of the booting vms, a dict of name to vm_id, that
+        are ready, checking their power states with a single command and
+        their other readiness checks concurrently.
+        '''
+        power_states = self.shutdown.get_vm_power_states(list(booting.values()))
+        powered_on = [name for name, vm_id in booting.items() if power_states.get(vm_id)]
+        outcomes = run_concurrently(lambda name: self.check_ready(name, booting[name]), powered_on, self.concurrency)
+        return [name for name in powered_on if outcomes[name].succeeded and outcomes[name].result]
+
+    def log_plan(self, to_start):
+        for i, wave in enumerate(self.config.get_startup_waves(list(to_start))):
+            self.logger.info(f'Startup wave={i + 1} vms={wave}')
+
+    def start(self, names=None, host_timeout=None):
+        '''
+        Starts the vms, see Startup.get_vms_to_start, and returns a tuple of
+        Shutdown.RESULT_OK if they all became ready, or otherwise
+        Shutdown.RESULT_TIMEDOUT, and a dict of each vm name to a dict of its
+        state and the seconds from the start until it was ready.
+        '''
+        start_time = self.clock()
+        host_timeout = host_timeout if host_timeout is not None else Startup.DEFAULT_HOST_TIMEOUT
+        inventory = self.wait_for_host(host_timeout)
+        if inventory is None:
+            return Shutdown.RESULT_FAILED, {}
+        vms, running_vms = inventory
+
+        to_start = self.get_vms_to_start(vms, names)
+        graph = self.config.get_dependency_graph(list(to_start))
+        try:
+            self.log_plan(to_start)
+        except ConfigError as e:
+            self.logger.error(f'Ignoring the vm dependencies, starting all of the vms unordered, error={e}')
+            graph = {name: set() for name in graph}
+        if self.dryrun:
+            self.logger.info('In dryrun mode, just returning with an OK result')
+            return Shutdown.RESULT_OK, {}
+
+        results = {}
+        pending = set(to_start)
+        # name -> time it was powered on, for the vms that are not yet ready
+        booting = {}
+        # Those already running are only waited on until they are ready
+        for name in sorted(pending):
+            if to_start[name] in running_vms:
+                booting[name] = start_time
+        pending.difference_update(booting)
+
+        while len(pending) > 0 or len(booting) > 0:
+            settled = set(results)
+            slots = self.concurrency - len(booting)
+            eligible = sorted(name for name in pending if graph[name] <= settled)[:max(0, slots)]
+            if len(eligible) > 0:
+                for name in eligible:
+                    for dependency in graph[name]:
+                        if results[dependency]['state'] != Startup.STATE_READY:
+                            self.logger.warning(f'Starting vm={name} although its dependency vm={dependency} is not ready')
+                outcomes = run_concurrently(lambda name: self.fab_power_on_vm(to_start[name]), eligible, self.concurrency)
+                now = self.clock()
+                for name in eligible:
+                    pending.discard(name)
+                    if outcomes[name].succeeded and outcomes[name].result:
+                        self.logger.info(f'Powered on vm={name}, vm_id={to_start[name]}')
+                        booting[name] = now
+                    else:
+                        self.logger.error(f'Unable to power on vm={name}, error={outcomes[name].error}')
+                        results[name] = dict(state=Startup.STATE_FAILED, seconds=None)
+
+            if len(booting) > 0:
+                ready_vms = self.get_ready_vms({name: to_start[name] for name in booting})
+                now = self.clock()
+                for name in ready_vms:
+                    del booting[name]
+                    results[name] = dict(state=Startup.STATE_READY, seconds=round(now - start_time, 3))
+                    self.logger.info(f'vm={name} is ready [{now - start_time:.1f}] seconds after the start')
+                for name, power_on_time in list(booting.items()):
+                    if now - power_on_time > self.ready_timeout:
+                        del booting[name]
+                        results[name] = dict(state=Startup.STATE_TIMEDOUT, seconds=None)
+                        self.logger.error(f'vm={name} was not ready within [{self.ready_timeout}] seconds')
+
+            if len(pending) == 0 and len(booting) == 0:
+                break
+            # Only sleep when we are waiting on a vm to boot, not for a slot
+            if len(eligible) == 0 or len(booting) > 0:
+                self.sleep(self.poll)
+
+        all_ready = all(result['state'] == Startup.STATE_READY for result in results.values())
+        self.logger.info(
+            f'Started [{len(results)}] vms on esxihost={self.esxihost} in [{self.clock() - start_time:.1f}] '
+            f'seconds, all_ready={all_ready}')
+        return (Shutdown.RESULT_OK if all_ready else Shutdown.RESULT_TIMEDOUT), results
@@ -0,0 +1,48 @@
+import json
+import time
+from esximanager.files import get_host_path, write_atomically
+
+
+class StatusCache(object):
+    '''
+    A short-lived on-disk cache, one json file per esxi host, of the status
+    snapshots returned by Shutdown.status, so that the status subcommand can
+    be called often, for example by monitoring, without querying the hosts
+    every time.
+
+    Unlike the InventoryCache, the power states go stale quickly, so the ttl
+    is meant to be seconds rather than hours.
+    '''
+
+    DEFAULT_TTL_SECONDS = 30
+
+    def __init__(self, logger, cache_dir, ttl=None):
+        self.logger = logger
+        self.cache_dir = cache_dir
+        self.ttl = ttl if ttl is not None and ttl > 0 else StatusCache.DEFAULT_TTL_SECONDS
+
+    def get_path(self, host):
+        return get_host_path(self.cache_dir, 'status', host)
+
+    def load(self, host):
+        '''
+        Returns the cached snapshot of the host, or None if there is none, it
+        has expired or it cannot be read.
+        '''
+        path = self.get_path(host)
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            age = time.time() - snapshot['timestamp']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning(f'Ignoring unreadable cached status path={path}, error={e!r}')
+            return None
+        if age > self.ttl or age < 0:
+            return None
+        self.logger.debug('Using cached status for host=%s, age=%.1f', host, age)
+        return snapshot
+
+    def save(self, host, snapshot):
+        write_atomically(self.get_path(host), json.dumps(snapshot))
@@ -0,0 +1,28 @@
+from unittest.mock import Mock
+from argparse import Namespace
+from esximanager.shutdown import Shutdown
+
+MOCK_LOGGER = Mock()
+
+'''
+Polls of the vms and of the host in the tests, so that they run quickly
+against the simulated hosts.
+'''
+TEST_POLL_SECONDS = 0.01
+
+
+def get_shutdown(host, logger=None, dryrun=False, **kwargs):
+    '''
+    Builds a Shutdown that runs against the esximanager.simulator
+    SimulatedEsxiHost, polling every TEST_POLL_SECONDS unless other polls are
+    given in kwargs, which are passed on to Shutdown.
+    '''
+    logger = logger if logger is not None else MOCK_LOGGER
+    kwargs.setdefault('vm_poweroff_poll', TEST_POLL_SECONDS)
+    kwargs.setdefault('esxi_poweroff_poll', TEST_POLL_SECONDS)
+    return Shutdown(
+        Namespace(esxihost='esxi.simulated', dryrun=dryrun),
+        logger,
+        transport=host.create_transport(logger),
+        probe=host.create_probe(),
+        **kwargs)
@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from unittest.mock import Mock
+from esximanager import agentclient
+from esximanager.agent import Agent
+from esximanager.shutdown import Shutdown
+
+MOCK_LOGGER = Mock()
+TEST_ESXI_HOSTS = ['esxi1.example.com', 'esxi2.example.com']
+
+
+def get_mock_shutdown():
+    shutdown = Mock()
+    shutdown.inventory = { 1: {}, 4: {} }
+    shutdown.first_command_time = None
+    shutdown.get_inventory_and_running_vms.return_value = (shutdown.inventory, [4])
+    shutdown.transport.stats.return_value = dict(connections=1, commands=1)
+
+    def shutdown_funct():
+        shutdown.first_command_time = time.time()
+        return Shutdown.RESULT_OK
+
+    shutdown.shutdown.side_effect = shutdown_funct
+    return shutdown
+
+
+class TestAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'agent.sock')
+        self.shutdowns = { host: get_mock_shutdown() for host in TEST_ESXI_HOSTS }
+        self.agent = Agent(self.shutdowns, MOCK_LOGGER, socket_path=self.socket_path, refresh_interval=60)
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.start()
+        deadline = time.time() + 5
+        while not os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.agent.stop()
+        self.thread.join(5)
+        self.tmpdir.cleanup()
+
+    def send(self, command):
+        return list(agentclient.send_command(self.socket_path, command, timeout=5))
+
+    def test_ping(self):
+        self.assertEqual([dict(ok=True)], self.send(agentclient.COMMAND_PING))
+
+    def test_status(self):
+        messages = self.send(agentclient.COMMAND_STATUS)
+        self.assertEqual(1, len(messages))
+        status = messages[0]['status']
+        self.assertEqual(TEST_ESXI_HOSTS, list(status))
+        self.assertEqual(2, status[TEST_ESXI_HOSTS[0]]['num_vms'])
+        self.assertEqual([4], status[TEST_ESXI_HOSTS[0]]['running_vms'])
+
+    def test_shutdown(self):
+        messages = self.send(agentclient.COMMAND_SHUTDOWN)
+        self.assertEqual('accepted', messages[0]['event'])
+        self.assertEqual('done', messages[1]['event'])
+        self.assertTrue(messages[1]['ok'])
+        for host in TEST_ESXI_HOSTS:
+            result = messages[1]['results'][host]
+            self.assertEqual(Shutdown.RESULT_OK, result['result'])
+            self.assertTrue(0 <= result['trigger_to_first_command_seconds'] < 1)
+            self.shutdowns[host].shutdown.assert_called_once_with()
+
+    def test_shutdown_without_budget(self):
+        self.agent.budget_factory = Mock(side_effect=FileNotFoundError('apcaccess'))
+        messages = self.send(agentclient.COMMAND_SHUTDOWN)
+        self.assertTrue(messages[1]['ok'])
+        for host in TEST_ESXI_HOSTS:
+            self.shutdowns[host].shutdown.assert_called_once_with()
+            self.assertIsNone(self.shutdowns[host].budget)
+
+    def test_unknown_command(self):
+        messages = self.send('reboot')
+        self.assertFalse(messages[0]['ok'])
+
+    def test_socket_permissions(self):
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+
+
+class TestAgentClient(unittest.TestCase):
+
+    def test_main_no_agent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with unittest.mock.patch('builtins.print'):
+                retval = agentclient.main(['ping', '--socket', os.path.join(tmpdir, 'missing.sock')])
+        self.assertEqual(2, retval)
@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import Mock
+from esximanager.autostart import AutostartEntry, AutostartManager
+from esximanager.config import DependencyConfig
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, constant
+from esximanager.tests.simulated import get_shutdown
+
+MOCK_LOGGER = Mock()
+
+AUTOSTARTSEQ = [
+    '(vim.host.AutoStartManager.AutoPowerInfo) [',
+    '   (vim.host.AutoStartManager.AutoPowerInfo) {',
+    "      key = 'vim.VirtualMachine:1',",
+    '      startOrder = 1,',
+    '      startDelay = -1,',
+    '      waitForHeartbeat = "systemDefault",',
+    '      startAction = "PowerOn",',
+    '      stopDelay = -1,',
+    '      stopAction = "systemDefault"',
+    '   },',
+    '   (vim.host.AutoStartManager.AutoPowerInfo) {',
+    "      key = 'vim.VirtualMachine:3',",
+    '      startOrder = -1,',
+    '      startDelay = 30,',
+    '      waitForHeartbeat = "yes",',
+    '      startAction = "none",',
+    '      stopDelay = 60,',
+    '      stopAction = "guestShutdown"',
+    '   }',
+    ']',
+    ]
+
+
+class TestAutostartManager(unittest.TestCase):
+
+    def test_parse_autostartseq(self):
+        entries = AutostartManager.parse_autostartseq(AUTOSTARTSEQ)
+        self.assertEqual(
+            {
+                1: AutostartEntry(1, 'PowerOn', -1, 1, 'systemDefault', -1, 'systemDefault'),
+                3: AutostartEntry(3, 'none', 30, -1, 'guestShutdown', 60, 'yes'),
+            },
+            entries)
+        self.assertEqual({}, AutostartManager.parse_autostartseq(['(vim.host.AutoStartManager.AutoPowerInfo) []']))
+
+    def test_get_desired_entries(self):
+        current = AutostartManager.parse_autostartseq(AUTOSTARTSEQ)
+        desired = AutostartManager.get_desired_entries([[1, 2], [3]], {1: 10, 3: 60}, current)
+        # vm 3 is stopped last so it starts first, and the start settings are kept
+        self.assertEqual(AutostartEntry(3, 'none', 30, 1, 'guestShutdown', 60, 'yes'), desired[3])
+        self.assertEqual(AutostartEntry(1, 'PowerOn', -1, 3, 'guestShutdown', 10, 'systemDefault'), desired[1])
+        self.assertEqual(AutostartEntry(2, 'none', -1, 2, 'guestShutdown', -1, 'systemDefault'), desired[2])
+
+    def test_sync_only_pushes_differences(self):
+        transport = Mock()
+        transport.run.return_value = Mock(succeeded=True)
+        manager = AutostartManager(transport, MOCK_LOGGER)
+        current = AutostartManager.parse_autostartseq(AUTOSTARTSEQ)
+        desired = {
+            1: current[1]._replace(stop_action='guestShutdown'),
+            # The host may report the actions in a different case
+            3: current[3]._replace(stop_action='GuestShutdown'),
+            }
+        self.assertEqual(1, manager.sync(desired, current))
+        commands = [c[0][0] for c in transport.run.call_args_list]
+        self.assertEqual(
+            [
+                'vim-cmd hostsvc/autostartmanager/enable_autostart true',
+                'vim-cmd hostsvc/autostartmanager/update_autostartentry 1 PowerOn -1 1 guestShutdown -1 systemDefault',
+            ],
+            commands)
+
+        transport.run.return_value = Mock(succeeded=False)
+        self.assertIsNone(manager.sync(desired, current))
+
+    def test_sync_dryrun(self):
+        transport = Mock()
+        manager = AutostartManager(transport, MOCK_LOGGER, dryrun=True)
+        desired = AutostartManager.get_desired_entries([[1]], {}, {})
+        self.assertEqual(1, manager.sync(desired, {}))
+        transport.run.assert_not_called()
+
+
+class TestShutdownAutostart(unittest.TestCase):
+
+    def test_shutdown(self):
+        '''
+        hostd stops the app vm, vm-1, before the db vm, vm-2, that it depends
+        on, and the client only syncs the autostart manager and powers off the
+        host.
+        '''
+        host = SimulatedEsxiHost(2, shutdown_latency=constant(0.05))
+        config = DependencyConfig(vms={'vm-1': {'depends_on': ['vm-2']}})
+        shutdown = get_shutdown(host, vm_poweroff_timeout=1, dependency_config=config, autostart=True)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual(0, host.commands['power.shutdown'])
+        self.assertEqual(2, host.commands['autostartmanager.update_autostartentry'])
+        self.assertLess(host.vms[1].off_time, host.vms[2].off_time)
+        self.assertEqual(2, shutdown.host_stop_seconds)
+        self.assertFalse(host.is_up())
+
+        # Once synced, a later sync pushes nothing
+        host = SimulatedEsxiHost(2)
+        shutdown = get_shutdown(host, vm_poweroff_timeout=1, dependency_config=config, autostart=True)
+        vms, _ = shutdown.get_inventory_and_running_vms()
+        self.assertEqual(2, len(shutdown.sync_autostart(vms)))
+        shutdown.sync_autostart(vms)
+        self.assertEqual(2, host.commands['autostartmanager.update_autostartentry'])
+        self.assertEqual(2, host.commands['autostartmanager.get_autostartseq'])
+
+    def test_shutdown_falls_back(self):
+        host = SimulatedEsxiHost(2)
+        shutdown = get_shutdown(host, autostart=True)
+        shutdown.autostart.fab_enable_autostart = Mock(return_value=False)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual(2, host.commands['power.shutdown'])
+        self.assertEqual(0, shutdown.host_stop_seconds)
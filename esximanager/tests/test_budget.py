@@ -0,0 +1,48 @@
+import time
+import unittest
+from unittest.mock import patch, Mock
+from esximanager.budget import Budget, BudgetError
+
+APCACCESS_OUTPUT = 'TIMELEFT :  12.5 Minutes\n'
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_deadlines(self):
+        budget = Budget(100, start_time=1000)
+        self.assertAlmostEqual(1060, budget.deadline(Budget.PHASE_GRACEFUL))
+        self.assertAlmostEqual(1080, budget.deadline(Budget.PHASE_FORCED))
+        self.assertAlmostEqual(1100, budget.deadline(Budget.PHASE_HOST))
+
+    def test_deadlines_custom_shares(self):
+        shares = {Budget.PHASE_GRACEFUL: 2, Budget.PHASE_FORCED: 1, Budget.PHASE_HOST: 1}
+        budget = Budget(100, phase_shares=shares, start_time=1000)
+        self.assertAlmostEqual(1050, budget.deadline(Budget.PHASE_GRACEFUL))
+        self.assertAlmostEqual(1075, budget.deadline(Budget.PHASE_FORCED))
+
+    def test_would_overrun(self):
+        budget = Budget(100)
+        self.assertFalse(budget.would_overrun(Budget.PHASE_GRACEFUL, 10))
+        self.assertTrue(budget.would_overrun(Budget.PHASE_GRACEFUL, 70))
+        self.assertFalse(budget.would_overrun(Budget.PHASE_HOST, 70))
+
+    def test_time_left_is_never_negative(self):
+        budget = Budget(10, start_time=time.time() - 20)
+        self.assertEqual(0, budget.time_left(Budget.PHASE_HOST))
+        self.assertTrue(budget.remaining() < 0)
+
+    def test_invalid_budget(self):
+        with self.assertRaises(BudgetError):
+            Budget(0)
+
+    def test_parse_apcupsd_timeleft(self):
+        self.assertAlmostEqual(750, Budget.parse_apcupsd_timeleft(APCACCESS_OUTPUT))
+        self.assertAlmostEqual(180, Budget.parse_apcupsd_timeleft('3 Minutes'))
+        with self.assertRaises(BudgetError):
+            Budget.parse_apcupsd_timeleft('N/A')
+
+    @patch('esximanager.budget.subprocess.run')
+    def test_from_apcupsd(self, mock_run):
+        mock_run.return_value = Mock(returncode=0, stdout=APCACCESS_OUTPUT, stderr='')
+        budget = Budget.from_apcupsd(margin=0.2)
+        self.assertAlmostEqual(600, budget.total_seconds)
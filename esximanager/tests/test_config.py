@@ -0,0 +1,58 @@
+import os
+import json
+import tempfile
+import unittest
+from esximanager.config import ConfigError, DependencyConfig
+
+
+class TestDependencyConfig(unittest.TestCase):
+
+    def get_config(self):
+        return DependencyConfig(
+            vms={
+                'web-1': {'tags': ['app']},
+                'web-2': {'tags': ['app']},
+                'db-1': {'tags': ['db'], 'depends_on': ['nas-1']},
+                'nas-1': {'ready': {'check': 'tcp', 'host': '10.0.0.5', 'port': 2049}},
+                },
+            tags={'app': {'depends_on': ['db']}})
+
+    def test_get_dependency_graph(self):
+        graph = self.get_config().get_dependency_graph(['web-1', 'web-2', 'db-1', 'nas-1', 'other'])
+        self.assertEqual(
+            {'web-1': {'db-1'}, 'web-2': {'db-1'}, 'db-1': {'nas-1'}, 'nas-1': set(), 'other': set()},
+            graph)
+        # Dependencies on vms that are not among the names are ignored
+        self.assertEqual({'web-1': set()}, self.get_config().get_dependency_graph(['web-1']))
+
+    def test_waves(self):
+        config = self.get_config()
+        names = ['web-1', 'web-2', 'db-1', 'nas-1', 'other']
+        self.assertEqual([['nas-1', 'other'], ['db-1'], ['web-1', 'web-2']], config.get_startup_waves(names))
+        # other depends on nothing and nothing depends on it, so it goes first either way
+        self.assertEqual([['other', 'web-1', 'web-2'], ['db-1'], ['nas-1']], config.get_shutdown_waves(names))
+
+    def test_cycle(self):
+        config = DependencyConfig(vms={'a': {'depends_on': ['b']}, 'b': {'depends_on': ['a']}, 'c': {}})
+        with self.assertRaises(ConfigError):
+            config.get_startup_waves(['a', 'b', 'c'])
+
+    def test_get_readiness(self):
+        config = self.get_config()
+        self.assertEqual({'check': 'tcp', 'host': '10.0.0.5', 'port': 2049}, config.get_readiness('nas-1'))
+        self.assertIsNone(config.get_readiness('web-1'))
+        self.assertIsNone(config.get_readiness('other'))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'config.json')
+            with open(path, 'w') as f:
+                json.dump({'vms': {'a': {'depends_on': ['b']}}}, f)
+            self.assertEqual({'a': {'b'}, 'b': set()}, DependencyConfig.load(path).get_dependency_graph(['a', 'b']))
+
+            with open(path, 'w') as f:
+                json.dump({'vms': {'a': {'depends_on': 'b'}}}, f)
+            with self.assertRaises(ConfigError):
+                DependencyConfig.load(path)
+            with self.assertRaises(ConfigError):
+                DependencyConfig.load(os.path.join(tmpdir, 'missing.json'))
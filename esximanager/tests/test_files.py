@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from esximanager.files import get_host_path, get_safe_name, write_atomically
+
+
+class TestFiles(unittest.TestCase):
+
+    def test_get_safe_name(self):
+        self.assertEqual('esxi1.example.com', get_safe_name('esxi1.example.com'))
+        self.assertEqual('root_esxi_1_', get_safe_name('root@esxi/1 '))
+
+    def test_get_host_path(self):
+        self.assertEqual('/tmp/history-esxi_1.json', get_host_path('/tmp', 'history', 'esxi/1'))
+        self.assertEqual('/tmp/journal-esxi1.jsonl', get_host_path('/tmp', 'journal', 'esxi1', extension='.jsonl'))
+
+    def test_write_atomically(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sub', 'file.json')
+            write_atomically(path, 'one')
+            write_atomically(path, 'two')
+            with open(path) as f:
+                self.assertEqual('two', f.read())
+            self.assertEqual(['file.json'], os.listdir(os.path.dirname(path)))
+
+    def test_write_atomically_failure(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'file.json')
+            write_atomically(path, 'one')
+            with patch('esximanager.files.os.replace', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    write_atomically(path, 'two')
+            with open(path) as f:
+                self.assertEqual('one', f.read())
+            self.assertEqual(['file.json'], os.listdir(tmpdir))
@@ -0,0 +1,33 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+from esximanager.fleet import Fleet
+
+MOCK_LOGGER = Mock()
+
+
+class TestFleet(unittest.TestCase):
+
+    def test_get_hosts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            host_file = os.path.join(tmpdir, 'hosts')
+            with open(host_file, 'w') as f:
+                f.write('# rack 1\nesxi2.example.com\n\nesxi3.example.com  # storage\nesxi1.example.com\n')
+
+            actual_result = Fleet.get_hosts(['esxi1.example.com'], host_file)
+        self.assertEqual(
+            ['esxi1.example.com', 'esxi2.example.com', 'esxi3.example.com'],
+            actual_result)
+
+    def test_run(self):
+        hosts = ['esxi1.example.com', 'esxi2.example.com']
+        fleet = Fleet(hosts, MOCK_LOGGER, max_workers=2)
+        outcomes = fleet.run(lambda host: host.upper())
+        self.assertEqual(hosts, list(outcomes))
+        self.assertEqual('ESXI2.EXAMPLE.COM', outcomes['esxi2.example.com'].result)
+
+    def test_defaults(self):
+        fleet = Fleet([], MOCK_LOGGER, max_workers=0, deadline=0)
+        self.assertEqual(Fleet.DEFAULT_MAX_WORKERS, fleet.max_workers)
+        self.assertIsNone(fleet.deadline)
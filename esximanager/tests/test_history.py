@@ -0,0 +1,139 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+from esximanager.history import ShutdownHistory
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, VirtualClock, constant
+from esximanager.tests.simulated import get_shutdown
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+
+
+class TestShutdownHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = ShutdownHistory(MOCK_LOGGER, os.path.join(self.tmpdir.name, 'history'), max_samples=3)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load_missing(self):
+        self.assertEqual(dict(vms={}, host_samples=[]), self.history.load(TEST_ESXI_HOST))
+
+    def test_load_corrupt(self):
+        os.makedirs(self.history.history_dir)
+        with open(self.history.get_path(TEST_ESXI_HOST), 'w') as f:
+            f.write('{"vms": ')
+        self.assertEqual(dict(vms={}, host_samples=[]), self.history.load(TEST_ESXI_HOST))
+
+    def test_record(self):
+        for seconds in [1, 2, 3, 4]:
+            self.history.record(TEST_ESXI_HOST, dict(web=seconds), dict(), host_seconds=seconds * 10)
+        self.history.record(TEST_ESXI_HOST, dict(), dict(windows=60))
+
+        history = self.history.load(TEST_ESXI_HOST)
+        # Only the last max_samples are kept
+        self.assertEqual([2, 3, 4], history['vms']['web']['samples'])
+        self.assertEqual([20, 30, 40], history['host_samples'])
+        self.assertEqual(dict(samples=[], forced_seconds=60), history['vms']['windows'])
+
+        # A graceful shutdown clears the forced time
+        self.history.record(TEST_ESXI_HOST, dict(windows=85), dict())
+        self.assertEqual(
+            dict(samples=[85], forced_seconds=None), self.history.load(TEST_ESXI_HOST)['vms']['windows'])
+
+    def test_get_percentile(self):
+        self.assertIsNone(ShutdownHistory.get_percentile([], 0.95))
+        self.assertEqual(10, ShutdownHistory.get_percentile(list(range(1, 11)), 0.95))
+        self.assertEqual(5, ShutdownHistory.get_percentile(list(range(1, 11)), 0.5))
+
+    def test_get_timeout(self):
+        history = ShutdownHistory(MOCK_LOGGER, self.tmpdir.name, min_timeout=5, max_timeout=120)
+        # Not enough samples
+        self.assertEqual(60, history.get_timeout(dict(samples=[1, 2], forced_seconds=None), 60))
+        self.assertEqual(60, history.get_timeout(None, 60))
+        # p95 * margin, bounded by min_timeout and max_timeout
+        self.assertEqual(6, history.get_timeout(dict(samples=[2, 3, 4], forced_seconds=None), 60))
+        self.assertEqual(5, history.get_timeout(dict(samples=[1, 1, 1], forced_seconds=None), 60))
+        self.assertEqual(120, history.get_timeout(dict(samples=[90, 95, 100], forced_seconds=None), 60))
+        # A vm that was forced off gets more time than it had
+        self.assertEqual(90, history.get_timeout(dict(samples=[], forced_seconds=60), 60))
+        self.assertEqual(90, history.get_timeout(dict(samples=[], forced_seconds=60), None))
+        self.assertIsNone(history.get_timeout(None, None))
+
+
+class TestShutdownWithHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = ShutdownHistory(MOCK_LOGGER, self.tmpdir.name, min_timeout=0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_per_vm_timeouts(self):
+        '''
+        vm-1 has always shut down quickly, so it is forced off when it hangs
+        this time, long before the global timeout.  vm-2 has always needed
+        longer than the global timeout, and is given that long.
+        '''
+        for _ in range(3):
+            self.history.record('esxi.simulated', {'vm-1': 0.02, 'vm-2': 0.3}, dict())
+        host = SimulatedEsxiHost(2)
+        host.vms[1].hung = True
+        host.vms[2].shutdown_latency = 0.3
+        shutdown = get_shutdown(host, history=self.history, vm_poweroff_timeout=0.2)
+
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([1], list(shutdown.forced_vms))
+        self.assertLess(shutdown.forced_vms[1], 0.2)
+        self.assertEqual(1, host.commands['power.off'])
+
+        history = self.history.load('esxi.simulated')
+        self.assertEqual(4, len(history['vms']['vm-2']['samples']))
+        self.assertIsNotNone(history['vms']['vm-1']['forced_seconds'])
+        self.assertEqual(1, len(history['host_samples']))
+
+    def test_per_vm_timeouts_with_host_executor(self):
+        '''
+        The host executor gives each vm its own timeout too: vm-1 is forced
+        off long before the global timeout and vm-2 is given longer than it.
+        '''
+        for _ in range(3):
+            self.history.record('esxi.simulated', {'vm-1': 2, 'vm-2': 100}, dict())
+        clock = VirtualClock()
+        host = SimulatedEsxiHost(2, clock=clock.time, sleep=clock.sleep)
+        host.vms[1].hung = True
+        host.vms[2].shutdown_latency = 100
+        shutdown = get_shutdown(
+            host,
+            history=self.history,
+            vm_poweroff_timeout=60,
+            host_executor=True,
+            clock=clock.time,
+            sleep=clock.sleep)
+
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([1], list(shutdown.forced_vms))
+        self.assertLess(host.vms[1].powered_off_time, 10)
+        self.assertEqual(100, host.vms[2].powered_off_time)
+        self.assertEqual(1, host.local_commands['power.off'])
+
+    def test_plan(self):
+        for _ in range(3):
+            self.history.record('esxi.simulated', {'vm-1': 2, 'vm-2': 30}, dict(), host_seconds=20)
+        host = SimulatedEsxiHost(3, shutdown_latency=constant(0))
+        shutdown = get_shutdown(host, history=self.history, vm_poweroff_timeout=60)
+
+        plan = shutdown.plan()
+        self.assertEqual(
+            [(1, 2, 3.0), (2, 30, 45.0), (3, 60, 60)],
+            [(vm['vm_id'], vm['predicted_seconds'], vm['timeout_seconds']) for vm in plan['vms']])
+        self.assertEqual(60, plan['vms_seconds'])
+        self.assertEqual(20, plan['host_seconds'])
+        self.assertAlmostEqual(80, plan['total_seconds'], places=1)
+        # Nothing was shut down
+        self.assertEqual(3, len(host.running_vms()))
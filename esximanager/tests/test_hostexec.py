@@ -0,0 +1,198 @@
+import os
+import stat
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest.mock import Mock
+from esximanager.hostexec import HostExecutor, ProgressEvent
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, constant
+from esximanager.tests.simulated import get_shutdown
+from esximanager.transport import CommandResult
+from esximanager.transport.base import ConnectionLostError
+from esximanager.transport.fake import FakeTransport
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+
+'''
+Stands in for vim-cmd, keeping the power state of each vm in a file in
+$STATE.  Vms with a .hung file ignore the graceful shutdown.
+'''
+FAKE_VIM_CMD = '''#!/bin/sh
+case "$1" in
+vmsvc/power.getstate)
+    if [ -e "$STATE/$2.off" ]; then echo 'Powered off'; else echo 'Powered on'; fi ;;
+vmsvc/power.shutdown)
+    [ -e "$STATE/$2.hung" ] || touch "$STATE/$2.off" ;;
+vmsvc/power.off)
+    touch "$STATE/$2.off" ;;
+esac
+'''
+
+
+class TestHostExecutor(unittest.TestCase):
+
+    def test_parse_line(self):
+        self.assertEqual(
+            ProgressEvent(1571000000, HostExecutor.EVENT_DONE, ['TIMEDOUT', '4', '5']),
+            HostExecutor.parse_line('EXM 1571000000 done TIMEDOUT 4 5'))
+        self.assertIsNone(HostExecutor.parse_line('sh: vim-cmd: not found'))
+        self.assertIsNone(HostExecutor.parse_line('EXM'))
+
+    def test_get_timeout_arg(self):
+        self.assertEqual(-1, HostExecutor.get_timeout_arg(None))
+        self.assertEqual(-1, HostExecutor.get_timeout_arg(-1))
+        self.assertEqual(3, HostExecutor.get_timeout_arg(2.5))
+
+    def test_follow_resumes_after_connection_loss(self):
+        '''
+        The connection drops after the first two lines, and the follow picks
+        up the log from the third line.
+        '''
+        log = [
+            'EXM 1 start 2',
+            'EXM 1 shutdown 1 ok',
+            'EXM 2 off 1',
+            'EXM 2 done OK',
+            ]
+        commands = []
+        transport = FakeTransport(TEST_ESXI_HOST, MOCK_LOGGER)
+
+        def exec_stream(command, on_line):
+            if len(commands) == 0:
+                commands.append(command)
+                on_line(log[0])
+                on_line(log[1])
+                raise ConnectionLostError() from OSError('Connection reset by peer')
+            commands.append(command)
+            for line in log[int(command.split()[2]) - 1:]:
+                if on_line(line) is False:
+                    return None
+            return 0
+
+        transport._exec_stream = exec_stream
+        executor = HostExecutor(transport, MOCK_LOGGER, sleep=Mock())
+        events = []
+        done = executor.follow(events.append, timeout=10)
+
+        self.assertEqual(ProgressEvent(2, HostExecutor.EVENT_DONE, ['OK']), done)
+        self.assertEqual(4, len(events))
+        self.assertTrue(commands[0].startswith('tail -n +1 -f '))
+        self.assertTrue(commands[1].startswith('tail -n +3 -f '))
+
+    def test_follow_gives_up(self):
+        transport = FakeTransport(TEST_ESXI_HOST, MOCK_LOGGER, responder=lambda command: CommandResult('', 1))
+        executor = HostExecutor(transport, MOCK_LOGGER, follow_attempts=3, sleep=Mock())
+        self.assertIsNone(executor.follow(Mock(), timeout=10))
+        self.assertEqual(3, len(transport.history))
+
+    @unittest.skipIf(shutil.which('tail') is None, 'requires a posix shell and tail')
+    def get_script_transport(self, tmpdir, hung_vms=(), off_vms=()):
+        '''
+        Returns a transport that runs the commands with sh, against a fake
+        vim-cmd that keeps the state of the vms in tmpdir.
+        '''
+        state_dir = os.path.join(tmpdir, 'state')
+        bin_dir = os.path.join(tmpdir, 'bin')
+        os.makedirs(state_dir)
+        os.makedirs(bin_dir)
+        vim_cmd = os.path.join(bin_dir, 'vim-cmd')
+        with open(vim_cmd, 'w') as f:
+            f.write(FAKE_VIM_CMD)
+        os.chmod(vim_cmd, stat.S_IRWXU)
+        for vm_id in hung_vms:
+            open(os.path.join(state_dir, f'{vm_id}.hung'), 'w').close()
+        for vm_id in off_vms:
+            open(os.path.join(state_dir, f'{vm_id}.off'), 'w').close()
+        env = dict(os.environ, PATH=f'{bin_dir}:{os.environ["PATH"]}', STATE=state_dir)
+
+        def responder(command):
+            result = subprocess.run(
+                ['sh', '-c', command], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return CommandResult(result.stdout.decode('utf-8'), result.returncode)
+
+        return FakeTransport(TEST_ESXI_HOST, MOCK_LOGGER, responder=responder)
+
+    def wait_for_script(self, executor):
+        '''
+        Waits for the script to be done and returns all of its events.
+        '''
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            with open(executor.get_log_path()) as f:
+                if ' done ' in f.read():
+                    break
+            time.sleep(0.05)
+
+        events = []
+        executor.follow(events.append, timeout=0.5)
+        return events
+
+    def test_script(self):
+        '''
+        Runs the real script with sh against a fake vim-cmd.  Vm 2 is hung
+        and has to be powered off, and vm 3 is already off.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            transport = self.get_script_transport(tmpdir, hung_vms=[2], off_vms=[3])
+            executor = HostExecutor(transport, MOCK_LOGGER, log_dir=tmpdir, run_id='test')
+            self.assertTrue(executor.launch([1, 2, 3], 0, 0))
+            # Retrying the launch command does not start a second script
+            self.assertTrue(transport.run(executor.get_launch_command([1, 2, 3], 0, 0)).succeeded)
+            self.assertEqual(1, len([name for name in os.listdir(tmpdir) if name.endswith('.log')]))
+
+            events = self.wait_for_script(executor)
+            self.assertEqual(
+                [
+                    (HostExecutor.EVENT_START, ['3']),
+                    (HostExecutor.EVENT_ESCALATE, ['2']),
+                    (HostExecutor.EVENT_POWEROFF, ['2', 'ok']),
+                    (HostExecutor.EVENT_DONE, ['OK']),
+                ],
+                [(e.event, e.args) for e in events if e.event not in ('shutdown', 'off')])
+            self.assertEqual(
+                {'1', '2', '3'},
+                set(e.args[0] for e in events if e.event == HostExecutor.EVENT_OFF))
+
+    def test_script_vm_timeouts(self):
+        '''
+        Vm 2 is hung but has its own timeout of 0, so it is powered off at
+        once rather than after the graceful timeout of the other vms.
+        '''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            transport = self.get_script_transport(tmpdir, hung_vms=[2])
+            executor = HostExecutor(transport, MOCK_LOGGER, log_dir=tmpdir, run_id='test')
+            self.assertIn(' 1 2:0 >>', executor.get_launch_command([1, 2], 30, 5, {2: 0}))
+            self.assertTrue(executor.launch([1, 2], 30, 5, vm_timeouts={2: 0}))
+
+            events = self.wait_for_script(executor)
+            self.assertEqual(['OK'], events[-1].args)
+            self.assertIn((HostExecutor.EVENT_ESCALATE, ['2']), [(e.event, e.args) for e in events])
+            self.assertLess(events[-1].timestamp - events[0].timestamp, 10)
+
+
+class TestShutdownWithHostExecutor(unittest.TestCase):
+
+    def test_shutdown(self):
+        '''
+        A full shutdown against a simulated host, in which the vms are only
+        polled on the host and the hung vm is powered off there too.
+        '''
+        host = SimulatedEsxiHost(20, shutdown_latency=constant(0.02), hung_fraction=0.1, seed=3)
+        hung_vms = [vm.vm_id for vm in host.vms.values() if vm.hung]
+        self.assertTrue(len(hung_vms) > 0)
+        shutdown = get_shutdown(host, vm_poweroff_timeout=1, host_executor=True)
+        shutdown.host_executor.poll = 0.01
+
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([], host.running_vms())
+        self.assertEqual(len(hung_vms), host.local_commands['power.off'])
+        self.assertEqual(1, host.commands['hostexec.launch'])
+        self.assertEqual(1, host.commands['hostexec.follow'])
+        # No vm was shut down or polled over the network
+        self.assertEqual(0, host.commands['power.shutdown'] + host.commands['power.getstate'])
+        self.assertEqual(1, host.commands['power.getstate.batched'])
+        self.assertEqual(20, len(shutdown.metrics.vm_poweroff_seconds))
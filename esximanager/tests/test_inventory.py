@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from unittest.mock import Mock
+from esximanager.inventory import InventoryCache, VmRecord
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+VMS = {
+    1: VmRecord('R10_V4_Base', '[ds-500gb]', 'R10_V4_Base/R10_V4_Base.vmx', 'centos7_64Guest', 'vmx-14', ''),
+    4: VmRecord('load_balancer', '[ds 1]', 'load_balancer/load_balancer.vmx', 'centos7_64Guest', 'vmx-14', 'haproxy'),
+    }
+
+
+class TestInventoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = InventoryCache(MOCK_LOGGER, cache_dir=os.path.join(self.tmpdir.name, 'cache'), ttl=60)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_and_load(self):
+        self.cache.save(TEST_ESXI_HOST, VMS)
+        self.assertDictEqual(VMS, self.cache.load(TEST_ESXI_HOST))
+        self.assertEqual([os.path.basename(self.cache.get_path(TEST_ESXI_HOST))], os.listdir(self.cache.cache_dir))
+
+    def test_load_missing(self):
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+
+    def test_load_expired(self):
+        self.cache.save(TEST_ESXI_HOST, VMS)
+        path = self.cache.get_path(TEST_ESXI_HOST)
+        with open(path) as f:
+            entry = json.load(f)
+        entry['timestamp'] = time.time() - 120
+        with open(path, 'w') as f:
+            json.dump(entry, f)
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+
+    def test_load_corrupt(self):
+        os.makedirs(self.cache.cache_dir)
+        with open(self.cache.get_path(TEST_ESXI_HOST), 'w') as f:
+            f.write('{"timestamp": ')
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+
+    def test_load_old_version(self):
+        os.makedirs(self.cache.cache_dir)
+        with open(self.cache.get_path(TEST_ESXI_HOST), 'w') as f:
+            json.dump(dict(timestamp=time.time(), vms={'1': dict(name='R10_V4_Base')}), f)
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+
+    def test_invalidate(self):
+        self.cache.save(TEST_ESXI_HOST, VMS)
+        self.cache.invalidate(TEST_ESXI_HOST)
+        self.cache.invalidate(TEST_ESXI_HOST)
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
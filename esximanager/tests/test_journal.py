@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from esximanager.budget import Budget
+from esximanager.journal import ShutdownJournal
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost
+from esximanager.tests.simulated import get_shutdown
+
+TEST_ESXI_HOST = 'esxi.simulated'
+MOCK_LOGGER = Mock()
+
+
+class TestShutdownJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal = ShutdownJournal(MOCK_LOGGER, os.path.join(self.tmpdir.name, 'journal'))
+
+    def tearDown(self):
+        self.journal.close(TEST_ESXI_HOST)
+        self.tmpdir.cleanup()
+
+    def write_journal(self, records, start_time=None):
+        self.journal.start(TEST_ESXI_HOST)
+        for event, fields in records:
+            self.journal.write(TEST_ESXI_HOST, event, **fields)
+        self.journal.close(TEST_ESXI_HOST)
+        if start_time is not None:
+            records = self.journal.read(TEST_ESXI_HOST)
+            records[0]['time'] = start_time
+            with open(self.journal.get_path(TEST_ESXI_HOST), 'w') as f:
+                f.write(''.join(json.dumps(record) + '\n' for record in records))
+
+    def test_get_resume_state(self):
+        self.write_journal([
+            (ShutdownJournal.EVENT_PHASE, dict(phase=Budget.PHASE_GRACEFUL)),
+            (ShutdownJournal.EVENT_RUNNING_VMS, dict(vms={'1': 'web', '2': 'db'})),
+            (ShutdownJournal.EVENT_SHUTDOWN_ISSUED, dict(vm_ids=[1, 2])),
+            (ShutdownJournal.EVENT_VMS_OFF, dict(vm_ids=[1])),
+            (ShutdownJournal.EVENT_PHASE, dict(phase=Budget.PHASE_FORCED)),
+            ])
+        # A torn last line is ignored
+        with open(self.journal.get_path(TEST_ESXI_HOST), 'a') as f:
+            f.write('{"time": 1, "ev')
+
+        self.assertEqual(
+            dict(
+                phase=Budget.PHASE_FORCED,
+                running_vms={1: 'web', 2: 'db'},
+                vms_off={1},
+                shutdown_issued={1, 2},
+                poweroff_issued=set(),
+                host_poweroff_issued=False),
+            self.journal.get_resume_state(TEST_ESXI_HOST))
+
+    def test_get_resume_state_nothing_to_resume(self):
+        self.assertIsNone(self.journal.get_resume_state(TEST_ESXI_HOST))
+        self.write_journal([(ShutdownJournal.EVENT_DONE, dict(result=Shutdown.RESULT_OK))])
+        self.assertIsNone(self.journal.get_resume_state(TEST_ESXI_HOST))
+        self.write_journal([], start_time=time.time() - 2 * ShutdownJournal.DEFAULT_MAX_AGE_SECONDS)
+        self.assertIsNone(self.journal.get_resume_state(TEST_ESXI_HOST))
+
+    def test_get_last_running_vms(self):
+        self.assertIsNone(self.journal.get_last_running_vms(TEST_ESXI_HOST))
+        self.write_journal([
+            (ShutdownJournal.EVENT_RUNNING_VMS, dict(vms={'1': 'web', '2': 'db'})),
+            (ShutdownJournal.EVENT_DONE, dict(result=Shutdown.RESULT_OK)),
+            ])
+        self.assertEqual({1: 'web', 2: 'db'}, self.journal.get_last_running_vms(TEST_ESXI_HOST))
+
+
+class TestShutdownResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journal = ShutdownJournal(MOCK_LOGGER, self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_interrupted_journal(self, vms_off):
+        self.journal.start(TEST_ESXI_HOST)
+        self.journal.write(TEST_ESXI_HOST, ShutdownJournal.EVENT_PHASE, phase=Budget.PHASE_GRACEFUL)
+        self.journal.write(
+            TEST_ESXI_HOST, ShutdownJournal.EVENT_RUNNING_VMS, vms={'1': 'vm-1', '2': 'vm-2', '3': 'vm-3'})
+        self.journal.write(TEST_ESXI_HOST, ShutdownJournal.EVENT_SHUTDOWN_ISSUED, vm_ids=[1, 2, 3])
+        self.journal.write(TEST_ESXI_HOST, ShutdownJournal.EVENT_VMS_OFF, vm_ids=vms_off)
+        self.journal.close(TEST_ESXI_HOST)
+
+    def test_shutdown_journals_progress(self):
+        host = SimulatedEsxiHost(2)
+        self.assertEqual(Shutdown.RESULT_OK, get_shutdown(host, journal=self.journal).shutdown())
+        events = [record['event'] for record in self.journal.read(TEST_ESXI_HOST)]
+        self.assertEqual(ShutdownJournal.EVENT_START, events[0])
+        self.assertIn(ShutdownJournal.EVENT_SHUTDOWN_ISSUED, events)
+        self.assertIn(ShutdownJournal.EVENT_HOST_POWEROFF_ISSUED, events)
+        self.assertEqual(ShutdownJournal.EVENT_DONE, events[-1])
+        # So the next shutdown starts afresh
+        self.assertIsNone(self.journal.get_resume_state(TEST_ESXI_HOST))
+
+    def test_shutdown_without_journal(self):
+        host = SimulatedEsxiHost(2)
+        shutdown = get_shutdown(host, journal=self.journal)
+        with patch.object(self.journal, 'start', side_effect=PermissionError('read-only')):
+            self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertIsNone(shutdown.journal)
+        self.assertEqual(2, host.commands['power.shutdown'])
+
+    def test_resume(self):
+        '''
+        vm-1 was seen off before we were interrupted, vm-2 has since shut down
+        and vm-3 is still shutting down.  Only vm-2 and vm-3 are checked, and
+        no shutdown is issued again.
+        '''
+        self.write_interrupted_journal([1])
+        host = SimulatedEsxiHost(3)
+        host.vms[1].powered_on = False
+        host.vms[2].powered_on = False
+        host.vms[3].off_time = time.time() + 0.05
+
+        shutdown = get_shutdown(host, journal=self.journal)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual(0, host.commands['getallvms'])
+        self.assertEqual(0, host.commands['power.shutdown'])
+        self.assertEqual('vm-3', shutdown.get_vm_name(3))
+        self.assertEqual(ShutdownJournal.EVENT_DONE, self.journal.read(TEST_ESXI_HOST)[-1]['event'])
+
+    def test_resume_all_vms_off(self):
+        self.write_interrupted_journal([1, 2, 3])
+        host = SimulatedEsxiHost(3, powered_off_fraction=1)
+
+        self.assertEqual(Shutdown.RESULT_OK, get_shutdown(host, journal=self.journal).shutdown())
+        self.assertEqual(0, host.commands['getallvms'] + host.commands['power.shutdown'])
+        # All of the journaled vms are checked with a single command
+        self.assertEqual(1, host.commands['power.getstate.batched'])
+        self.assertEqual(1, host.commands['poweroff'])
+
+    def test_resume_after_host_restarted(self):
+        '''
+        The host poweroff was issued, but the host has since come back up and
+        vm-2 is running again, so it is shut down before the host is powered
+        off again.
+        '''
+        self.write_interrupted_journal([1, 2, 3])
+        self.journal.resume(TEST_ESXI_HOST)
+        self.journal.write(TEST_ESXI_HOST, ShutdownJournal.EVENT_HOST_POWEROFF_ISSUED)
+        self.journal.close(TEST_ESXI_HOST)
+        host = SimulatedEsxiHost(3)
+        host.vms[1].powered_on = False
+        host.vms[3].powered_on = False
+
+        self.assertEqual(Shutdown.RESULT_OK, get_shutdown(host, journal=self.journal).shutdown())
+        self.assertEqual(1, host.commands['power.shutdown'])
+        self.assertEqual(0, host.commands['power.off'])
+        self.assertIsNotNone(host.vms[2].powered_off_time)
+        self.assertLessEqual(host.vms[2].powered_off_time, host.poweroff_time)
+
+    def test_resume_with_unjournaled_vm(self):
+        '''
+        The host rebooted partway through the shutdown and autostarted vm-4,
+        which is not in the journal, so it is shut down gracefully along with
+        the journaled vm-3 before the host is powered off.
+        '''
+        self.write_interrupted_journal([1, 2])
+        host = SimulatedEsxiHost(4)
+        host.vms[1].powered_on = False
+        host.vms[2].powered_on = False
+        host.vms[3].off_time = time.time() + 0.05
+
+        shutdown = get_shutdown(host, journal=self.journal)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        # vm-3 was already issued its shutdown
+        self.assertEqual(1, host.commands['power.shutdown'])
+        self.assertEqual(0, host.commands['power.off'])
+        self.assertLessEqual(host.vms[4].powered_off_time, host.poweroff_time)
+        self.assertEqual('vm-4', shutdown.get_vm_name(4))
+        self.assertEqual({1: 'vm-1', 2: 'vm-2', 3: 'vm-3', 4: 'vm-4'},
+                         self.journal.get_last_running_vms(TEST_ESXI_HOST))
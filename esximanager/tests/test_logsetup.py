@@ -0,0 +1,84 @@
+import io
+import json
+import logging
+import threading
+import unittest
+from esximanager.logsetup import AsyncLogging
+
+
+class ThreadRecordingStream(io.StringIO):
+
+    def __init__(self, block=None):
+        super().__init__()
+        self.threads = set()
+        self.block = block
+
+    def write(self, s):
+        if self.block is not None:
+            self.block.wait()
+        self.threads.add(threading.current_thread())
+        return super().write(s)
+
+
+class Lazy(object):
+    '''
+    Records the thread that formats it.
+    '''
+
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return 'lazy'
+
+
+class TestAsyncLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('esximanager.tests.logsetup')
+        root = logging.getLogger()
+        saved = (list(root.handlers), root.level)
+
+        def restore():
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in saved[0]:
+                root.addHandler(handler)
+            root.setLevel(saved[1])
+        self.addCleanup(restore)
+
+    def test_writes_from_background_thread(self):
+        stream = ThreadRecordingStream()
+        async_logging = AsyncLogging('INFO', stream=stream).start()
+        lazy = Lazy()
+        self.logger.info('value=%s', lazy)
+        self.logger.debug('Not written')
+        async_logging.stop()
+
+        self.assertIn(',INFO,test_logsetup,value=lazy\n', stream.getvalue())
+        self.assertNotIn('Not written', stream.getvalue())
+        self.assertNotIn(threading.current_thread(), stream.threads)
+        # The message was formatted by the writer, not the caller
+        self.assertIsNot(threading.current_thread(), lazy.thread)
+
+    def test_json(self):
+        stream = io.StringIO()
+        async_logging = AsyncLogging('INFO', json_format=True, stream=stream).start()
+        self.logger.warning('host=%s', 'esxi')
+        async_logging.stop()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual('WARNING', entry['level'])
+        self.assertEqual('host=esxi', entry['message'])
+
+    def test_drops_rather_than_blocks(self):
+        block = threading.Event()
+        stream = ThreadRecordingStream(block)
+        async_logging = AsyncLogging('INFO', stream=stream, max_queue=1).start()
+        for i in range(10):
+            self.logger.info('record=%d', i)
+        dropped = async_logging.queue_handler.dropped
+        self.assertGreater(dropped, 0)
+        block.set()
+        async_logging.stop()
+        self.assertIn(f'Dropped [{dropped}] log records', stream.getvalue())
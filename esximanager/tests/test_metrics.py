@@ -0,0 +1,108 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import Mock
+from esximanager import metrics
+from esximanager.metrics import RunMetrics
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, constant
+from esximanager.tests.simulated import get_shutdown
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def test_get_command_kind(self):
+        self.assertEqual('getallvms', RunMetrics.get_command_kind('vim-cmd vmsvc/getallvms'))
+        self.assertEqual('power.shutdown', RunMetrics.get_command_kind('vim-cmd vmsvc/power.shutdown 4'))
+        self.assertEqual(
+            'power.getstate.batched',
+            RunMetrics.get_command_kind(
+                'for id in 1 2; do echo "__esximanager_vmid__ $id"; vim-cmd vmsvc/power.getstate $id 2>&1; done'))
+        self.assertEqual('poweroff', RunMetrics.get_command_kind('poweroff'))
+
+    def test_record(self):
+        run = RunMetrics(TEST_ESXI_HOST)
+        run.start()
+        with run.phase(RunMetrics.PHASE_GRACEFUL_WAIT):
+            run.record_command('vim-cmd vmsvc/power.shutdown 1', 0.5, True)
+            run.record_command('vim-cmd vmsvc/power.shutdown 2', 0.25, False)
+            run.record_sleep(2)
+        run.record_vms_issued([1, 2])
+        run.record_vm_off(1, 'web')
+        # Only the first time that a vm is seen off counts
+        run.record_vm_off(1, 'web')
+        # Nor are vms for which no command was issued
+        run.record_vm_off(3, 'db')
+        run.finish(Shutdown.RESULT_OK)
+
+        data = run.to_dict()
+        self.assertEqual(dict(count=2, failures=1, seconds=0.75), data['commands']['power.shutdown'])
+        self.assertEqual(2, data['remote_commands'])
+        self.assertEqual(2, data['sleep_seconds'])
+        self.assertEqual([RunMetrics.PHASE_GRACEFUL_WAIT], list(data['phase_seconds']))
+        self.assertEqual(['1'], list(data['vm_poweroff_seconds']))
+        self.assertEqual('web', data['vm_poweroff_seconds']['1']['name'])
+        self.assertGreaterEqual(data['duration_seconds'], 0)
+
+    def test_format_prometheus(self):
+        run = RunMetrics('esxi"1')
+        run.start()
+        with run.phase(RunMetrics.PHASE_INVENTORY):
+            run.record_command('vim-cmd vmsvc/getallvms', 0.1, True)
+        run.finish(Shutdown.RESULT_TIMEDOUT)
+
+        text = metrics.format_prometheus([run])
+        self.assertIn('# TYPE esximanager_shutdown_phase_seconds gauge\n', text)
+        self.assertIn('esximanager_shutdown_success{host="esxi\\"1"} 0\n', text)
+        self.assertIn('esximanager_shutdown_remote_commands{host="esxi\\"1",command="getallvms"} 1\n', text)
+        # No vm was powered off, so the metric is left out entirely
+        self.assertNotIn('esximanager_shutdown_vm_poweroff_seconds', text)
+
+        run.record_wave(1, ['web'], run.start_time)
+        text = metrics.format_prometheus([run])
+        self.assertIn('esximanager_shutdown_wave_seconds{host="esxi\\"1",wave="1"} ', text)
+
+    def test_write_reports(self):
+        run = RunMetrics(TEST_ESXI_HOST)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, 'report.json')
+            metrics.write_json_report(json_path, [run])
+            with open(json_path) as f:
+                self.assertEqual(TEST_ESXI_HOST, json.load(f)['hosts'][0]['host'])
+
+            prom_path = os.path.join(tmpdir, 'textfile', 'esximanager.prom')
+            metrics.write_prometheus_textfile(prom_path, [run])
+            self.assertEqual(['esximanager.prom'], os.listdir(os.path.dirname(prom_path)))
+
+    def test_shutdown_metrics(self):
+        '''
+        A full shutdown against a simulated host records every phase, the
+        commands that it ran and when each vm was seen powered off.
+        '''
+        host = SimulatedEsxiHost(6, shutdown_latency=constant(0.02), hung_fraction=0.2, seed=3)
+        shutdown = get_shutdown(host, vm_poweroff_timeout=0.2)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+
+        data = shutdown.metrics.to_dict()
+        self.assertEqual(Shutdown.RESULT_OK, data['result'])
+        self.assertEqual(
+            {
+                RunMetrics.PHASE_INVENTORY,
+                RunMetrics.PHASE_GRACEFUL_SHUTDOWN,
+                RunMetrics.PHASE_GRACEFUL_WAIT,
+                RunMetrics.PHASE_FORCED_POWEROFF,
+                RunMetrics.PHASE_FORCED_WAIT,
+                RunMetrics.PHASE_HOST_POWEROFF,
+                RunMetrics.PHASE_HOST_WAIT,
+            },
+            set(data['phase_seconds']))
+        self.assertEqual(host.commands['getallvms'], data['commands']['getallvms']['count'])
+        self.assertEqual(host.commands['power.shutdown'], data['commands']['power.shutdown']['count'])
+        self.assertGreater(data['commands']['probe']['count'], 0)
+        self.assertGreater(data['sleep_seconds'], 0)
+        self.assertEqual(6, len(data['vm_poweroff_seconds']))
+        self.assertEqual('vm-1', data['vm_poweroff_seconds']['1']['name'])
@@ -0,0 +1,42 @@
+import unittest
+from esximanager.poll import PollScheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_backoff(self):
+        scheduler = PollScheduler([1, 2], 1, 4, backoff=2, start_time=100, coalesce=0)
+        self.assertEqual([1, 2], scheduler.due(100))
+
+        scheduler.reschedule(1, 100)
+        scheduler.reschedule(2, 100)
+        self.assertEqual(102, scheduler.next_due_time())
+        self.assertEqual([], scheduler.due(101))
+        self.assertEqual(1, scheduler.sleep_time(101))
+
+        scheduler.reschedule(1, 102)
+        scheduler.reschedule(1, 106)
+        scheduler.reschedule(1, 110)
+        # Capped at the max interval
+        self.assertEqual(114, scheduler.schedule[1][0])
+
+    def test_remove(self):
+        scheduler = PollScheduler([1, 2], 1, 4, start_time=100)
+        scheduler.remove(1)
+        scheduler.remove(3)
+        self.assertEqual([2], scheduler.items())
+        self.assertNotIn(1, scheduler)
+        scheduler.remove(2)
+        self.assertEqual(0, len(scheduler))
+        self.assertIsNone(scheduler.next_due_time())
+        self.assertEqual(0, scheduler.sleep_time())
+
+    def test_coalesce(self):
+        scheduler = PollScheduler([1], 1, 4, backoff=2, start_time=100, coalesce=0.5)
+        scheduler.add(2, 100.4)
+        scheduler.add(3, 101)
+        self.assertEqual([1, 2], scheduler.due(100))
+
+    def test_min_interval_is_bounded_by_max(self):
+        scheduler = PollScheduler([1], 5, 2)
+        self.assertEqual(2, scheduler.min_interval)
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import threading
+import unittest
+import subprocess
+import esximanager
+from esximanager.pool import run_concurrently, PoolTimeoutError
+
+
+class TestPool(unittest.TestCase):
+
+    def test_run_concurrently(self):
+        def funct(item):
+            if item == 3:
+                raise ValueError('bad item')
+            return item * 2
+
+        outcomes = run_concurrently(funct, [1, 2, 3], 2)
+        self.assertEqual([1, 2, 3], list(outcomes))
+        self.assertEqual(2, outcomes[1].result)
+        self.assertEqual(4, outcomes[2].result)
+        self.assertFalse(outcomes[3].succeeded)
+        self.assertIsInstance(outcomes[3].error, ValueError)
+
+    def test_run_concurrently_no_items(self):
+        self.assertDictEqual({}, run_concurrently(lambda item: item, [], 2))
+
+    def test_run_concurrently_is_bounded(self):
+        lock = threading.Lock()
+        active = []
+        max_active = []
+
+        def funct(item):
+            with lock:
+                active.append(item)
+                max_active.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(item)
+
+        run_concurrently(funct, range(10), 3)
+        self.assertEqual(3, max(max_active))
+
+    def test_run_concurrently_timeout(self):
+        event = threading.Event()
+
+        def funct(item):
+            if item == 2:
+                event.wait(1)
+            return item
+
+        outcomes = run_concurrently(funct, [1, 2], 2, timeout=0.05)
+        event.set()
+        self.assertEqual(1, outcomes[1].result)
+        self.assertIsInstance(outcomes[2].error, PoolTimeoutError)
+
+    def test_run_concurrently_timeout_skips_pending(self):
+        event = threading.Event()
+        called = []
+
+        def funct(item):
+            called.append(item)
+            event.wait(1)
+            return item
+
+        outcomes = run_concurrently(funct, [1, 2], 1, timeout=0.05)
+        event.set()
+        time.sleep(0.05)
+        self.assertIsInstance(outcomes[1].error, PoolTimeoutError)
+        self.assertIsInstance(outcomes[2].error, PoolTimeoutError)
+        self.assertEqual([1], called)
+
+    def test_run_concurrently_timeout_does_not_hold_up_exit(self):
+        script = (
+            'import time\n'
+            'from esximanager.pool import run_concurrently\n'
+            'run_concurrently(lambda item: time.sleep(30), [1, 2], 2, timeout=0.05)\n')
+        start_time = time.time()
+        subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(esximanager.__file__))),
+            check=True,
+            timeout=20)
+        self.assertLess(time.time() - start_time, 10)
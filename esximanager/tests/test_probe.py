@@ -0,0 +1,67 @@
+import socket
+import unittest
+from unittest.mock import patch, Mock
+from esximanager.probe import HostProbe
+
+MOCK_LOGGER = Mock()
+
+'''
+Reserved for documentation, RFC 5737, so nothing should ever answer.
+'''
+UNREACHABLE_HOST = '192.0.2.1'
+
+
+class TestHostProbe(unittest.TestCase):
+
+    def test_tcp_check_listening(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        try:
+            probe = HostProbe('127.0.0.1', MOCK_LOGGER)
+            self.assertTrue(probe.tcp_check(listener.getsockname()[1]))
+        finally:
+            listener.close()
+
+    def test_tcp_check_refused(self):
+        '''
+        A refused connection means that the host is still up.
+        '''
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        probe = HostProbe('127.0.0.1', MOCK_LOGGER)
+        self.assertTrue(probe.tcp_check(port))
+
+    @patch('esximanager.probe.socket.create_connection')
+    def test_tcp_check_unreachable(self, mock_create_connection):
+        mock_create_connection.side_effect = socket.timeout()
+        probe = HostProbe(UNREACHABLE_HOST, MOCK_LOGGER, timeout=0.05)
+        self.assertFalse(probe.tcp_check(443))
+
+    def test_checksum(self):
+        header = bytes([8, 0, 0, 0, 0, 1, 0, 1])
+        checksum = HostProbe.checksum(header)
+        packet = header[:2] + checksum.to_bytes(2, 'big') + header[4:]
+        self.assertEqual(0, HostProbe.checksum(packet))
+
+    @patch('esximanager.probe.HostProbe.icmp_check')
+    @patch('esximanager.probe.HostProbe.tcp_check')
+    def test_probe_consecutive_misses(self, mock_tcp_check, mock_icmp_check):
+        mock_icmp_check.return_value = None
+        mock_tcp_check.side_effect = lambda port: port == 443 and answers.pop(0)
+        answers = [True, False, True, False, False]
+
+        probe = HostProbe(UNREACHABLE_HOST, MOCK_LOGGER, ports=(22, 443), misses=2)
+        self.assertEqual([True, True, True, True, False], [probe.probe() for _ in range(5)])
+
+    @patch('esximanager.probe.HostProbe.tcp_check')
+    def test_is_alive_icmp_only(self, mock_tcp_check):
+        mock_tcp_check.return_value = False
+        probe = HostProbe(UNREACHABLE_HOST, MOCK_LOGGER)
+        with patch.object(probe, 'icmp_check', return_value=True):
+            self.assertTrue(probe.is_alive())
+        probe.use_icmp = False
+        self.assertFalse(probe.is_alive())
@@ -1,11 +1,19 @@
+import time
+import threading
 import unittest
 from unittest.mock import patch, Mock
+from esximanager.budget import Budget
+from esximanager.inventory import InventoryError, VmRecord
+from esximanager.transport import CommandResult, TransportError
+from esximanager.transport.fake import FakeTransport
 from esximanager.shutdown import Shutdown
+from esximanager.simulator import VirtualClock
 from esximanager.tests.dotteddict import DottedDict
 
 TEST_ESXI_HOST = 'esxi.example.com'
 MOCK_LOGGER = Mock()
 MOCK_LOGGER.info = Mock(side_effect=None)
+GETALLVMS_LOGIN_FAILED = 'Failed to login: vim.fault.HostConnectFault\n'
 GETALLVMS_HDR = 'Vmid      Name                        File                       Guest OS       Version   Annotation'
 
 POWER_GETSTATE_ERR = [
@@ -17,27 +25,36 @@ POWER_GETSTATE_ERR = [
     ]
 POWER_GETSTATE_ON = [ 'Retrieved runtime info', 'Powered on' ]
 POWER_GETSTATE_OFF = [ 'Retrieved runtime info', 'Powered off' ]
+POWER_GETSTATES = (
+    [ f'{Shutdown.POWER_GETSTATE_MARKER} 1' ] + POWER_GETSTATE_ON +
+    [ f'{Shutdown.POWER_GETSTATE_MARKER} 2' ] + POWER_GETSTATE_ERR +
+    [ f'{Shutdown.POWER_GETSTATE_MARKER} 4' ] + POWER_GETSTATE_OFF +
+    [ f'{Shutdown.POWER_GETSTATE_MARKER} 5' ] + POWER_GETSTATE_ON
+    )
 
-VM_1 = dict(
+VM_1 = VmRecord(
     name='R10_V4_Base',
     datastore='[ds-500gb]',
     file='R10_V4_Base/R10_V4_Base.vmx',
     guest_os='centos7_64Guest',
     version='vmx-14',
+    annotation='',
     )
-VM_4 = dict(
+VM_4 = VmRecord(
     name='load_balancer',
     datastore='[ds-500gb]',
     file='load_balancer/load_balancer.vmx',
     guest_os='centos7_64Guest',
     version='vmx-14',
+    annotation='',
     )
-VM_5 = dict(
+VM_5 = VmRecord(
     name='web_server',
     datastore='[ds-500gb]',
     file='web_server/web_server.vmx',
     guest_os='centos7_64Guest',
     version='vmx-14',
+    annotation='',
     )
 
 class Testshutdown(unittest.TestCase):
@@ -65,6 +82,54 @@ class Testshutdown(unittest.TestCase):
         expected_result = { 1: VM_1, 4: VM_4, 5: VM_5 }
         self.exec_get_all_vms_test(getallvms_mock_result, expected_result)
 
+    def test_get_all_vms_spaces_and_annotations(self):
+        '''
+        Names, datastores and files with spaces, an annotation that runs over
+        several lines and a vm that the host could not load.
+        '''
+        getallvms_mock_result = [
+            GETALLVMS_HDR,
+            '1      R10 V4 Base   [datastore 1] R10 V4 Base/R10 V4 Base.vmx   centos7_64Guest   vmx-14    Base image',
+            'Skipping invalid VM \'3\'',
+            '4      load_balancer   [ds-500gb] load_balancer/load_balancer.vmx   centos7_64Guest   vmx-14    haproxy',
+            'restart the web_servers first',
+            '5      web_server   [ds-500gb] web_server/web_server.vmx   centos7_64Guest   vmx-14',
+            ]
+        expected_result = {
+            1: VM_1._replace(
+                name='R10 V4 Base',
+                datastore='[datastore 1]',
+                file='R10 V4 Base/R10 V4 Base.vmx',
+                annotation='Base image'),
+            4: VM_4._replace(annotation='haproxy\nrestart the web_servers first'),
+            5: VM_5,
+            }
+        self.exec_get_all_vms_test(getallvms_mock_result, expected_result)
+
+    def test_get_all_vms_header_columns(self):
+        '''
+        A version that does not look like vmx-NN is parsed from the column
+        offsets of the header.
+        '''
+        row = '{:<7}{:<16}{:<40}{:<18}{:<10}{}'
+        getallvms_mock_result = [
+            row.format('Vmid', 'Name', 'File', 'Guest OS', 'Version', 'Annotation'),
+            row.format('1', 'R10_V4_Base', '[ds-500gb] R10_V4_Base/R10_V4_Base.vmx', 'centos7_64Guest', '14', ''),
+            ]
+        expected_result = { 1: VM_1._replace(version='14') }
+        self.exec_get_all_vms_test(getallvms_mock_result, expected_result)
+
+    @patch('esximanager.shutdown.Shutdown.fab_get_all_vms')
+    def test_get_all_vms_no_header(self, mock_fab_get_all_vms):
+        mock_fab_get_all_vms.return_value = []
+        self.assertRaises(InventoryError, self.get_default_out().get_all_vms)
+
+    def test_get_all_vms_failed(self):
+        shutdown = self.get_default_out()
+        shutdown.transport = FakeTransport(
+            TEST_ESXI_HOST, MOCK_LOGGER, responder=lambda command: CommandResult(GETALLVMS_LOGIN_FAILED, 1))
+        self.assertRaises(InventoryError, shutdown.get_all_vms)
+
     @patch('esximanager.shutdown.Shutdown.fab_get_all_vms')
     def exec_get_all_vms_test(self, mock_fab_get_all_vms_result, expected_result, mock_fab_get_all_vms):
         mock_fab_get_all_vms.return_value = mock_fab_get_all_vms_result
@@ -77,7 +142,9 @@ class Testshutdown(unittest.TestCase):
             vm_poweroff_poll=None,
             vm_poweroff_timeout=None,
             esxi_poweroff_poll=None,
-            esxi_poweroff_timeout=None):
+            esxi_poweroff_timeout=None,
+            vm_command_concurrency=None,
+            clock=None):
 
         args = DottedDict()
         args.esxihost = TEST_ESXI_HOST
@@ -89,7 +156,10 @@ class Testshutdown(unittest.TestCase):
             vm_poweroff_poll=vm_poweroff_poll,
             vm_poweroff_timeout=vm_poweroff_timeout,
             esxi_poweroff_poll=esxi_poweroff_poll,
-            esxi_poweroff_timeout=esxi_poweroff_timeout)
+            esxi_poweroff_timeout=esxi_poweroff_timeout,
+            vm_command_concurrency=vm_command_concurrency,
+            clock=clock.time if clock is not None else None,
+            sleep=clock.sleep if clock is not None else None)
         return shutdown
 
     def test_is_vm_running_is_on(self):
@@ -112,6 +182,162 @@ class Testshutdown(unittest.TestCase):
         actual_result = shutdown.is_vm_running(1)
         self.assertEqual(expected_result, actual_result)
 
+    def test_parse_power_getstates(self):
+        expected_result = {
+            1: POWER_GETSTATE_ON,
+            2: POWER_GETSTATE_ERR,
+            4: POWER_GETSTATE_OFF,
+            5: POWER_GETSTATE_ON,
+            }
+        actual_result = Shutdown.parse_power_getstates(POWER_GETSTATES)
+        self.assertDictEqual(expected_result, actual_result)
+
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_vm_power_states(self, mock_fab_power_getstates):
+        mock_fab_power_getstates.return_value = POWER_GETSTATES
+        shutdown = self.get_default_out()
+        # vm 3 is missing from the output altogether and is considered NOT running
+        actual_result = shutdown.get_vm_power_states([1, 2, 3, 4, 5])
+        self.assertDictEqual({1: True, 2: False, 3: False, 4: False, 5: True}, actual_result)
+        self.assertEqual(1, mock_fab_power_getstates.call_count)
+
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_vm_power_states_no_vms(self, mock_fab_power_getstates):
+        shutdown = self.get_default_out()
+        self.assertDictEqual({}, shutdown.get_vm_power_states([]))
+        mock_fab_power_getstates.assert_not_called()
+
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_running_vms(self, mock_fab_power_getstates):
+        mock_fab_power_getstates.return_value = POWER_GETSTATES
+        shutdown = self.get_default_out()
+        actual_result = shutdown.get_running_vms({1: VM_1, 4: VM_4, 5: VM_5})
+        self.assertEqual([1, 5], actual_result)
+        self.assertEqual(1, mock_fab_power_getstates.call_count)
+
+    @patch('esximanager.shutdown.Shutdown.fab_shutdown_vm')
+    def test_shutdown_vms(self, mock_fab_shutdown_vm):
+        '''
+        All of the commands should be in flight at the same time, and the
+        failures reported per vm.
+        '''
+        barrier = threading.Barrier(3, timeout=1)
+
+        def mock_fab_shutdown_vm_funct(vm_id):
+            barrier.wait()
+            if vm_id == 5:
+                raise TransportError('connection lost')
+            return vm_id != 4
+
+        mock_fab_shutdown_vm.side_effect = mock_fab_shutdown_vm_funct
+        mock_logger = Mock()
+        shutdown = self.get_default_out(vm_command_concurrency=3)
+        shutdown.logger = mock_logger
+
+        actual_result = shutdown.shutdown_vms([1, 4, 5], { 1: VM_1, 4: VM_4, 5: VM_5 })
+        self.assertDictEqual({ 1: True, 4: False, 5: False }, actual_result)
+        self.assertEqual(2, mock_logger.error.call_count)
+        self.assertIn(str(VM_4), mock_logger.error.call_args_list[0][0][0])
+
+    @patch('esximanager.shutdown.Shutdown.fab_poweroff_vm')
+    def test_poweroff_vms_serial(self, mock_fab_poweroff_vm):
+        mock_fab_poweroff_vm.return_value = True
+        shutdown = self.get_default_out(vm_command_concurrency=1)
+        actual_result = shutdown.poweroff_vms([1, 4], { 1: VM_1, 4: VM_4 })
+        self.assertDictEqual({ 1: True, 4: True }, actual_result)
+        self.assertEqual(2, mock_fab_poweroff_vm.call_count)
+
+    @patch('esximanager.shutdown.Shutdown.get_all_vms')
+    @patch('esximanager.shutdown.Shutdown.fab_get_running_vm_names')
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_inventory_and_running_vms_cached(
+            self, mock_fab_power_getstates, mock_fab_get_running_vm_names, mock_get_all_vms):
+        mock_fab_power_getstates.return_value = POWER_GETSTATES
+        mock_fab_get_running_vm_names.return_value = [ 'web_server', 'R10_V4_Base' ]
+        shutdown = self.get_default_out()
+        shutdown.inventory_cache = Mock()
+        shutdown.inventory_cache.load.return_value = { 1: VM_1, 4: VM_4, 5: VM_5 }
+
+        vms, running_vms = shutdown.get_inventory_and_running_vms()
+        self.assertEqual([1, 4, 5], list(vms))
+        self.assertEqual([1, 5], running_vms)
+        mock_get_all_vms.assert_not_called()
+
+    @patch('esximanager.shutdown.Shutdown.get_all_vms')
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_inventory_and_running_vms_stale(self, mock_fab_power_getstates, mock_get_all_vms):
+        '''
+        vm 2 is in the cache but no longer exists on the host, so we re-scan.
+        '''
+        mock_fab_power_getstates.return_value = POWER_GETSTATES
+        mock_get_all_vms.return_value = { 1: VM_1, 5: VM_5 }
+        shutdown = self.get_default_out()
+        shutdown.inventory_cache = Mock()
+        shutdown.inventory_cache.load.return_value = { 1: VM_1, 2: VM_4 }
+
+        vms, running_vms = shutdown.get_inventory_and_running_vms()
+        self.assertEqual({ 1: VM_1, 5: VM_5 }, vms)
+        self.assertEqual([1, 5], running_vms)
+        shutdown.inventory_cache.save.assert_called_once_with(TEST_ESXI_HOST, vms)
+
+    @patch('esximanager.shutdown.Shutdown.get_all_vms')
+    @patch('esximanager.shutdown.Shutdown.fab_get_running_vm_names')
+    @patch('esximanager.shutdown.Shutdown.fab_power_getstates')
+    def test_get_inventory_and_running_vms_unknown_running_vm(
+            self, mock_fab_power_getstates, mock_fab_get_running_vm_names, mock_get_all_vms):
+        '''
+        new_vm is running but is not in the cache, so we re-scan.
+        '''
+        mock_fab_power_getstates.return_value = POWER_GETSTATES
+        mock_fab_get_running_vm_names.return_value = [ 'R10_V4_Base', 'web_server', 'new_vm' ]
+        mock_get_all_vms.return_value = { 1: VM_1, 4: VM_4, 5: VM_5 }
+        shutdown = self.get_default_out()
+        shutdown.inventory_cache = Mock()
+        shutdown.inventory_cache.load.return_value = { 1: VM_1, 4: VM_4, 5: VM_5 }
+
+        shutdown.get_inventory_and_running_vms()
+        mock_get_all_vms.assert_called_once_with()
+
+    def test_parse_vm_process_list(self):
+        fab_output = [
+            'R10_V4_Base',
+            '   World ID: 2100934',
+            '   Process ID: 0',
+            '   VMX Cartel ID: 2100933',
+            '   UUID: 56 4d 2b 5c 9a 6e 34 7e-8c 1f 0a 6e 2b 3c 4d 5e',
+            '   Display Name: R10_V4_Base',
+            '   Config File: /vmfs/volumes/5e1f2a3b-4c5d6e7f/R10_V4_Base/R10_V4_Base.vmx',
+            '',
+            'web server',
+            '   World ID: 2101022',
+            '   Display Name: web server',
+            '   Config File: /vmfs/volumes/5e1f2a3b-4c5d6e7f/web server/web server.vmx',
+            ]
+        self.assertEqual(['R10_V4_Base', 'web server'], Shutdown.parse_vm_process_list(fab_output))
+
+    @patch('esximanager.shutdown.Shutdown.get_all_vms')
+    def test_refresh_inventory_unable_to_save(self, mock_get_all_vms):
+        mock_get_all_vms.return_value = { 1: VM_1 }
+        shutdown = self.get_default_out()
+        shutdown.inventory_cache = Mock()
+        shutdown.inventory_cache.save.side_effect = PermissionError('read-only')
+
+        self.assertEqual({ 1: VM_1 }, shutdown.refresh_inventory())
+        self.assertEqual({ 1: VM_1 }, shutdown.inventory)
+
+    def test_refresh_inventory_failed_scan(self):
+        '''
+        An inventory that we could not scan is never cached as an empty one.
+        '''
+        shutdown = self.get_default_out()
+        shutdown.transport = FakeTransport(
+            TEST_ESXI_HOST, MOCK_LOGGER, responder=lambda command: CommandResult(GETALLVMS_LOGIN_FAILED, 1))
+        shutdown.inventory_cache = Mock()
+
+        self.assertRaises(InventoryError, shutdown.refresh_inventory)
+        shutdown.inventory_cache.save.assert_not_called()
+        self.assertIsNone(shutdown.inventory)
+
     def test_wait_for_vms_to_shutdown(self):
         '''
         Tests a happy path where we attempt to shutdown 2 vms and one shutsdown
@@ -121,7 +347,8 @@ class Testshutdown(unittest.TestCase):
 
         '''
         A dictionary of successive results that should be returned for a given
-        vm when the is_vm_running command is called for it.
+        vm each time its power state is queried.  All of the vms are queried
+        in one call per poll, so we expect three calls in total.
         '''
         mock_is_vm_running_result = { 1: [True, False], 4: [True, True, False] }
 
@@ -131,7 +358,7 @@ class Testshutdown(unittest.TestCase):
             mock_is_vm_running_result,
             0.01, # quick poll time to keep the tests short
             -1, # no timeout setting for this test
-            5)
+            3)
 
     def test_wait_for_vms_to_shutdown_force_poweroff(self):
         '''
@@ -154,7 +381,7 @@ class Testshutdown(unittest.TestCase):
             0.05, # 1 second timeout
             -1) # We don't care how many times this is called, just that we validate it is called at least once.
 
-    @patch('esximanager.shutdown.Shutdown.is_vm_running')
+    @patch('esximanager.shutdown.Shutdown.get_vm_power_states')
     def exec_wait_for_vms_to_shutdown_test(
             self,
             vms,
@@ -162,8 +389,8 @@ class Testshutdown(unittest.TestCase):
             mock_is_vm_running_result,
             vm_poweroff_poll,
             vm_poweroff_timeout,
-            expected_is_vm_running_call_count,
-            mock_is_vm_running):
+            expected_get_vm_power_states_call_count,
+            mock_get_vm_power_states):
 
         def mock_is_vm_running_funct(vm_id):
             retvals = mock_is_vm_running_result[vm_id]
@@ -180,22 +407,71 @@ class Testshutdown(unittest.TestCase):
 
             return retval
 
+        def mock_get_vm_power_states_funct(vm_ids):
+            return { vm_id: mock_is_vm_running_funct(vm_id) for vm_id in vm_ids }
+
         # Set up the mocks to return the defined values
-        mock_is_vm_running.side_effect = mock_is_vm_running_funct
+        mock_get_vm_power_states.side_effect = mock_get_vm_power_states_funct
 
         shutdown = self.get_default_out(vm_poweroff_poll=vm_poweroff_poll, vm_poweroff_timeout=vm_poweroff_timeout)
         actual_result = shutdown.wait_for_vms_to_shutdown(vms)
 
-        actual_mock_is_vm_running_call_count = mock_is_vm_running.call_count
-        if expected_is_vm_running_call_count > 0:
-            self.assertEqual(expected_is_vm_running_call_count, actual_mock_is_vm_running_call_count)
+        actual_call_count = mock_get_vm_power_states.call_count
+        if expected_get_vm_power_states_call_count > 0:
+            self.assertEqual(expected_get_vm_power_states_call_count, actual_call_count)
         else:
             # Just check that it was called at least once
             self.assertTrue(
-                actual_mock_is_vm_running_call_count > 0,
-                'The mock_is_vm_running function was never called')
+                actual_call_count > 0,
+                'The mock_get_vm_power_states function was never called')
         self.assertEqual(expected_result, actual_result)
 
+    @patch('esximanager.shutdown.Shutdown.get_vm_power_states')
+    def test_wait_for_vms_to_shutdown_budget_overrun(self, mock_get_vm_power_states):
+        '''
+        With no timeout but a budget that leaves no time for another poll in
+        the graceful phase, we should give up after the first poll.
+        '''
+        mock_get_vm_power_states.return_value = { 1: True }
+        shutdown = self.get_default_out(vm_poweroff_poll=5, vm_poweroff_timeout=-1)
+        shutdown.vm_poweroff_min_poll = 5
+        shutdown.budget = Budget(5)
+
+        actual_result = shutdown.wait_for_vms_to_shutdown([1])
+        self.assertEqual((Shutdown.RESULT_TIMEDOUT, [1]), actual_result)
+        self.assertEqual(1, mock_get_vm_power_states.call_count)
+
+    @patch('esximanager.shutdown.Shutdown.get_vm_power_states')
+    def test_wait_for_vms_to_shutdown_adaptive_polling(self, mock_get_vm_power_states):
+        '''
+        A vm that is slow to shutdown is polled less and less often and does
+        not cause the fast one to be polled any more often than its own
+        schedule.
+        '''
+        remaining_polls = { 1: 1, 4: 6 }
+        polled = []
+
+        def mock_get_vm_power_states_funct(vm_ids):
+            polled.append(sorted(vm_ids))
+            retval = {}
+            for vm_id in vm_ids:
+                remaining_polls[vm_id] -= 1
+                retval[vm_id] = remaining_polls[vm_id] > 0
+            return retval
+
+        mock_get_vm_power_states.side_effect = mock_get_vm_power_states_funct
+        clock = VirtualClock()
+        shutdown = self.get_default_out(vm_poweroff_poll=4, vm_poweroff_timeout=-1, clock=clock)
+        shutdown.vm_poweroff_min_poll = 1
+        shutdown.vm_poweroff_poll_backoff = 2
+
+        actual_result = shutdown.wait_for_vms_to_shutdown([1, 4])
+
+        self.assertEqual((Shutdown.RESULT_OK, []), actual_result)
+        self.assertEqual([[1, 4], [4], [4], [4], [4], [4]], polled)
+        # Sleeps of 2, 4, 4, 4 and 4 seconds between polls
+        self.assertEqual(18, clock.time())
+
     def test_wait_to_return(self):
         mock_funct = Mock(side_effect=[Shutdown.RESULT_WAIT, Shutdown.RESULT_OK])
         actual_result = Shutdown.wait_to_return(MOCK_LOGGER, mock_funct, 0.01, 1)
@@ -203,7 +479,35 @@ class Testshutdown(unittest.TestCase):
         self.assertEqual(2, mock_funct.call_count)
 
     def test_wait_to_return_timeout(self):
+        clock = VirtualClock()
         mock_funct = Mock(return_value=Shutdown.RESULT_WAIT)
-        actual_result = Shutdown.wait_to_return(MOCK_LOGGER, mock_funct, 0.01, 0.05)
+        actual_result = Shutdown.wait_to_return(
+            MOCK_LOGGER, mock_funct, 1, 5, sleep=clock.sleep, clock=clock.time)
         self.assertEqual(Shutdown.RESULT_TIMEDOUT, actual_result)
-        self.assertTrue(mock_funct.call_count > 1)
+        self.assertEqual(6, mock_funct.call_count)
+
+    def test_wait_to_return_backoff(self):
+        mock_funct = Mock(side_effect=[Shutdown.RESULT_WAIT] * 3 + [Shutdown.RESULT_OK])
+        with patch('esximanager.shutdown.time.sleep') as mock_sleep:
+            actual_result = Shutdown.wait_to_return(MOCK_LOGGER, mock_funct, 1, -1, max_polltime=3, backoff=2)
+        self.assertEqual(Shutdown.RESULT_OK, actual_result)
+        self.assertEqual([1, 2, 3], [c[0][0] for c in mock_sleep.call_args_list])
+
+    def test_wait_to_return_deadline(self):
+        mock_funct = Mock(return_value=Shutdown.RESULT_WAIT)
+        actual_result = Shutdown.wait_to_return(MOCK_LOGGER, mock_funct, 5, -1, deadline=time.time() + 1)
+        self.assertEqual(Shutdown.RESULT_TIMEDOUT, actual_result)
+        self.assertEqual(1, mock_funct.call_count)
+
+    @patch('esximanager.shutdown.Shutdown.wait_for_esxihost_to_shutdown')
+    @patch('esximanager.shutdown.Shutdown.fab_poweroff_esxihost')
+    @patch('esximanager.shutdown.Shutdown.get_all_vms')
+    def test_shutdown_result(self, mock_get_all_vms, mock_fab_poweroff_esxihost, mock_wait_for_esxihost_to_shutdown):
+        mock_get_all_vms.return_value = {}
+        mock_wait_for_esxihost_to_shutdown.return_value = Shutdown.RESULT_OK
+
+        mock_fab_poweroff_esxihost.return_value = True
+        self.assertEqual(Shutdown.RESULT_OK, self.get_default_out().shutdown())
+
+        mock_fab_poweroff_esxihost.return_value = False
+        self.assertEqual(Shutdown.RESULT_FAILED, self.get_default_out().shutdown())
@@ -0,0 +1,277 @@
+import time
+import unittest
+from unittest.mock import Mock
+from esximanager.config import DependencyConfig
+from esximanager.metrics import RunMetrics
+from esximanager.pool import run_concurrently
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import SimulatedEsxiHost, SimulatedVm, VirtualClock, constant, simulate_shutdown
+from esximanager.tests.simulated import get_shutdown
+from esximanager.transport import TransportError
+from esximanager.transport.base import ConnectionLostError
+
+MOCK_LOGGER = Mock()
+
+
+class TestSimulatedEsxiHost(unittest.TestCase):
+
+    def test_get_all_vms(self):
+        host = SimulatedEsxiHost(3)
+        vms = get_shutdown(host).get_all_vms()
+        self.assertEqual([1, 2, 3], list(vms))
+        self.assertEqual('vm-2', vms[2].name)
+        self.assertEqual('[datastore1]', vms[2].datastore)
+
+    def test_power_states(self):
+        host = SimulatedEsxiHost(4, powered_off_fraction=0.5, seed=1)
+        shutdown = get_shutdown(host)
+        vm_states, invalid_vm_ids = shutdown.query_vm_power_states([1, 2, 3, 4, 5])
+        self.assertEqual({ vm_id: vm_id in host.running_vms() for vm_id in [1, 2, 3, 4, 5] }, vm_states)
+        self.assertEqual([5], invalid_vm_ids)
+        self.assertEqual(1, host.commands['power.getstate.batched'])
+
+    def test_status(self):
+        host = SimulatedEsxiHost(4, powered_off_fraction=0.5, seed=1)
+        snapshot = get_shutdown(host).status()
+        self.assertEqual(4, snapshot['num_vms'])
+        self.assertEqual(len(host.running_vms()), snapshot['num_running'])
+        self.assertEqual(
+            [(vm_id, f'vm-{vm_id}', vm_id in host.running_vms()) for vm_id in [1, 2, 3, 4]],
+            [(vm['vm_id'], vm['name'], vm['powered_on']) for vm in snapshot['vms']])
+        # Nothing is changed, and it takes one command for the power states
+        self.assertEqual(1, host.commands['power.getstate.batched'])
+        self.assertEqual(2, sum(host.commands.values()))
+
+    def test_shutdown_and_poweroff_vm(self):
+        host = SimulatedEsxiHost(2, shutdown_latency=constant(0))
+        shutdown = get_shutdown(host)
+        self.assertTrue(shutdown.fab_shutdown_vm(1))
+        self.assertTrue(shutdown.fab_poweroff_vm(2))
+        self.assertEqual([], host.running_vms())
+        # Neither can be powered off again
+        self.assertFalse(shutdown.fab_poweroff_vm(2))
+        self.assertFalse(shutdown.is_vm_running(1))
+
+    def test_power_on_and_heartbeat(self):
+        now = [0]
+        host = SimulatedEsxiHost(1, powered_off_fraction=1, boot_latency=constant(5), clock=lambda: now[0])
+        transport = host.create_transport(MOCK_LOGGER)
+        self.assertTrue(transport.run('vim-cmd vmsvc/power.on 1').succeeded)
+        self.assertEqual([1], host.running_vms())
+        self.assertEqual('gray', transport.run('vim-cmd vmsvc/get.guestheartbeatStatus 1').stdout.strip())
+        now[0] = 5
+        self.assertEqual('green', transport.run('vim-cmd vmsvc/get.guestheartbeatStatus 1').stdout.strip())
+        # It cannot be powered on again
+        self.assertFalse(transport.run('vim-cmd vmsvc/power.on 1').succeeded)
+
+    def test_host_poweroff(self):
+        host = SimulatedEsxiHost(0)
+        transport = host.create_transport(MOCK_LOGGER)
+        transport.run('poweroff')
+        self.assertFalse(host.is_up())
+        with self.assertRaises(TransportError):
+            transport.run('vim-cmd vmsvc/getallvms')
+
+    def test_end_to_end_shutdown(self):
+        '''
+        A full shutdown of a host with a hung vm, which has to be forcefully
+        powered off.
+        '''
+        host = SimulatedEsxiHost(20, shutdown_latency=constant(0.02), hung_fraction=0.1, seed=3)
+        hung_vms = [vm.vm_id for vm in host.vms.values() if vm.hung]
+        self.assertTrue(len(hung_vms) > 0)
+
+        shutdown = get_shutdown(host, vm_poweroff_poll=0.02, vm_poweroff_timeout=0.2)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([], host.running_vms())
+        self.assertFalse(host.is_up())
+        self.assertEqual(20, host.commands['power.shutdown'])
+        self.assertEqual(len(hung_vms), host.commands['power.off'])
+
+    def test_shutdown_with_link_drop(self):
+        '''
+        The connection drops for a while as the vms are polled, but the
+        shutdown carries on, forcefully powers off vm-2, which is hung, once
+        its timeout passes and then powers off the host.
+        '''
+        clock = VirtualClock()
+        host = SimulatedEsxiHost(2, shutdown_latency=constant(3), clock=clock.time, sleep=clock.sleep)
+        host.vms[2].hung = True
+        execute = host.execute
+
+        def dropping_execute(command):
+            if 1 <= clock.time() < 8:
+                raise ConnectionLostError() from ConnectionResetError('Connection reset by peer')
+            return execute(command)
+        host.execute = dropping_execute
+
+        shutdown = get_shutdown(
+            host, vm_poweroff_poll=2, vm_poweroff_timeout=10, clock=clock.time, sleep=clock.sleep)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([], host.running_vms())
+        self.assertEqual(1, host.commands['power.off'])
+        self.assertEqual(1, host.commands['poweroff'])
+        self.assertEqual([2], list(shutdown.forced_vms))
+
+    def test_shutdown_in_waves(self):
+        """
+        vm-1 and vm-2 depend on the databases, vm-3 and vm-4, which depend on
+        the storage, vm-5, so each wave is shut down only once the one before
+        it is off.
+        """
+        host = SimulatedEsxiHost(6, shutdown_latency=constant(0.05))
+        config = DependencyConfig(
+            vms={
+                'vm-1': {'tags': ['app']},
+                'vm-2': {'tags': ['app']},
+                'vm-3': {'tags': ['db'], 'depends_on': ['vm-5']},
+                'vm-4': {'tags': ['db'], 'depends_on': ['vm-5']},
+                },
+            tags={'app': {'depends_on': ['db']}})
+        shutdown_times = {}
+        execute = host.execute
+
+        def record_execute(command):
+            if command.startswith('vim-cmd vmsvc/power.shutdown '):
+                shutdown_times[int(command.split()[-1])] = time.time()
+            return execute(command)
+        host.execute = record_execute
+
+        shutdown = get_shutdown(host, dependency_config=config)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([[1, 2, 6], [3, 4], [5]], shutdown.get_shutdown_waves([1, 2, 3, 4, 5, 6]))
+        self.assertGreaterEqual(min(shutdown_times[3], shutdown_times[4]) - max(shutdown_times[1], shutdown_times[2]), 0.05)
+        self.assertGreaterEqual(shutdown_times[5] - max(shutdown_times[3], shutdown_times[4]), 0.05)
+
+        waves = shutdown.metrics.to_dict()['waves']
+        self.assertEqual([1, 2, 3], [wave['wave'] for wave in waves])
+        self.assertEqual(['vm-3', 'vm-4'], waves[1]['vms'])
+        self.assertGreaterEqual(waves[1]['seconds'], 0.05)
+        self.assertIn(RunMetrics.PHASE_GRACEFUL_WAIT, shutdown.metrics.get_phase_seconds())
+
+    def test_inventory_expires(self):
+        '''
+        vm-3 is added, powered off, after the inventory was scanned, and is
+        only seen once the inventory in memory has expired.
+        '''
+        clock = VirtualClock()
+        host = SimulatedEsxiHost(2, clock=clock.time, sleep=clock.sleep)
+        inventory_cache = Mock(ttl=60)
+        inventory_cache.load.return_value = None
+        shutdown = get_shutdown(host, inventory_cache=inventory_cache, clock=clock.time, sleep=clock.sleep)
+        self.assertEqual([1, 2], list(shutdown.get_inventory_and_running_vms()[0]))
+
+        host.vms[3] = SimulatedVm(3, 'vm-3', 0, False, powered_on=False)
+        clock.sleep(30)
+        self.assertEqual([1, 2], list(shutdown.get_inventory_and_running_vms()[0]))
+        self.assertEqual(1, host.commands['getallvms'])
+        clock.sleep(31)
+        vms, running_vms = shutdown.get_inventory_and_running_vms()
+        self.assertEqual([1, 2, 3], list(vms))
+        self.assertEqual([1, 2], running_vms)
+        self.assertEqual(2, host.commands['getallvms'])
+
+    def test_cached_inventory_missing_running_vm(self):
+        '''
+        vm-3 is registered and started after the inventory was cached, so the
+        cached inventory is re-scanned and vm-3 shut down with the others
+        before the host is powered off.
+        '''
+        host = SimulatedEsxiHost(2)
+        inventory_cache = Mock(ttl=60)
+        inventory_cache.load.return_value = get_shutdown(host).get_all_vms()
+        host.vms[3] = SimulatedVm(3, 'vm-3', 0, False)
+        running_at_poweroff = []
+        execute = host.execute
+
+        def record_execute(command):
+            if command == 'poweroff':
+                running_at_poweroff.extend(host.running_vms())
+            return execute(command)
+        host.execute = record_execute
+
+        shutdown = get_shutdown(host, inventory_cache=inventory_cache)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual([], running_at_poweroff)
+        self.assertEqual(2, host.commands['getallvms'])
+        self.assertEqual(3, host.commands['power.shutdown'])
+        inventory_cache.save.assert_called_once()
+
+    def test_shutdown_in_waves_with_host_executor(self):
+        clock = VirtualClock()
+        host = SimulatedEsxiHost(2, shutdown_latency=constant(5), clock=clock.time, sleep=clock.sleep)
+        config = DependencyConfig(vms={'vm-1': {'depends_on': ['vm-2']}})
+        shutdown = get_shutdown(
+            host,
+            dependency_config=config,
+            host_executor=True,
+            clock=clock.time,
+            sleep=clock.sleep)
+        self.assertEqual(Shutdown.RESULT_OK, shutdown.shutdown())
+        self.assertEqual(2, host.commands['hostexec.launch'])
+        self.assertEqual(2, host.local_commands['power.shutdown'])
+        self.assertEqual(2, len(host.executors))
+        self.assertLess(host.vms[1].powered_off_time, host.vms[2].powered_off_time)
+        self.assertLessEqual(host.vms[2].powered_off_time, host.poweroff_time)
+
+    def test_shutdown_waves_with_cycle(self):
+        host = SimulatedEsxiHost(3)
+        config = DependencyConfig(vms={'vm-1': {'depends_on': ['vm-2']}, 'vm-2': {'depends_on': ['vm-1']}})
+        shutdown = get_shutdown(host, dependency_config=config)
+        shutdown.get_inventory_and_running_vms()
+        self.assertEqual([[1, 2, 3]], shutdown.get_shutdown_waves([1, 2, 3]))
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def test_sleep(self):
+        clock = VirtualClock(start_time=100)
+        clock.sleep(5)
+        clock.sleep(-1)
+        self.assertEqual(105, clock.time())
+
+    def test_concurrent_sleeps(self):
+        clock = VirtualClock(concurrency=4)
+
+        def command(i):
+            clock.sleep(1)
+            return clock.time()
+
+        outcomes = run_concurrently(command, range(10), 4)
+        # 10 commands on 4 lanes take 3 rounds
+        self.assertEqual(3, clock.time())
+        self.assertEqual([1, 2, 3], sorted(set(outcome.result for outcome in outcomes.values())))
+
+    def test_unlimited_concurrent_sleeps(self):
+        clock = VirtualClock()
+        run_concurrently(lambda i: clock.sleep(2), range(10), 10)
+        self.assertEqual(2, clock.time())
+
+
+class TestSimulateShutdown(unittest.TestCase):
+
+    def test_simulate_shutdown(self):
+        report = simulate_shutdown(
+            20,
+            MOCK_LOGGER,
+            host_kwargs=dict(shutdown_latency=constant(10), command_latency=0.5, poweroff_latency=5),
+            vm_poweroff_poll=2,
+            vm_command_concurrency=4)
+        self.assertEqual(Shutdown.RESULT_OK, report['result'])
+        self.assertEqual(20, report['commands']['power.shutdown'])
+        self.assertEqual(0, report['num_forced'])
+        # The inventory, 5 rounds of shutdowns and at least the guest shutdown latency
+        self.assertTrue(13 <= report['seconds'] < 30, report)
+        self.assertTrue(0 <= report['vm_lateness'] <= 2 + 0.5, report)
+        self.assertTrue(0 <= report['host_lateness'] <= 1, report)
+        self.assertTrue(report['wall_seconds'] < report['seconds'])
+
+    def test_simulate_shutdown_with_hung_vms(self):
+        report = simulate_shutdown(
+            10,
+            MOCK_LOGGER,
+            host_kwargs=dict(hung_fraction=1, command_latency=0.1),
+            vm_poweroff_timeout=60)
+        self.assertEqual(Shutdown.RESULT_OK, report['result'])
+        self.assertEqual(10, report['num_forced'])
+        self.assertTrue(60 <= report['seconds'] < 70, report)
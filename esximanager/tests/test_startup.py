@@ -0,0 +1,148 @@
+import unittest
+from unittest.mock import Mock
+from esximanager.config import DependencyConfig
+from esximanager.journal import ShutdownJournal
+from esximanager.shutdown import Shutdown
+from esximanager.simulator import GETALLVMS_HDR, SimulatedEsxiHost, VirtualClock, constant
+from esximanager.startup import Startup
+from esximanager.tests.simulated import get_shutdown
+from esximanager.transport import CommandResult
+
+MOCK_LOGGER = Mock()
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(start_time=1000.0)
+
+    def get_host(self, num_vms, boot_latency=None):
+        host = SimulatedEsxiHost(
+            num_vms,
+            powered_off_fraction=1,
+            boot_latency=boot_latency,
+            clock=self.clock.time,
+            sleep=self.clock.sleep)
+        self.on_times = {}
+        execute = host.execute
+
+        def record_execute(command):
+            if command.startswith('vim-cmd vmsvc/power.on '):
+                self.on_times[int(command.split()[-1])] = self.clock.time()
+            return execute(command)
+        host.execute = record_execute
+        return host
+
+    def get_startup(self, host, dryrun=False, **kwargs):
+        shutdown = get_shutdown(host, dryrun=dryrun, clock=self.clock.time, sleep=self.clock.sleep)
+        return Startup(shutdown, MOCK_LOGGER, poll=1, sleep=self.clock.sleep, **kwargs)
+
+    def test_start_in_dependency_order(self):
+        host = self.get_host(4, boot_latency=constant(10))
+        config = DependencyConfig(
+            vms={
+                'vm-1': {'ready': {'check': 'heartbeat'}},
+                'vm-2': {'depends_on': ['vm-1']},
+                'vm-3': {'depends_on': ['vm-1'], 'ready': {'check': 'heartbeat'}},
+                'vm-4': {'depends_on': ['vm-3']},
+                })
+        startup = self.get_startup(host, config=config)
+        result, results = startup.start()
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual([1, 2, 3, 4], sorted(host.running_vms()))
+        self.assertTrue(all(r['state'] == Startup.STATE_READY for r in results.values()))
+        # vm-2 and vm-3 start together once the guest of vm-1 is up, and vm-4
+        # once that of vm-3 is
+        self.assertEqual(self.on_times[2], self.on_times[3])
+        self.assertGreaterEqual(self.on_times[2] - self.on_times[1], 10)
+        self.assertGreaterEqual(self.on_times[4] - self.on_times[3], 10)
+        self.assertLess(results['vm-4']['seconds'], 25)
+
+    def test_start_with_dependency_cycle(self):
+        host = self.get_host(2)
+        config = DependencyConfig(vms={'vm-1': {'depends_on': ['vm-2']}, 'vm-2': {'depends_on': ['vm-1']}})
+        result, results = self.get_startup(host, config=config).start()
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual([1, 2], sorted(host.running_vms()))
+        # All of the vms are started together
+        self.assertEqual(1, len(set(self.on_times.values())))
+
+    def test_concurrency_cap(self):
+        host = self.get_host(6, boot_latency=constant(5))
+        config = DependencyConfig(vms={f'vm-{i}': {'ready': {'check': 'heartbeat'}} for i in range(1, 7)})
+        result, results = self.get_startup(host, config=config, concurrency=2).start()
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual(6, len(results))
+        on_times = sorted(self.on_times.values())
+        # Three rounds of two at a time
+        self.assertEqual(3, len(set(on_times)))
+        self.assertEqual(1, host.commands['getallvms'])
+
+    def test_ready_timeout(self):
+        host = self.get_host(2, boot_latency=constant(100))
+        config = DependencyConfig(
+            vms={'vm-1': {'ready': {'check': 'heartbeat'}}, 'vm-2': {'depends_on': ['vm-1']}})
+        result, results = self.get_startup(host, config=config, ready_timeout=5).start()
+        self.assertEqual(Shutdown.RESULT_TIMEDOUT, result)
+        self.assertEqual(Startup.STATE_TIMEDOUT, results['vm-1']['state'])
+        # Its dependent is started anyway
+        self.assertEqual(Startup.STATE_READY, results['vm-2']['state'])
+
+    def test_vms_from_last_shutdown(self):
+        host = self.get_host(3)
+        journal = Mock(spec=ShutdownJournal)
+        journal.get_last_running_vms.return_value = {1: 'vm-1', 3: 'vm-3'}
+        result, results = self.get_startup(host, journal=journal).start()
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual(['vm-1', 'vm-3'], sorted(results))
+        self.assertEqual([1, 3], sorted(host.running_vms()))
+
+    def test_named_vms_and_already_running(self):
+        host = self.get_host(3)
+        host.vms[2].powered_on = True
+        result, results = self.get_startup(host).start(names=['vm-2', 'vm-3', 'missing'])
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual(['vm-2', 'vm-3'], sorted(results))
+        self.assertEqual(1, host.commands['power.on'])
+
+    def test_dryrun(self):
+        host = self.get_host(2)
+        result, results = self.get_startup(host, dryrun=True).start(names=['vm-1', 'vm-2'])
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual(0, host.commands['power.on'])
+        self.assertEqual([], host.running_vms())
+
+    def test_hostd_not_ready(self):
+        '''
+        sshd is up before hostd, so vim-cmd fails to log in at first, and then
+        hostd reports no vms while it loads its inventory.
+        '''
+        host = self.get_host(2)
+        execute = host.execute
+
+        def booting_execute(command):
+            if command.startswith('vim-cmd ') and self.clock.time() < 1010:
+                return CommandResult('Failed to login: vim.fault.HostConnectFault\n', 1)
+            if command == 'vim-cmd vmsvc/getallvms' and self.clock.time() < 1020:
+                return CommandResult(GETALLVMS_HDR + '\n', 0)
+            return execute(command)
+        host.execute = booting_execute
+
+        result, results = self.get_startup(host).start(names=['vm-1', 'vm-2'])
+        self.assertEqual(Shutdown.RESULT_OK, result)
+        self.assertEqual(['vm-1', 'vm-2'], sorted(results))
+        self.assertEqual([1, 2], sorted(host.running_vms()))
+        self.assertGreaterEqual(min(self.on_times.values()), 1020)
+
+    def test_host_reports_no_vms(self):
+        host = self.get_host(0)
+        result, results = self.get_startup(host).start(names=['vm-1'], host_timeout=3)
+        self.assertEqual(Shutdown.RESULT_FAILED, result)
+        self.assertEqual({}, results)
+
+    def test_host_does_not_come_up(self):
+        host = self.get_host(1)
+        host.poweroff_time = 0
+        result, results = self.get_startup(host).start(host_timeout=3)
+        self.assertEqual(Shutdown.RESULT_FAILED, result)
+        self.assertEqual({}, results)
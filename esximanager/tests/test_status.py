@@ -0,0 +1,37 @@
+import json
+import time
+import tempfile
+import unittest
+from unittest.mock import Mock
+from esximanager.status import StatusCache
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+
+
+class TestStatusCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = StatusCache(MOCK_LOGGER, self.tmpdir.name, ttl=10)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_save_and_load(self):
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+        snapshot = dict(host=TEST_ESXI_HOST, timestamp=time.time(), num_vms=1, num_running=0, vms=[])
+        self.cache.save(TEST_ESXI_HOST, snapshot)
+        self.assertEqual(snapshot, self.cache.load(TEST_ESXI_HOST))
+
+    def test_expired(self):
+        self.cache.save(TEST_ESXI_HOST, dict(host=TEST_ESXI_HOST, timestamp=time.time() - 11, vms=[]))
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+
+    def test_unreadable(self):
+        with open(self.cache.get_path(TEST_ESXI_HOST), 'w') as f:
+            f.write('{')
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
+        with open(self.cache.get_path(TEST_ESXI_HOST), 'w') as f:
+            json.dump(dict(host=TEST_ESXI_HOST), f)
+        self.assertIsNone(self.cache.load(TEST_ESXI_HOST))
@@ -0,0 +1,180 @@
+import io
+import socket
+import unittest
+from unittest.mock import patch, Mock
+from esximanager.transport import (
+    CommandResult, TransportError, TRANSPORT_FAKE, create_transport, get_transport_class)
+from esximanager.transport.fake import FakeTransport
+from esximanager.transport.openssh import OpenSshTransport
+from esximanager.transport.paramikossh import ParamikoTransport
+
+TEST_ESXI_HOST = 'esxi.example.com'
+MOCK_LOGGER = Mock()
+
+
+def get_mock_client(outputs):
+    '''
+    Builds a mock paramiko.SSHClient whose channels return the given
+    (stdout, return_code) outputs, or raise them if they are exceptions.
+    '''
+    mock_client = Mock()
+    transport = mock_client.get_transport.return_value
+    transport.is_active.return_value = True
+
+    def open_session():
+        output = outputs.pop(0)
+        if isinstance(output, Exception):
+            raise output
+        channel = Mock()
+        channel.makefile.return_value = io.BytesIO(output[0].encode('utf-8'))
+        channel.recv_exit_status.return_value = output[1]
+        return channel
+
+    transport.open_session.side_effect = open_session
+    return mock_client
+
+
+class TestTransport(unittest.TestCase):
+
+    def test_command_result_succeeded(self):
+        self.assertTrue(CommandResult('', 0).succeeded)
+        self.assertFalse(CommandResult('', 1).succeeded)
+
+    def test_get_transport_class(self):
+        self.assertIs(FakeTransport, get_transport_class(TRANSPORT_FAKE))
+        with self.assertRaises(ValueError):
+            get_transport_class('telnet')
+
+    def test_fake_transport(self):
+        transport = create_transport(
+            TRANSPORT_FAKE, TEST_ESXI_HOST, MOCK_LOGGER, responder=lambda command: CommandResult(command, 0))
+        with transport:
+            self.assertEqual(CommandResult('echo one', 0), transport.run('echo one'))
+            transport.run('echo two')
+        self.assertEqual(['echo one', 'echo two'], transport.history)
+        self.assertFalse(transport.is_connected())
+        self.assertEqual(1, transport.stats()['connections'])
+        self.assertEqual(2, transport.stats()['commands'])
+
+    def test_observer(self):
+        transport = FakeTransport(
+            TEST_ESXI_HOST, MOCK_LOGGER, responder=lambda command: CommandResult('', 0 if command == 'true' else 1))
+        transport.observer = Mock()
+        transport.run('true')
+        transport.run('false')
+        self.assertEqual(
+            [('true', True), ('false', False)],
+            [(c[0][0], c[0][2]) for c in transport.observer.call_args_list])
+
+
+class TestParamikoTransport(unittest.TestCase):
+
+    @patch('esximanager.transport.paramikossh.paramiko.SSHClient')
+    def test_run_reuses_connection(self, mock_ssh_client):
+        mock_ssh_client.return_value = get_mock_client([('one\n', 0), ('two\n', 1)])
+        transport = ParamikoTransport(TEST_ESXI_HOST, MOCK_LOGGER)
+
+        self.assertEqual(CommandResult('one\n', 0), transport.run('echo one'))
+        self.assertEqual(CommandResult('two\n', 1), transport.run('echo two'))
+        self.assertEqual(1, mock_ssh_client.call_count)
+        self.assertDictEqual(
+            dict(host=TEST_ESXI_HOST, transport='ParamikoTransport', connections=1, commands=2, reconnects=0),
+            transport.stats())
+
+    @patch('esximanager.transport.paramikossh.paramiko.SSHClient')
+    def test_run_reconnects(self, mock_ssh_client):
+        mock_ssh_client.side_effect = [
+            get_mock_client([socket.error('connection reset')]),
+            get_mock_client([('ok\n', 0)]),
+            ]
+        transport = ParamikoTransport(TEST_ESXI_HOST, MOCK_LOGGER)
+
+        self.assertEqual(CommandResult('ok\n', 0), transport.run('echo ok'))
+        stats = transport.stats()
+        self.assertEqual((2, 2, 1), (stats['connections'], stats['commands'], stats['reconnects']))
+
+    @patch('esximanager.transport.paramikossh.paramiko.SSHClient')
+    def test_stream(self, mock_ssh_client):
+        mock_ssh_client.return_value = get_mock_client([('one\ntwo\n', 0), ('one\ntwo\n', 0)])
+        transport = ParamikoTransport(TEST_ESXI_HOST, MOCK_LOGGER)
+
+        lines = []
+        self.assertEqual(0, transport.stream('tail log', lines.append))
+        self.assertEqual(['one', 'two'], lines)
+        # Stopping early
+        self.assertIsNone(transport.stream('tail log', lambda line: False))
+
+    @patch('esximanager.transport.paramikossh.paramiko.SSHClient')
+    def test_run_no_retry(self, mock_ssh_client):
+        mock_ssh_client.return_value = get_mock_client([EOFError()])
+        transport = ParamikoTransport(TEST_ESXI_HOST, MOCK_LOGGER)
+
+        with self.assertRaises(TransportError):
+            transport.run('poweroff', retry=False)
+        self.assertEqual(1, mock_ssh_client.call_count)
+        self.assertFalse(transport.is_connected())
+
+
+    @patch('esximanager.transport.paramikossh.paramiko.SSHClient')
+    def test_run_timeout(self, mock_ssh_client):
+        mock_client = get_mock_client([])
+        channel = Mock()
+        channel.makefile.return_value.read.side_effect = socket.timeout()
+        mock_client.get_transport.return_value.open_session.side_effect = None
+        mock_client.get_transport.return_value.open_session.return_value = channel
+        mock_ssh_client.return_value = mock_client
+        transport = ParamikoTransport(TEST_ESXI_HOST, MOCK_LOGGER, command_timeout=5)
+
+        with self.assertRaises(TransportError):
+            transport.run('vim-cmd vmsvc/power.shutdown 1')
+        channel.settimeout.assert_called_once_with(5)
+        channel.close.assert_called_once_with()
+        # The command is not retried and the connection is kept
+        self.assertEqual(1, transport.stats()['commands'])
+        self.assertTrue(transport.is_connected())
+
+
+class TestOpenSshTransport(unittest.TestCase):
+
+    @patch('esximanager.transport.openssh.subprocess.run')
+    def test_run_multiplexed(self, mock_run):
+        mock_run.side_effect = [
+            Mock(returncode=0, stderr=''),      # start the master
+            Mock(returncode=0, stdout=b'one'),  # first command
+            Mock(returncode=3, stdout=b'two'),  # second command
+            ]
+        transport = OpenSshTransport(TEST_ESXI_HOST, MOCK_LOGGER, control_dir='/tmp/esximanager-test')
+
+        self.assertEqual(CommandResult('one', 0), transport.run('echo one'))
+        self.assertEqual(CommandResult('two', 3), transport.run('echo two'))
+        self.assertEqual(1, transport.stats()['connections'])
+
+        master_args = mock_run.call_args_list[0][0][0]
+        self.assertIn('ControlMaster=yes', master_args)
+        self.assertIn('ControlPath=/tmp/esximanager-test/%C', master_args)
+        command_args = mock_run.call_args_list[2][0][0]
+        self.assertEqual([TEST_ESXI_HOST, 'echo two'], command_args[-2:])
+        # One fork per command, without checking the master each time
+        self.assertEqual(3, mock_run.call_count)
+
+    @patch('esximanager.transport.openssh.subprocess.run')
+    def test_run_master_lost(self, mock_run):
+        mock_run.side_effect = [
+            Mock(returncode=0, stderr=''),                                   # start the master
+            Mock(returncode=255, stdout=b'Control socket connect: refused'),  # the master has gone
+            Mock(returncode=0),                                              # stop the old master
+            Mock(returncode=0, stderr=''),                                   # start a new master
+            Mock(returncode=0, stdout=b'one'),                               # the command again
+            ]
+        transport = OpenSshTransport(TEST_ESXI_HOST, MOCK_LOGGER, control_dir='/tmp/esximanager-test')
+
+        self.assertEqual(CommandResult('one', 0), transport.run('echo one'))
+        stats = transport.stats()
+        self.assertEqual((2, 1), (stats['connections'], stats['reconnects']))
+
+    @patch('esximanager.transport.openssh.subprocess.run')
+    def test_run_connection_error(self, mock_run):
+        mock_run.return_value = Mock(returncode=255, stderr='Connection refused')
+        transport = OpenSshTransport(TEST_ESXI_HOST, MOCK_LOGGER, control_dir='/tmp/esximanager-test', retries=0)
+        with self.assertRaises(TransportError):
+            transport.run('echo one')
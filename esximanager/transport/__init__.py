@@ -0,0 +1,32 @@
+'''
+The transports through which all commands are run on the esxi hosts, see
+esximanager.transport.base.Transport.
+
+The implementations are only imported when one is requested, so that only
+the dependencies of the one in use are loaded.
+'''
+import importlib
+from esximanager.transport.base import CommandResult, Transport, TransportError
+
+TRANSPORT_PARAMIKO = 'paramiko'
+TRANSPORT_OPENSSH = 'openssh'
+TRANSPORT_FAKE = 'fake'
+
+TRANSPORTS = {
+    TRANSPORT_PARAMIKO: ('esximanager.transport.paramikossh', 'ParamikoTransport'),
+    TRANSPORT_OPENSSH: ('esximanager.transport.openssh', 'OpenSshTransport'),
+    TRANSPORT_FAKE: ('esximanager.transport.fake', 'FakeTransport'),
+    }
+
+DEFAULT_TRANSPORT = TRANSPORT_PARAMIKO
+
+
+def get_transport_class(name):
+    if name not in TRANSPORTS:
+        raise ValueError(f'Unknown transport={name}, must be one of {list(TRANSPORTS)}')
+    module_name, class_name = TRANSPORTS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_transport(name, host, logger, **kwargs):
+    return get_transport_class(name)(host, logger, **kwargs)
@@ -0,0 +1,200 @@
+import time
+import threading
+from collections import namedtuple
+
+
+class CommandResult(namedtuple('CommandResult', ['stdout', 'return_code'])):
+    '''
+    The output of a remote command, stdout and stderr combined, and its exit
+    status.
+    '''
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+
+class TransportError(Exception):
+    '''
+    Raised when a command cannot be run on the remote host even after
+    reconnecting.
+    '''
+    pass
+
+
+class ConnectionLostError(Exception):
+    '''
+    Raised by the transport implementations when the connection to the host
+    fails or drops, so that Transport.run can reconnect and retry.
+    '''
+    pass
+
+
+class Transport(object):
+    '''
+    Runs commands on an esxi host over a connection that is opened on the
+    first command and then kept open and reused for every subsequent command.
+    If the connection drops, it is re-established and the command retried.
+
+    Implementations provide _connect, _exec, _close and is_connected, and
+    keep count of the connections that they open in self.connections.
+
+    If an observer is set, it is called with the command, the time in seconds
+    that it took and whether it succeeded after every command.
+    '''
+
+    DEFAULT_USER = 'root'
+    DEFAULT_PORT = 22
+    DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+    DEFAULT_KEEPALIVE_SECONDS = 15
+    DEFAULT_RETRIES = 1
+
+    def __init__(
+            self,
+            host,
+            logger,
+            user=DEFAULT_USER,
+            port=DEFAULT_PORT,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+            keepalive=DEFAULT_KEEPALIVE_SECONDS,
+            retries=DEFAULT_RETRIES):
+        self.host = host
+        self.logger = logger
+        self.user = user
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.retries = retries
+
+        self.lock = threading.Lock()
+        self.observer = None
+
+        # Counters reported by Transport.stats
+        self.connections = 0
+        self.commands = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_connected(self):
+        raise NotImplementedError()
+
+    def _connect(self):
+        raise NotImplementedError()
+
+    def _exec(self, command):
+        '''
+        Runs the command on the open connection and returns a CommandResult,
+        raising ConnectionLostError if the connection fails.
+        '''
+        raise NotImplementedError()
+
+    def _exec_stream(self, command, on_line):
+        '''
+        Runs the command on the open connection, calling on_line with each
+        line of its output as it arrives, and returns its exit status, or None
+        if on_line returned False to stop reading early.
+
+        Implementations that cannot stream deliver all of the lines once the
+        command has completed.
+        '''
+        result = self._exec(command)
+        for line in result.stdout.splitlines():
+            if on_line(line) is False:
+                return None
+        return result.return_code
+
+    def _close(self):
+        raise NotImplementedError()
+
+    def connect(self):
+        '''
+        Opens the connection if it is not already open.
+        '''
+        with self.lock:
+            if not self.is_connected():
+                self._close()
+                self.logger.info(f'Opening {type(self).__name__} connection to host={self.host}')
+                self._connect()
+                self.connections += 1
+
+    def run(self, command, retry=True):
+        '''
+        Runs the command on the remote host and returns a CommandResult.
+
+        If the connection fails, it is closed, re-opened and the command is
+        run again up to Transport.retries times.  Pass retry=False for
+        commands that are expected to take the connection down with them.
+        '''
+        attempt = 0
+        while True:
+            try:
+                self.connect()
+                with self.lock:
+                    self.commands += 1
+                start_time = time.time()
+                try:
+                    result = self._exec(command)
+                except ConnectionLostError:
+                    self.observe(command, time.time() - start_time, False)
+                    raise
+                self.observe(command, time.time() - start_time, result.succeeded)
+                return result
+            except ConnectionLostError as e:
+                self.close()
+                if retry is False or attempt >= self.retries:
+                    raise TransportError(
+                        f'Unable to run command on host={self.host}, command={command}') from e.__cause__
+                attempt += 1
+                with self.lock:
+                    self.reconnects += 1
+                self.logger.warning(
+                    f'Connection to host={self.host} failed, reconnecting; attempt={attempt}, error={e.__cause__}')
+
+    def stream(self, command, on_line):
+        '''
+        Runs the command on the remote host, passing each line of its output
+        to on_line as it arrives, and returns its exit status, or None if
+        on_line returned False to stop reading early.
+
+        Unlike Transport.run, the command is never retried, as the lines that
+        were already passed to on_line would be repeated.  If the connection
+        fails, it is closed and a TransportError raised.
+        '''
+        try:
+            self.connect()
+            with self.lock:
+                self.commands += 1
+            start_time = time.time()
+            try:
+                return_code = self._exec_stream(command, on_line)
+            except ConnectionLostError:
+                self.observe(command, time.time() - start_time, False)
+                raise
+            self.observe(command, time.time() - start_time, return_code in (0, None))
+            return return_code
+        except ConnectionLostError as e:
+            self.close()
+            raise TransportError(
+                f'Unable to stream command on host={self.host}, command={command}') from e.__cause__
+
+    def observe(self, command, seconds, succeeded):
+        if self.observer is not None:
+            self.observer(command, seconds, succeeded)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def stats(self):
+        return dict(
+            host=self.host,
+            transport=type(self).__name__,
+            connections=self.connections,
+            commands=self.commands,
+            reconnects=self.reconnects)
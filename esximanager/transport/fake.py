@@ -0,0 +1,30 @@
+from esximanager.transport.base import Transport, CommandResult
+
+
+class FakeTransport(Transport):
+    '''
+    An in-memory transport that does not connect to anything.  Each command
+    is passed to the responder, a callable that returns a CommandResult, and
+    every command run is recorded in self.history.
+
+    Without a responder every command succeeds with no output.
+    '''
+
+    def __init__(self, host, logger, responder=None, **kwargs):
+        super().__init__(host, logger, **kwargs)
+        self.responder = responder if responder is not None else lambda command: CommandResult('', 0)
+        self.connected = False
+        self.history = []
+
+    def is_connected(self):
+        return self.connected
+
+    def _connect(self):
+        self.connected = True
+
+    def _exec(self, command):
+        self.history.append(command)
+        return self.responder(command)
+
+    def _close(self):
+        self.connected = False
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import subprocess
+from esximanager.transport.base import Transport, CommandResult, ConnectionLostError
+
+
+class OpenSshTransport(Transport):
+    '''
+    Runs commands with the system's OpenSSH client, multiplexed over a single
+    master connection (ControlMaster) that is kept open for the life of the
+    transport, so each command only costs a fork of the ssh client and a new
+    channel on the already authenticated connection.
+
+    Uses the user's ssh configuration, keys and agent, in BatchMode so that
+    it never prompts.
+    '''
+
+    SSH_CMD = 'ssh'
+
+    '''
+    Exit status of the ssh client when the connection itself failed, as
+    opposed to the exit status of the remote command.
+    '''
+    SSH_CONNECTION_ERROR = 255
+
+    def __init__(self, host, logger, control_dir=None, **kwargs):
+        super().__init__(host, logger, **kwargs)
+        self.control_dir = control_dir
+        self.tmpdir = None
+        self.control_path = None
+        self.connected = False
+
+    def get_ssh_args(self):
+        return [
+            OpenSshTransport.SSH_CMD,
+            '-o', 'BatchMode=yes',
+            '-o', f'ConnectTimeout={int(self.connect_timeout)}',
+            '-o', f'ServerAliveInterval={int(self.keepalive)}',
+            '-o', f'ControlPath={self.control_path}',
+            '-p', str(self.port),
+            '-l', self.user,
+            ]
+
+    def is_connected(self):
+        '''
+        Does not check the master with ssh -O check, which would cost another
+        fork for every command.  If the master has gone, the command fails
+        with SSH_CONNECTION_ERROR and Transport.run reconnects.
+        '''
+        return self.connected
+
+    def _connect(self):
+        if self.control_path is None:
+            if self.control_dir is None:
+                self.tmpdir = tempfile.TemporaryDirectory(prefix='esximanager-ssh-')
+                self.control_dir = self.tmpdir.name
+            self.control_path = os.path.join(self.control_dir, '%C')
+
+        # Start a backgrounded master connection that persists until we close it
+        result = subprocess.run(
+            self.get_ssh_args() + ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-N', '-f', self.host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode != 0:
+            raise ConnectionLostError() from OSError(result.stderr.strip())
+        self.connected = True
+
+    def _exec(self, command):
+        result = subprocess.run(
+            self.get_ssh_args() + ['-o', 'ControlMaster=no', self.host, command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        stdout = result.stdout.decode('utf-8', errors='replace')
+        if result.returncode == OpenSshTransport.SSH_CONNECTION_ERROR:
+            raise ConnectionLostError() from OSError(stdout.strip())
+        return CommandResult(stdout, result.returncode)
+
+    def _exec_stream(self, command, on_line):
+        process = subprocess.Popen(
+            self.get_ssh_args() + ['-o', 'ControlMaster=no', self.host, command],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        last_line = ''
+        try:
+            for line in process.stdout:
+                last_line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+                if on_line(last_line) is False:
+                    return None
+            return_code = process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+        if return_code == OpenSshTransport.SSH_CONNECTION_ERROR:
+            raise ConnectionLostError() from OSError(last_line.strip())
+        return return_code
+
+    def _close(self):
+        if self.connected:
+            subprocess.run(
+                self.get_ssh_args() + ['-O', 'exit', self.host],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            self.connected = False
@@ -0,0 +1,88 @@
+import socket
+import paramiko
+from esximanager.transport.base import Transport, CommandResult, ConnectionLostError, TransportError
+
+
+class ParamikoTransport(Transport):
+    '''
+    A single authenticated ssh connection made with the paramiko library.
+
+    Commands are exec'd on their own channel of the connection and are run
+    by the remote user's shell without the -l flag, so no login profile is
+    sourced.  Channels can be opened from several threads at once.
+
+    A command that produces no output for command_timeout seconds, such as a
+    hung vim-cmd, is given up on with a TransportError, without retrying it.
+    Streamed commands have no such timeout, as they can be idle for long.
+    '''
+
+    DEFAULT_COMMAND_TIMEOUT_SECONDS = 120
+
+    def __init__(self, host, logger, command_timeout=None, **kwargs):
+        super().__init__(host, logger, **kwargs)
+        if command_timeout is not None and command_timeout > 0:
+            self.command_timeout = command_timeout
+        else:
+            self.command_timeout = ParamikoTransport.DEFAULT_COMMAND_TIMEOUT_SECONDS
+        self.client = None
+
+    def is_connected(self):
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect(self):
+        try:
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(
+                self.host,
+                port=self.port,
+                username=self.user,
+                timeout=self.connect_timeout)
+            client.get_transport().set_keepalive(self.keepalive)
+        except (paramiko.SSHException, socket.error, EOFError) as e:
+            raise ConnectionLostError() from e
+        self.client = client
+
+    def _exec(self, command):
+        try:
+            channel = self.client.get_transport().open_session()
+            try:
+                channel.settimeout(self.command_timeout)
+                channel.set_combine_stderr(True)
+                channel.exec_command(command)
+                stdout = channel.makefile('rb').read().decode('utf-8', errors='replace')
+                return_code = channel.recv_exit_status()
+            finally:
+                channel.close()
+        except socket.timeout as e:
+            raise TransportError(
+                f'Command did not complete within [{self.command_timeout}] seconds on host={self.host}, '
+                f'command={command}') from e
+        except (paramiko.SSHException, socket.error, EOFError, AttributeError) as e:
+            raise ConnectionLostError() from e
+        return CommandResult(stdout, return_code)
+
+    def _exec_stream(self, command, on_line):
+        try:
+            channel = self.client.get_transport().open_session()
+            try:
+                channel.set_combine_stderr(True)
+                channel.exec_command(command)
+                for line in channel.makefile('rb'):
+                    if on_line(line.decode('utf-8', errors='replace').rstrip('\r\n')) is False:
+                        return None
+                return_code = channel.recv_exit_status()
+            finally:
+                channel.close()
+        except (paramiko.SSHException, socket.error, EOFError, AttributeError) as e:
+            raise ConnectionLostError() from e
+        return return_code
+
+    def _close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
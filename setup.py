@@ -26,11 +26,12 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        'fabric3==1.14.post1',
+        'paramiko>=2.4',
         ],
     entry_points={
          'console_scripts': [
              'esximanager=esximanager.main:main',
+             'esximanager-trigger=esximanager.agentclient:main',
              ],
     },
 )